@@ -4,35 +4,366 @@ import sys
 import logging
 import argparse
 import time
+import queue
+import threading
 import collections
 import datetime as dt
+import urllib.parse
+import zmq
+import dill
+import prometheus_client as pc
 import ami.multiproc as mp
 from ami.worker import run_worker, parse_args
 from ami import LogConfig, Defaults
-from ami.comm import BasePort, Ports, Colors, Node, Collector, TransitionBuilder, EventBuilder
+from ami.comm import BasePort, Ports, Colors, Node, Collector, TransitionBuilder, EventBuilder, collector_tiers, \
+    rank_stragglers
 from ami.data import MsgTypes, Transitions
 
 
 logger = logging.getLogger(__name__)
 
 
+def tier_name(tier):
+    """
+    Returns the base name of the collectors in an intermediate tier of the
+    reduction tree.
+
+    Args:
+        tier (int): the intermediate tier starting from zero
+
+    Returns:
+        The base name of the collectors which takes the node number as a format argument.
+    """
+    return (Colors.MidCollector % tier) + "_%03d"
+
+
+class GraphLane:
+    """
+    Completes the heartbeats of a subset of the graphs handled by a collector.
+    Each lane has its own event builder, so graphs in different lanes never
+    wait on each other.
+
+    Work for the graphs of the lane is passed to `submit`. When the lane has a
+    thread the work is queued and done on that thread in the order it was
+    submitted, otherwise it is done right away on the calling thread.
+
+    Args:
+        store (EventBuilder): the event builder for the graphs of the lane.
+        report (function): sends a report to the manager. With a thread it is
+            only called from `process_reports`.
+        wake_addr (str): the zmq address used to wake up the main thread when
+            the lane has reports for the manager. If None the lane has no
+            thread.
+    """
+
+    def __init__(self, store, report, wake_addr=None):
+        self.store = store
+        self.graphs = set()
+        self.heartbeat_time = collections.defaultdict(lambda: 0)
+        self._report = report
+        self.wake_addr = wake_addr
+        self.reports = queue.Queue()
+        if wake_addr is None:
+            self.tasks = None
+            self.thread = None
+        else:
+            self.tasks = queue.Queue()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.thread is not None:
+            self.thread.start()
+
+    def submit(self, func, *args):
+        """
+        Calls func with the lane and the passed arguments on the thread of the
+        lane.
+
+        Args:
+            func (function): the work to be done.
+        """
+        if self.tasks is None:
+            func(self, *args)
+        else:
+            self.tasks.put((func, args))
+
+    def wait(self):
+        """
+        Blocks until all the work submitted to the lane has been done.
+        """
+        if self.tasks is not None:
+            self.tasks.join()
+
+    def report(self, topic, payload):
+        if self.tasks is None:
+            self._report(topic, payload)
+        else:
+            self.reports.put((topic, payload))
+
+    def process_reports(self):
+        """
+        Sends the reports queued by the thread of the lane to the manager.
+        """
+        while True:
+            try:
+                topic, payload = self.reports.get_nowait()
+            except queue.Empty:
+                break
+            self._report(topic, payload)
+
+    def _run(self):
+        wake = self.store.ctx.socket(zmq.PUSH)
+        wake.connect(self.wake_addr)
+        try:
+            while True:
+                func, args = self.tasks.get()
+                try:
+                    func(self, *args)
+                except Exception as e:
+                    logger.exception("Failure encountered in graph completion thread")
+                    self.report("error", e)
+                finally:
+                    self.tasks.task_done()
+                if not self.reports.empty():
+                    try:
+                        wake.send(b'', flags=zmq.NOBLOCK)
+                    except zmq.Again:
+                        # the main thread already has a wake up pending
+                        pass
+        except zmq.ContextTerminated:
+            wake.close(linger=0)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints of the graph state of a collector to files on a
+    background thread, so the collector never waits on the filesystem. Each
+    file is written under a temporary name and then renamed, so a crash never
+    leaves a partial checkpoint behind.
+
+    Args:
+        path (str): the directory the checkpoint files are written to.
+        prefix (str): the prefix of the checkpoint file names, which is the
+            name of the collector.
+    """
+
+    suffix = ".ckpt"
+
+    def __init__(self, path, prefix):
+        self.path = path
+        self.prefix = prefix
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, name):
+        return os.path.join(self.path, "%s.%s%s" % (self.prefix, urllib.parse.quote(name, safe=''), self.suffix))
+
+    def start(self):
+        self.thread.start()
+
+    def write(self, name, data):
+        """
+        Queues a checkpoint to be written.
+
+        Args:
+            name (str): the name of the graph.
+            data (bytes): the serialized checkpoint.
+        """
+        self.requests.put((name, data))
+
+    def remove(self, name):
+        """
+        Queues the removal of the checkpoint of a graph.
+
+        Args:
+            name (str): the name of the graph.
+        """
+        self.requests.put((name, None))
+
+    def wait(self):
+        """
+        Blocks until all the queued checkpoints have been written.
+        """
+        self.requests.join()
+
+    def load(self):
+        """
+        Loads the checkpoints written by a previous run of the collector.
+
+        Returns:
+            A dictionary of the graph version and node state keyed by graph
+            name.
+        """
+        checkpoints = {}
+        start = self.prefix + "."
+        for filename in os.listdir(self.path):
+            if filename.startswith(start) and filename.endswith(self.suffix):
+                name = urllib.parse.unquote(filename[len(start):-len(self.suffix)])
+                try:
+                    with open(os.path.join(self.path, filename), 'rb') as f:
+                        checkpoints[name] = dill.load(f)
+                except Exception:
+                    logger.exception("Failure encountered loading checkpoint %s", filename)
+        return checkpoints
+
+    def _run(self):
+        while True:
+            name, data = self.requests.get()
+            filename = self.filename(name)
+            try:
+                if data is None:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                else:
+                    tmpname = filename + ".tmp"
+                    with open(tmpname, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmpname, filename)
+            except OSError:
+                logger.exception("Failure encountered writing checkpoint %s", filename)
+            finally:
+                self.requests.task_done()
+
+
+class StragglerTracker:
+    """
+    Accumulates how long after the first contribution of the same heartbeat
+    the contributions of each sender arrive, plus how many of them were late
+    or missing at completion. Statistics can be recorded from the threads of
+    several graph lanes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, sender, offsets=(), late=0, missing=0):
+        """
+        Adds to the statistics of a sender.
+
+        Args:
+            sender (str): the name of the contributor.
+            offsets (list): the arrival offsets of its contributions in seconds.
+            late (int): the number of contributions that arrived after completion.
+            missing (int): the number of contributions missing at completion.
+        """
+        with self.lock:
+            if sender not in self.stats:
+                self.stats[sender] = {'sender': sender, 'contributions': 0, 'total_offset': 0.0,
+                                      'max_offset': 0.0, 'late': 0, 'missing': 0}
+            entry = self.stats[sender]
+            if offsets:
+                entry['contributions'] += len(offsets)
+                entry['total_offset'] += sum(offsets)
+                entry['max_offset'] = max(entry['max_offset'], max(offsets))
+            entry['late'] += late
+            entry['missing'] += missing
+
+    def ranking(self):
+        """
+        Ranks the senders seen since the last call and resets the statistics.
+
+        Returns:
+            A list of the statistics of each sender ordered from the worst
+            straggler to the best.
+        """
+        with self.lock:
+            stats, self.stats = self.stats, {}
+        for entry in stats.values():
+            total = entry.pop('total_offset')
+            entry['mean_offset'] = total / entry['contributions'] if entry['contributions'] else 0.0
+        return rank_stragglers(stats.values())
+
+
 class GraphCollector(Node, Collector):
     def __init__(self, node, base_name, num_workers, color, collector_addr, downstream_addr, graph_addr,
-                 msg_addr, prometheus_dir, prometheus_port, hutch):
+                 msg_addr, prometheus_dir, prometheus_port, hutch, recv_threads=0, incremental=False,
+                 fan_in=None, sender=None, completion_timeout=None, graph_threads=0, depth=10, max_bytes=None,
+                 checkpoint_dir=None, checkpoint_interval=60, restore=False, straggler_interval=10,
+                 transition_timeout=5):
         Node.__init__(self, node, graph_addr, msg_addr, prometheus_dir=prometheus_dir,
                       prometheus_port=prometheus_port, hutch=hutch)
-        Collector.__init__(self, collector_addr, ctx=self.ctx, hutch=hutch)
+        Collector.__init__(self, collector_addr, ctx=self.ctx, hutch=hutch, recv_threads=recv_threads)
         self.base_name = base_name
         self.num_workers = num_workers
+        self.color = color
+        # the contributors of the collectors in a tier are assigned in blocks of fan_in
+        self.fan_in = fan_in or num_workers
         self.transitions = TransitionBuilder(self.num_workers, downstream_addr, self.ctx)
-        self.store = EventBuilder(self.num_workers, 10, color, downstream_addr, self.ctx)
-        self.sender = 'worker%03d' if color == 'localCollector' else 'localCollector%03d'
+        # the number of datagrams received keyed by (eb_id, graph name), the datagrams sent before a transition
+        # travel on a different socket so a ready transition waits up to transition_timeout seconds for them
+        self.received = collections.Counter()
+        self.transition_timeout = transition_timeout
+        self.waiting = None
+        self.completion_timeout = completion_timeout
+        # wake up often enough to complete heartbeats when contributors stop sending
+        self.poll_timeout = completion_timeout
+        self.contrib_late = pc.Counter('ami_contributor_late_count', 'Contributions Arriving After Completion',
+                                       ['hutch', 'sender', 'process'])
+        self.contrib_missing = pc.Counter('ami_contributor_missing_count', 'Contributions Missing At Completion',
+                                          ['hutch', 'sender', 'process'])
+        self.pending_count = pc.Gauge('ami_graph_pending_heartbeats', 'Heartbeats Waiting For Contributions',
+                                      ['hutch', 'graph', 'process'])
+        self.pending_bytes = pc.Gauge('ami_graph_pending_bytes', 'Bytes Of Contributions Waiting For Completion',
+                                      ['hutch', 'graph', 'process'])
+        self.arrival_offset = pc.Histogram('ami_contributor_arrival_offset_secs',
+                                           'Contribution Arrival Time After The First Contribution Of The Heartbeat',
+                                           ['hutch', 'sender', 'process'])
+        self.completion_time = pc.Histogram('ami_heartbeat_completion_secs',
+                                            'Heartbeat Time From First Contribution To Completion',
+                                            ['hutch', 'process'])
+        # the ranked stragglers are reported to the manager every straggler_interval seconds
+        self.stragglers = StragglerTracker()
+        self.straggler_interval = straggler_interval
+        self.last_straggler_report = time.time()
+        if self.poll_timeout is None or self.poll_timeout > straggler_interval * 1000:
+            self.poll_timeout = straggler_interval * 1000
+        if sender is None:
+            sender = 'worker%03d' if color == Colors.LocalCollector else 'localCollector%03d'
+        self.sender = sender
         self.pickers = {}
         self.strategies = {}
-        self.heartbeat_time = collections.defaultdict(lambda: 0)
+        self.latencies = {}
 
         self.downstream_addr = downstream_addr
 
+        # each graph is assigned to a lane which completes its heartbeats
+        if graph_threads > 0:
+            wake_addr = "inproc://collector-lanes-%x" % id(self)
+            self.lane_sock = self.ctx.socket(zmq.PULL)
+            self.lane_sock.bind(wake_addr)
+            self.register(self.lane_sock, self.process_reports)
+        else:
+            wake_addr = None
+        self.lanes = []
+        for _ in range(max(graph_threads, 1)):
+            store = EventBuilder(self.num_workers, depth, color, downstream_addr, self.ctx, batching=True,
+                                 incremental=incremental,
+                                 timeout=None if completion_timeout is None else completion_timeout / 1000,
+                                 max_bytes=max_bytes)
+            self.lanes.append(GraphLane(store, self.report, wake_addr))
+        self.routes = {}
+
+        # the state of the graphs is periodically saved so a restarted collector can pick up where it left off
+        if checkpoint_dir is None:
+            self.checkpointer = None
+        else:
+            self.checkpointer = CheckpointWriter(checkpoint_dir, self.name)
+            self.checkpoint_interval = checkpoint_interval
+            self.last_checkpoint = time.time()
+            if self.poll_timeout is None or self.poll_timeout > checkpoint_interval * 1000:
+                self.poll_timeout = checkpoint_interval * 1000
+            if restore:
+                for name, (version, states) in self.checkpointer.load().items():
+                    logger.info("%s: Loaded checkpoint of graph (%s v%d)", self.name, name, version)
+                    self.lane(name).submit(lambda lane, name=name, version=version, states=states:
+                                           lane.store.restore_state(name, version, states))
+
+        # while messages are waiting in a spill queue they are retried every spill_retry ms
+        self.timer_timeout = self.poll_timeout
+        self.spill_retry = 10
+
         self.register(self.graph_comm.sock, self.graph_comm.recv)
 
     def __enter__(self):
@@ -48,134 +379,384 @@ class GraphCollector(Node, Collector):
     def close(self):
         self.ctx.destroy()
 
-    def flush(self, configure):
+    def run(self):
+        for lane in self.lanes:
+            lane.start()
+        if self.checkpointer is not None:
+            self.checkpointer.start()
+        return super().run()
+
+    def lane(self, name):
+        """
+        Returns the lane of a graph. A graph seen for the first time is
+        assigned to the lane with the fewest graphs.
+
+        Args:
+            name (str): the name of the graph.
+        """
+        if name not in self.routes:
+            lane = min(self.lanes, key=lambda lane: len(lane.graphs))
+            lane.graphs.add(name)
+            self.routes[name] = lane
+        return self.routes[name]
+
+    def broadcast(self, func, *args):
+        for lane in self.lanes:
+            lane.submit(func, *args)
+
+    def wait(self):
+        """
+        Blocks until the lanes have finished all the work submitted to them.
+        """
+        for lane in self.lanes:
+            lane.wait()
+
+    def process_reports(self):
+        # clear the wake up notifications from the lanes
+        while True:
+            try:
+                self.lane_sock.recv(flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+        for lane in self.lanes:
+            lane.process_reports()
+
+    def flush(self, lane, configure):
         try:
             if configure:
-                self.store.flush(self.node, drop=True)
+                # heartbeats of the previous run still pending at Configure are lost
+                flushed = sum(count for count, _ in lane.store.pending_stats().values())
+                lane.store.flush(self.node, drop=True)
+                if flushed:
+                    self.event_counter.labels(self.hutch, 'Flushed Heartbeat', self.name).inc(flushed)
         except Exception as e:
             logger.exception("%s: Failure encountered while flushing store", self.name)
-            self.report("error", e)
+            lane.report("error", e)
 
-    def begin_run(self):
+    def begin_run(self, lane):
         try:
-            self.store.begin_run()
+            lane.store.begin_run()
         except Exception as e:
             logger.exception("%s: Failure encountered while beginning run", self.name)
-            self.report("error", e)
+            lane.report("error", e)
 
-    def end_run(self):
+    def end_run(self, lane):
         try:
-            self.store.end_run()
+            lane.store.end_run()
         except Exception as e:
             logger.exception("%s: Failure encountered while ending run %d", self.name)
-            self.report("error", e)
+            lane.report("error", e)
 
-    def begin_step(self, step):
+    def begin_step(self, lane, step):
         try:
-            self.store.begin_step(step)
+            lane.store.begin_step(step)
         except Exception as e:
             logger.exception("%s: Failure encountered while beginning step %d", self.name, step)
-            self.report("error", e)
+            lane.report("error", e)
 
-    def end_step(self, step):
+    def end_step(self, lane, step):
         try:
-            self.store.end_step(step)
+            lane.store.end_step(step)
         except Exception as e:
             logger.exception("%s: Failure encountered while ending step %d", self.name, step)
-            self.report("error", e)
+            lane.report("error", e)
 
     def eb_id(self, identity):
-        return identity - (self.node * self.num_workers)
+        return identity - (self.node * self.fan_in)
+
+    def identity(self, eb_id):
+        return eb_id + (self.node * self.fan_in)
+
+    def contributor_span(self, workers_per_node, fan_in, num_tiers):
+        """
+        Computes how many consecutive worker identities each contributor of
+        this collector is responsible for.
 
-    def report_times(self, times, name, heartbeat):
+        Args:
+            workers_per_node (int): the number of workers per local collector
+            fan_in (int): the fan-in of the intermediate collector tiers
+            num_tiers (int): the number of intermediate collector tiers
+
+        Returns:
+            The number of workers per contributor.
+        """
+        if self.color == Colors.LocalCollector:
+            return 1
+        for tier in range(num_tiers):
+            if self.color == Colors.MidCollector % tier:
+                return workers_per_node * fan_in ** tier
+        return workers_per_node * fan_in ** num_tiers if num_tiers else workers_per_node
+
+    def recv_members(self, name, version, args, members):
+        span = self.contributor_span(members['workers_per_node'],
+                                     members['fan_in'],
+                                     len(args.get('num_mid_collectors') or []))
+        eb_ids = {self.eb_id(worker // span) for worker in members['workers']}
+        eb_ids = {eb_id for eb_id in eb_ids if 0 <= eb_id < self.num_workers}
+        logger.info("%s: Active contributors changed to %s (v%d)", self.name, sorted(eb_ids), version)
+        if self.transitions.set_members(eb_ids, version):
+            self.broadcast(self.set_members, eb_ids, version)
+            # transitions that were only waiting on removed contributors can be completed now
+            self.process_transitions()
+
+    def set_members(self, lane, eb_ids, version):
+        # heartbeats that were only waiting on removed contributors can be completed now
+        self.complete_heartbeats(lane, lane.store.set_members(eb_ids, version), 'Heartbeat')
+
+    def report_times(self, lane, times, name, heartbeat):
         if times:
-            self.report("profile", {'graph': name,
+            lane.report("profile", {'graph': name,
                                     'heartbeat': heartbeat,
                                     'times': times,
-                                    'version': self.store.version(name)})
+                                    'version': lane.store.version(name)})
 
     def recv_graph(self, name, version, args, graph):
-        self.store.set_graph(name, version, args, graph)
+        self.lane(name).submit(lambda lane: lane.store.set_graph(name, version, args, graph))
 
     def recv_graph_add(self, name, version, args, nodes):
-        self.store.add_graph(name, version, args, nodes)
+        self.lane(name).submit(lambda lane: lane.store.add_graph(name, version, args, nodes))
 
     def recv_graph_del(self, name, version, args, nodes):
-        self.store.del_graph(name, version, args, nodes)
+        self.lane(name).submit(lambda lane: lane.store.del_graph(name, version, args, nodes))
 
     def recv_graph_purge(self, name, version, args, graph):
-        self.store.purge_graph(name, version, args, graph)
+        self.lane(name).submit(self.purge_graph, name, version, args, graph)
+
+    def purge_graph(self, lane, name, version, args, graph):
+        lane.store.purge_graph(name, version, args, graph)
+        if self.checkpointer is not None:
+            self.checkpointer.remove(name)
+
+    def update_limits(self, name, version, args, limits):
+        logger.info("%s: Event builder limits of graph %s changed to %s", self.name, name, limits)
+        self.lane(name).submit(lambda lane: lane.store.set_limits(name, limits['depth'], limits['max_bytes']))
+
+    def update_unviewed(self, name, version, args, names):
+        logger.debug("%s: Outputs of graph %s no longer viewed changed to %s", self.name, name, names)
+        self.lane(name).submit(lambda lane: lane.store.set_unviewed(name, names))
 
     def recv_graph_exception(self, name, version, exception):
         logger.exception("%s: Failure encountered updating graph (%s v%d):",
                          self.name, name, version)
         self.report("error", "Failure updating graph: %s" % exception)
         logger.error("%s: Purging graph (%s v%d)", self.name, name, version)
-        self.store.destroy(name)
+        self.lane(name).submit(lambda lane: lane.store.destroy(name))
         self.report("purge", name)
 
+    def graph_failure(self, lane, name, exception):
+        exception.graph_name = name
+        logger.exception("%s: Failure encountered while executing graph %s:", self.name, name)
+        lane.report("error", exception)
+        logger.error("%s: Purging graph (%s v%d)", self.name, name, lane.store.version(name))
+        lane.store.destroy(name)
+        lane.report("purge", name)
+
+    def process_batch_end(self):
+        for sender, latency in self.latencies.items():
+            self.event_latency.labels(self.hutch, sender, self.name).set(latency)
+        self.latencies.clear()
+        self.count_deferred(self.transitions)
+        duplicates = self.transitions.reset_duplicates()
+        if duplicates:
+            self.event_counter.labels(self.hutch, 'Duplicate Transition', self.name).inc(duplicates)
+        self.broadcast(self.lane_batch_end)
+
+    def lane_batch_end(self, lane):
+        lane.store.flush_batch()
+        self.count_deferred(lane.store)
+        late, missing = lane.store.reset_stragglers()
+        offsets, completions = lane.store.reset_arrivals()
+        for eb_id in late.keys() | missing.keys() | offsets.keys():
+            sender = self.sender % self.identity(eb_id)
+            if late[eb_id]:
+                self.contrib_late.labels(self.hutch, sender, self.name).inc(late[eb_id])
+            if missing[eb_id]:
+                self.contrib_missing.labels(self.hutch, sender, self.name).inc(missing[eb_id])
+            histogram = self.arrival_offset.labels(self.hutch, sender, self.name)
+            for offset in offsets[eb_id]:
+                histogram.observe(offset)
+            self.stragglers.record(sender, offsets[eb_id], late[eb_id], missing[eb_id])
+        histogram = self.completion_time.labels(self.hutch, self.name)
+        for completion in completions:
+            histogram.observe(completion)
+        for name, (count, size) in lane.store.pending_stats().items():
+            self.pending_count.labels(self.hutch, name, self.name).set(count)
+            self.pending_bytes.labels(self.hutch, name, self.name).set(size)
+
+    def count_deferred(self, handler):
+        deferred, dropped = handler.reset_counts()
+        if deferred:
+            self.event_counter.labels(self.hutch, 'Deferred Heartbeat', self.name).inc(deferred)
+        if dropped:
+            self.event_counter.labels(self.hutch, 'Dropped Heartbeat', self.name).inc(dropped)
+
+    def process_timers(self):
+        if self.waiting is not None:
+            self.process_transitions()
+        self.drain_spills()
+        if self.completion_timeout is not None:
+            self.broadcast(self.expire_heartbeats)
+        if self.checkpointer is not None and time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.last_checkpoint = time.time()
+            self.broadcast(self.checkpoint)
+        if time.time() - self.last_straggler_report >= self.straggler_interval:
+            self.last_straggler_report = time.time()
+            ranking = self.stragglers.ranking()
+            if ranking:
+                self.report("stragglers", ranking)
+
+    def drain_spills(self):
+        """
+        Retries sending the messages waiting in the spill queues, so the last
+        transition or heartbeat before the data stops is not held back until
+        something else is sent.
+        """
+        spilled = not self.transitions.drain_spill()
+        for lane in self.lanes:
+            if lane.store.spill:
+                lane.submit(lambda lane: lane.store.drain_spill())
+                spilled = True
+        waiting = spilled or self.waiting is not None
+        self.poll_timeout = self.spill_retry if waiting else self.timer_timeout
+
+    def checkpoint(self, lane):
+        # the state is serialized on the lane so it is consistent, the file is written by the checkpointer
+        for name, checkpoint in lane.store.checkpoint().items():
+            try:
+                self.checkpointer.write(name, dill.dumps(checkpoint))
+            except Exception:
+                logger.exception("%s: Failure encountered checkpointing graph %s", self.name, name)
+
+    def expire_heartbeats(self, lane):
+        self.complete_heartbeats(lane, lane.store.expired(), 'Timeout Heartbeat')
+
+    def complete_heartbeats(self, lane, heartbeats, label):
+        for name, heartbeat in heartbeats:
+            # a graph failure on an earlier heartbeat may have purged the graph
+            if name not in lane.store.builders:
+                continue
+            try:
+                # complete the heartbeat with whatever contributions have arrived
+                times, size = lane.store.complete(name, heartbeat, self.node)
+                self.event_counter.labels(self.hutch, label, self.name).inc()
+                self.event_size.labels(self.hutch, self.name).set(size)
+                lane.heartbeat_time.pop(heartbeat.identity, 0)
+            except Exception as e:
+                self.graph_failure(lane, name, e)
+        if heartbeats:
+            self.lane_batch_end(lane)
+
+    def settle_heartbeats(self, lane, boundary):
+        self.complete_heartbeats(lane, lane.store.settled(boundary), 'Settled Heartbeat')
+
+    def process_transitions(self):
+        """
+        Completes the ready transitions in the order they arrived. A transition
+        is held back until the datagrams its contributors sent before it have
+        been received, or until transition_timeout seconds have passed since
+        it was ready in case they were dropped.
+        """
+        for seq in self.transitions.ready_keys():
+            undelivered = self.transitions.undelivered(seq, self.received)
+            if undelivered:
+                now = time.time()
+                if self.waiting is None or self.waiting[0] != seq:
+                    self.waiting = (seq, now)
+                if now - self.waiting[1] < self.transition_timeout:
+                    return
+                logger.warning("%s: Completing transition %d without the datagrams %s", self.name, seq,
+                               sorted(undelivered))
+                # count them as received so a collector that was restarted does not wait on every transition
+                for key, count in undelivered.items():
+                    self.received[key] = count
+            self.waiting = None
+            self.process_transition(seq)
+
+    def process_transition(self, seq):
+        transition = self.transitions.pending[seq]
+        ttype, payload = transition.ttype, transition.payload
+        # complete the heartbeats every contributor sent before the transition instead of pruning them later, the
+        # heartbeats of the previous run were already settled by its Unconfigure and may be numbered from the start
+        if transition.heartbeat is not None and ttype != Transitions.Configure:
+            self.broadcast(self.settle_heartbeats, transition.heartbeat)
+        # send any completed heartbeats ahead of the transition
+        self.broadcast(lambda lane: lane.store.flush_batch())
+        self.wait()
+        # the next tier waits for the datagrams sent so far, the lanes are idle so their counts can be read here
+        transition.sent = dict(sum((lane.store.sent for lane in self.lanes), collections.Counter()))
+        self.transitions.complete(seq, self.node)
+        if ttype == Transitions.Configure:
+            self.broadcast(self.flush, True)
+            self.broadcast(self.begin_run)
+        elif ttype == Transitions.Unconfigure:
+            self.broadcast(self.flush, False)
+            self.broadcast(self.end_run)
+        elif ttype == Transitions.BeginStep:
+            self.broadcast(self.begin_step, payload)
+        elif ttype == Transitions.EndStep:
+            self.broadcast(self.end_step, payload)
+
+    def process_datagram(self, lane, msg):
+        datagram_start = time.time()
+        try:
+            # in incremental mode the contribution is run through the graph here
+            lane.store.update(msg.name, msg.heartbeat, self.eb_id(msg.identity), msg.version, msg.payload,
+                              msg.contributors)
+        except Exception as e:
+            self.graph_failure(lane, msg.name, e)
+            return
+        if lane.store.ready(msg.name, msg.heartbeat):
+            try:
+                # prune entries older than the current heartbeat
+                pruned_times, pruned_size = lane.store.prune(msg.name, self.node, msg.heartbeat)
+                if pruned_size:
+                    self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
+                    self.event_size.labels(self.hutch, self.name).set(pruned_size)
+                # complete the current heartbeat
+                times, size = lane.store.complete(msg.name, msg.heartbeat, self.node)
+
+                # times = lane.store.complete(msg.name, msg.heartbeat, self.node)
+                # self.report_times(lane, times, msg.name, msg.heartbeat)
+
+                self.event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
+                lane.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
+                heartbeat_time = lane.heartbeat_time.pop(msg.heartbeat.identity, 0)
+                self.event_time.labels(self.hutch, 'Heartbeat', self.name).set(heartbeat_time)
+                self.event_size.labels(self.hutch, self.name).set(size)
+            except Exception as e:
+                self.graph_failure(lane, msg.name, e)
+        else:
+            # prune older entries from the event builder
+            pruned_times, pruned_size = lane.store.prune(msg.name, self.node)
+            if pruned_size:
+                self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
+                self.event_size.labels(self.hutch, self.name).set(pruned_size)
+                lane.heartbeat_time.pop(msg.heartbeat.identity, 0)
+
+        lane.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
+
     def process_msg(self, msg):
         if msg.mtype == MsgTypes.Transition:
-            self.transitions.update(msg.payload.ttype, self.eb_id(msg.identity), msg.payload.payload)
-            if self.transitions.ready(msg.payload.ttype):
-                self.transitions.complete(msg.payload.ttype, self.node)
-                if msg.payload.ttype == Transitions.Configure:
-                    self.flush(True)
-                    self.begin_run()
-                elif msg.payload.ttype == Transitions.Unconfigure:
-                    self.flush(False)
-                    self.end_run()
-                elif msg.payload.ttype == Transitions.BeginStep:
-                    self.begin_step(msg.payload.payload)
-                elif msg.payload.ttype == Transitions.EndStep:
-                    self.end_step(msg.payload.payload)
+            self.transitions.update(msg.payload.seq, self.eb_id(msg.identity), msg.payload)
+            self.process_transitions()
 
             self.event_counter.labels(self.hutch, 'Transition', self.name).inc()
         elif msg.mtype == MsgTypes.Datagram:
+            # the latency gauges are updated once per batch in process_batch_end
             latency = dt.datetime.now() - dt.datetime.fromtimestamp(msg.heartbeat.timestamp)
-            self.event_latency.labels(self.hutch, self.sender % msg.identity,
-                                      self.name).set(latency.total_seconds())
-            datagram_start = time.time()
-            self.store.update(msg.name, msg.heartbeat, self.eb_id(msg.identity), msg.version, msg.payload)
-            if self.store.ready(msg.name, msg.heartbeat):
-                try:
-                    # prune entries older than the current heartbeat
-                    pruned_times, pruned_size = self.store.prune(msg.name, self.node, msg.heartbeat)
-                    if pruned_size:
-                        self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
-                        self.event_size.labels(self.hutch, self.name).set(pruned_size)
-                    # complete the current heartbeat
-                    times, size = self.store.complete(msg.name, msg.heartbeat, self.node)
-
-                    # times = self.store.complete(msg.name, msg.heartbeat, self.node)
-                    # self.report_times(times, msg.name, msg.heartbeat)
-
-                    self.event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
-                    self.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
-                    heartbeat_time = self.heartbeat_time.pop(msg.heartbeat.identity, 0)
-                    self.event_time.labels(self.hutch, 'Heartbeat', self.name).set(heartbeat_time)
-                    self.event_size.labels(self.hutch, self.name).set(size)
-                except Exception as e:
-                    e.graph_name = msg.name
-                    logger.exception("%s: Failure encountered while executing graph %s:", self.name, msg.name)
-                    self.report("error", e)
-                    logger.error("%s: Purging graph (%s v%d)", self.name, msg.name, self.store.version(msg.name))
-                    self.store.destroy(msg.name)
-                    self.report("purge", msg.name)
-            else:
-                # prune older entries from the event builder
-                pruned_times, pruned_size = self.store.prune(msg.name, self.node)
-                if pruned_size:
-                    self.event_counter.labels(self.hutch, 'Pruned Heartbeat', self.name).inc()
-                    self.event_size.labels(self.hutch, self.name).set(pruned_size)
-                    self.heartbeat_time.pop(msg.heartbeat.identity, 0)
-
-            self.heartbeat_time[msg.heartbeat.identity] += time.time() - datagram_start
+            self.latencies[self.sender % msg.identity] = latency.total_seconds()
+            self.received[(self.eb_id(msg.identity), msg.name)] += 1
+            # the graph is completed by its lane, which may be on another thread
+            self.lane(msg.name).submit(self.process_datagram, msg)
+            if self.waiting is not None:
+                self.process_transitions()
 
 
 def run_collector(node_num, base_name, num_contribs, color,
                   collector_addr, upstream_addr, graph_addr, msg_addr,
-                  prometheus_dir, prometheus_port, hutch):
+                  prometheus_dir, prometheus_port, hutch, recv_threads=0, incremental=False,
+                  fan_in=None, sender=None, completion_timeout=None, graph_threads=0, depth=10, max_bytes=None,
+                  checkpoint_dir=None, checkpoint_interval=60, restore=False):
     logger.info('Starting collector on node # %d PID: %d', node_num, os.getpid())
     with GraphCollector(
             node_num,
@@ -187,14 +768,28 @@ def run_collector(node_num, base_name, num_contribs, color,
             graph_addr,
             msg_addr,
             prometheus_dir,
-            prometheus_port, hutch) as collector:
+            prometheus_port,
+            hutch,
+            recv_threads,
+            incremental,
+            fan_in,
+            sender,
+            completion_timeout,
+            graph_threads,
+            depth,
+            max_bytes,
+            checkpoint_dir,
+            checkpoint_interval,
+            restore) as collector:
         collector.start_prometheus()
         return collector.run()
 
 
 def run_node_collector(node_num, num_contribs,
                        collector_addr, upstream_addr, graph_addr, msg_addr,
-                       prometheus_dir, prometheus_port, hutch):
+                       prometheus_dir, prometheus_port, hutch, recv_threads=0, incremental=False,
+                       completion_timeout=None, graph_threads=0, depth=10, max_bytes=None,
+                       checkpoint_dir=None, checkpoint_interval=60, restore=False):
     return run_collector(node_num,
                          "localCollector%03d",
                          num_contribs,
@@ -205,12 +800,52 @@ def run_node_collector(node_num, num_contribs,
                          msg_addr,
                          prometheus_dir,
                          prometheus_port,
-                         hutch)
+                         hutch,
+                         recv_threads,
+                         incremental,
+                         completion_timeout=completion_timeout,
+                         graph_threads=graph_threads,
+                         depth=depth,
+                         max_bytes=max_bytes,
+                         checkpoint_dir=checkpoint_dir,
+                         checkpoint_interval=checkpoint_interval,
+                         restore=restore)
+
+
+def run_mid_collector(tier, node_num, num_contribs,
+                      collector_addr, upstream_addr, graph_addr, msg_addr,
+                      prometheus_dir, prometheus_port, hutch, recv_threads=0, incremental=False, fan_in=None,
+                      completion_timeout=None, graph_threads=0, depth=10, max_bytes=None,
+                      checkpoint_dir=None, checkpoint_interval=60, restore=False):
+    return run_collector(node_num,
+                         tier_name(tier),
+                         num_contribs,
+                         Colors.MidCollector % tier,
+                         collector_addr,
+                         upstream_addr,
+                         graph_addr,
+                         msg_addr,
+                         prometheus_dir,
+                         prometheus_port,
+                         hutch,
+                         recv_threads,
+                         incremental,
+                         fan_in,
+                         tier_name(tier - 1) if tier > 0 else "localCollector%03d",
+                         completion_timeout,
+                         graph_threads,
+                         depth,
+                         max_bytes,
+                         checkpoint_dir,
+                         checkpoint_interval,
+                         restore)
 
 
 def run_global_collector(node_num, num_contribs,
                          collector_addr, upstream_addr, graph_addr, msg_addr,
-                         prometheus_dir, prometheus_port, hutch):
+                         prometheus_dir, prometheus_port, hutch, recv_threads=0, incremental=False,
+                         upstream_tier=None, completion_timeout=None, graph_threads=0, depth=10,
+                         max_bytes=None, checkpoint_dir=None, checkpoint_interval=60, restore=False):
     return run_collector(node_num,
                          "globalCollector%03d",
                          num_contribs,
@@ -221,7 +856,17 @@ def run_global_collector(node_num, num_contribs,
                          msg_addr,
                          prometheus_dir,
                          prometheus_port,
-                         hutch)
+                         hutch,
+                         recv_threads,
+                         incremental,
+                         sender=None if upstream_tier is None else tier_name(upstream_tier),
+                         completion_timeout=completion_timeout,
+                         graph_threads=graph_threads,
+                         depth=depth,
+                         max_bytes=max_bytes,
+                         checkpoint_dir=checkpoint_dir,
+                         checkpoint_interval=checkpoint_interval,
+                         restore=restore)
 
 
 def main(color, upstream_port, downstream_port):
@@ -288,6 +933,96 @@ def main(color, upstream_port, downstream_port):
         default=None
     )
 
+    parser.add_argument(
+        '--recv-threads',
+        type=int,
+        default=0,
+        help='number of threads used to receive and deserialize contributions (default: 0)'
+    )
+
+    parser.add_argument(
+        '--graph-threads',
+        type=int,
+        default=0,
+        help='number of threads used to complete heartbeats, with each graph assigned to one of them so '
+             'independent graphs complete in parallel (default: 0)'
+    )
+
+    parser.add_argument(
+        '--depth',
+        type=int,
+        default=10,
+        help='default number of heartbeats held per graph while waiting for contributions (default: 10)'
+    )
+
+    parser.add_argument(
+        '--max-bytes',
+        type=int,
+        default=None,
+        help='default number of bytes of contributions buffered per graph before the oldest heartbeats are '
+             'completed early (default: no limit)'
+    )
+
+    parser.add_argument(
+        '--checkpoint-dir',
+        default=None,
+        help='directory to periodically save the state of the graphs to (default: no checkpoints)'
+    )
+
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=int,
+        default=60,
+        help='time in seconds between checkpoints of the state of the graphs (default: 60)'
+    )
+
+    parser.add_argument(
+        '--restore',
+        action='store_true',
+        help='restore the state of the graphs from the checkpoints of a previous run of this collector'
+    )
+
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='run each contribution through the graph as it arrives instead of at completion'
+    )
+
+    parser.add_argument(
+        '--completion-timeout',
+        type=int,
+        default=None,
+        help='time in ms after the first contribution to a heartbeat arrives before it is completed with '
+             'the contributions received so far (default: wait for all contributors)'
+    )
+
+    parser.add_argument(
+        '--num-nodes',
+        type=int,
+        default=1,
+        help='number of nodes (a.k.a local collector processes) (default: 1)'
+    )
+
+    parser.add_argument(
+        '--fan-in',
+        type=int,
+        default=None,
+        help='maximum number of contributors per collector in the reduction tree (default: no intermediate tiers)'
+    )
+
+    parser.add_argument(
+        '--tier',
+        type=int,
+        default=None,
+        help='run as a collector in this intermediate tier of the reduction tree instead of the global collector'
+    )
+
+    parser.add_argument(
+        '--downstream-host',
+        default=None,
+        help='hostname of the next collector in the reduction tree (default: the AMII Manager host)'
+    )
+
     subparsers = parser.add_subparsers(help='spawn workers', dest='worker')
     worker_subparser = subparsers.add_parser('worker', help='worker arguments')
 
@@ -316,8 +1051,33 @@ def main(color, upstream_port, downstream_port):
 
     args = parser.parse_args()
 
+    tiers = collector_tiers(args.num_nodes, args.fan_in)
+    num_contribs = args.num_contribs
+    downstream_host = args.downstream_host or args.host
+    if color == Colors.LocalCollector:
+        if tiers:
+            downstream_port = Ports.MidCollector
+    elif args.tier is not None:
+        if not 0 <= args.tier < len(tiers):
+            parser.error("tier %d is invalid: %d nodes with a fan-in of %s has %d intermediate tiers" %
+                         (args.tier, args.num_nodes, args.fan_in, len(tiers)))
+        upstream_port = Ports.MidCollector + args.tier
+        if args.tier + 1 < len(tiers):
+            downstream_port = Ports.MidCollector + args.tier + 1
+        # the number of contributors is determined by the layout of the tree
+        num_upstream = tiers[args.tier - 1] if args.tier > 0 else args.num_nodes
+        num_contribs = min(args.fan_in, num_upstream - args.node_num * args.fan_in)
+        if num_contribs < 1:
+            parser.error("node %d is invalid for tier %d which has %d collectors" %
+                         (args.node_num, args.tier, tiers[args.tier]))
+    else:
+        # the global collector always sends to the manager
+        downstream_host = args.host
+        if tiers:
+            num_contribs = tiers[-1]
+
     collector_addr = "tcp://*:%d" % (args.port + upstream_port)
-    downstream_addr = "tcp://%s:%d" % (args.host, args.port + downstream_port)
+    downstream_addr = "tcp://%s:%d" % (downstream_host, args.port + downstream_port)
     graph_addr = "tcp://%s:%d" % (args.host, args.port + Ports.Graph)
     msg_addr = "tcp://%s:%d" % (args.host, args.port + Ports.Message)
 
@@ -361,17 +1121,57 @@ def main(color, upstream_port, downstream_port):
                                       msg_addr,
                                       args.prometheus_dir,
                                       args.prometheus_port,
-                                      args.hutch)
+                                      args.hutch,
+                                      args.recv_threads,
+                                      args.incremental,
+                                      args.completion_timeout,
+                                      args.graph_threads,
+                                      args.depth,
+                                      args.max_bytes,
+                                      args.checkpoint_dir,
+                                      args.checkpoint_interval,
+                                      args.restore)
+        elif color == Colors.GlobalCollector and args.tier is not None:
+            return run_mid_collector(args.tier,
+                                     args.node_num,
+                                     num_contribs,
+                                     collector_addr,
+                                     downstream_addr,
+                                     graph_addr,
+                                     msg_addr,
+                                     args.prometheus_dir,
+                                     args.prometheus_port,
+                                     args.hutch,
+                                     args.recv_threads,
+                                     args.incremental,
+                                     args.fan_in,
+                                     args.completion_timeout,
+                                     args.graph_threads,
+                                     args.depth,
+                                     args.max_bytes,
+                                     args.checkpoint_dir,
+                                     args.checkpoint_interval,
+                                     args.restore)
         elif color == Colors.GlobalCollector:
             return run_global_collector(args.node_num,
-                                        args.num_contribs,
+                                        num_contribs,
                                         collector_addr,
                                         downstream_addr,
                                         graph_addr,
                                         msg_addr,
                                         args.prometheus_dir,
                                         args.prometheus_port,
-                                        args.hutch)
+                                        args.hutch,
+                                        args.recv_threads,
+                                        args.incremental,
+                                        len(tiers) - 1 if tiers else None,
+                                        args.completion_timeout,
+                                        args.graph_threads,
+                                        args.depth,
+                                        args.max_bytes,
+                                        args.checkpoint_dir,
+                                        args.checkpoint_interval,
+                                        args.restore)
         else:
             logger.critical("Invalid option collector color '%s' chosen!", color)
             return 1
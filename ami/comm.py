@@ -1,4 +1,5 @@
 import abc
+import bisect
 import socket
 import os
 import sys
@@ -6,9 +7,13 @@ import time
 import zmq
 import dill
 import json
+import pickle
 import asyncio
 import logging
+import queue
 import functools
+import threading
+import collections
 import numpy as np
 import zmq.asyncio
 import prometheus_client as pc
@@ -22,11 +27,70 @@ from enum import IntEnum
 
 logger = logging.getLogger(__name__)
 ZMQ_TOPIC_DELIM = '\0'
+ZMQ_BATCH_MARKER = b'\0ami-batch\0'
+
+
+def batch_frames(msgs):
+    """
+    Packs several serialized messages into the frames of a single multipart
+    envelope. The envelope starts with a marker frame followed by a frame
+    with the number of frames belonging to each of the messages.
+
+    Args:
+        msgs (list): list of serialized messages (each a list of frames).
+
+    Returns:
+        The list of frames making up the envelope.
+    """
+    frames = [ZMQ_BATCH_MARKER, pickle.dumps([len(msg) for msg in msgs])]
+    for msg in msgs:
+        frames.extend(msg)
+    return frames
+
+
+def unbatch_frames(frames):
+    """
+    Generator which splits a received multipart message into the frames of
+    the individual serialized messages it contains. Messages which were not
+    sent as a batch envelope are yielded unchanged.
+
+    Args:
+        frames (list): the frames of the received multipart message.
+
+    Returns:
+        The frames of each message in the order they were batched.
+    """
+    if frames and len(frames[0]) == len(ZMQ_BATCH_MARKER) and bytes(frames[0]) == ZMQ_BATCH_MARKER:
+        start = 2
+        for nframes in pickle.loads(frames[1]):
+            yield frames[start:start+nframes]
+            start += nframes
+    else:
+        yield frames
+
+
+def payload_size(data):
+    """
+    Estimates the number of bytes held by the values of a contribution. Arrays
+    report the size of their buffers, anything else its shallow size.
+
+    Args:
+        data (dict): the contribution.
+
+    Returns:
+        The estimated size in bytes.
+    """
+    size = 0
+    for value in data.values():
+        nbytes = getattr(value, 'nbytes', None)
+        size += nbytes if isinstance(nbytes, int) else sys.getsizeof(value)
+    return size
 
 
 class Colors:
     Worker = "worker"
     LocalCollector = "localCollector"
+    MidCollector = "midCollector%d"
     GlobalCollector = "globalCollector"
 
 
@@ -43,10 +107,62 @@ class Ports(IntEnum):
     Message = 6
     Info = 7
     View = 8
+    MidCollector = 9
     Sync = 5600
     Prometheus = 9200
 
 
+def collector_tiers(num_local_collectors, fan_in=None):
+    """
+    Computes the intermediate tiers of a k-ary reduction tree between the local
+    collectors and the global collector. Tiers are added until the global
+    collector has at most `fan_in` contributors.
+
+    Args:
+        num_local_collectors (int): the number of local collectors
+        fan_in (int): the maximum number of contributors for each collector in
+            the tree. No intermediate tiers are used if this is None or less than 2.
+
+    Returns:
+        A list of the number of collectors in each intermediate tier.
+    """
+    tiers = []
+    if fan_in is not None and fan_in > 1:
+        num_collectors = num_local_collectors
+        while num_collectors > fan_in:
+            num_collectors = (num_collectors + fan_in - 1) // fan_in
+            tiers.append(num_collectors)
+    return tiers
+
+
+def rank_stragglers(stats):
+    """
+    Orders the arrival statistics of contributors from the worst straggler to
+    the best. Contributors whose contributions were late or missing at
+    completion come first, then the rest by their mean arrival offset.
+
+    Args:
+        stats (list): dictionaries of the arrival statistics of each contributor
+            with 'late', 'missing' and 'mean_offset' keys.
+
+    Returns:
+        A new sorted list of the statistics.
+    """
+    return sorted(stats, key=lambda entry: (entry['late'] + entry['missing'], entry['mean_offset']), reverse=True)
+
+
+class HighWaterMarks:
+    """
+    The zmq high-water marks (in messages) used for each socket role, plus the
+    depth of the local spill queue used by senders when the high-water mark of
+    their socket is reached.
+    """
+    Contribution = 1000
+    Collection = 1000
+    View = 100
+    Spill = 100
+
+
 class AutoName:
     """Class for generation auto names for graph nodes
 
@@ -338,28 +454,154 @@ class Store:
 
 
 class ZmqHandler:
-    def __init__(self, addr, ctx=None):
+    """
+    Sends serialized messages to a collector over a zmq PUSH socket.
+
+    When batching is enabled, messages sent with `defer=True` are held until
+    `flush_batch` is called (or a non-deferred message is sent) and then go
+    out together as a single multipart envelope, which the receiving
+    `Collector` splits apart again.
+
+    Sends never block. If the high-water mark of the socket is reached the
+    message is put in a bounded spill queue that is drained before anything
+    else is sent, and whenever `drain_spill` is called. When the spill queue
+    is full the oldest message in it is dropped. Transitions are never
+    dropped, since the state machine downstream cannot recover from missing
+    one, they keep their place in the spill queue so they do not overtake
+    the messages ahead of them. The number of deferred and dropped messages
+    are counted.
+
+    Args:
+        addr (str): the zmq address of the collector.
+        ctx (zmq.Context): optional zmq context to use. If none is passed it
+            creates one.
+        batching (bool): enables coalescing of deferred messages. Defaults to
+            False.
+        hwm (int): the send high-water mark of the socket.
+        spill_depth (int): the maximum number of messages held in the spill
+            queue.
+    """
+
+    def __init__(self, addr, ctx=None, batching=False, hwm=HighWaterMarks.Contribution,
+                 spill_depth=HighWaterMarks.Spill):
         if ctx is None:
             self.ctx = zmq.Context()
         else:
             self.ctx = ctx
         self.collector = self.ctx.socket(zmq.PUSH)
+        self.collector.setsockopt(zmq.SNDHWM, hwm)
         self.collector.connect(addr)
         self.serializer = Serializer()
+        self.batching = batching
+        self.batch = []
+        # whether the messages waiting in the batch include a transition
+        self.batch_transition = False
+        self.spill = collections.deque()
+        self.spill_depth = spill_depth
+        self.deferred = 0
+        self.dropped = 0
+
+    def send(self, msg, defer=False):
+        transition = getattr(msg, 'mtype', None) == MsgTypes.Transition
+        frames = self.serializer(msg)
+        self.batch.append(frames)
+        self.batch_transition |= transition
+        if transition or not (defer and self.batching):
+            self.flush_batch()
+        return self.serializer.sizeof(frames)
+
+    def flush_batch(self):
+        """
+        Sends any messages that are waiting in the batch.
+        """
+        if len(self.batch) == 1:
+            self.send_frames(self.batch[0], self.batch_transition)
+        elif self.batch:
+            self.send_frames(batch_frames(self.batch), self.batch_transition)
+        else:
+            self.drain_spill()
+        self.batch = []
+        self.batch_transition = False
+
+    def send_frames(self, frames, transition=False):
+        """
+        Sends already serialized frames without blocking. If they cannot be
+        sent right away they are put in the spill queue.
+
+        Args:
+            frames (list): the frames of the multipart message.
+            transition (bool): the frames include a transition, so they are
+                never dropped.
+        """
+        # anything already in the spill queue has to go out first to keep order
+        if self.drain_spill():
+            try:
+                self.collector.send_multipart(frames, flags=zmq.NOBLOCK, copy=False)
+                return
+            except zmq.Again:
+                pass
+
+        if not transition:
+            if self.spill_depth < 1:
+                self.dropped += 1
+                return
+            if len(self.spill) >= self.spill_depth and not self.drop_oldest():
+                # the spill queue only holds transitions, which have to go first
+                self.dropped += 1
+                return
+        self.spill.append((frames, transition))
+        self.deferred += 1
+
+    def drop_oldest(self):
+        """
+        Drops the oldest message in the spill queue which is not a transition.
+
+        Returns:
+            True if a message was dropped, False otherwise.
+        """
+        for idx, (frames, transition) in enumerate(self.spill):
+            if not transition:
+                del self.spill[idx]
+                self.dropped += 1
+                return True
+        return False
+
+    def drain_spill(self):
+        """
+        Sends as many messages from the spill queue as the socket will accept.
 
-    def send(self, msg):
-        msg = self.serializer(msg)
-        self.collector.send_multipart(msg, flags=zmq.NOBLOCK, copy=False)
-        return self.serializer.sizeof(msg)
+        Returns:
+            True if the spill queue is now empty, False otherwise.
+        """
+        while self.spill:
+            try:
+                self.collector.send_multipart(self.spill[0][0], flags=zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return False
+            self.spill.popleft()
+        return True
 
-    def message(self, mtype, identity, payload):
+    def reset_counts(self):
+        """
+        Returns the number of messages deferred to the spill queue and the
+        number of messages dropped since the last call, and resets them.
+
+        Returns:
+            A tuple of the deferred and dropped message counts.
+        """
+        counts = self.deferred, self.dropped
+        self.deferred = 0
+        self.dropped = 0
+        return counts
+
+    def message(self, mtype, identity, payload, defer=False):
         msg = Message(mtype=mtype, identity=identity, payload=payload)
-        return self.send(msg)
+        return self.send(msg, defer)
 
-    def collector_message(self, identity, heartbeat, name, version, payload):
+    def collector_message(self, identity, heartbeat, name, version, payload, defer=False, contributors=1):
         msg = CollectorMessage(mtype=MsgTypes.Datagram, identity=identity, heartbeat=heartbeat,
-                               name=name, version=version, payload=payload)
-        return self.send(msg)
+                               name=name, version=version, payload=payload, contributors=contributors)
+        return self.send(msg, defer)
 
 
 class ResultStore(ZmqHandler):
@@ -370,8 +612,9 @@ class ResultStore(ZmqHandler):
     a Collector object.
     """
 
-    def __init__(self, addr, ctx=None):
-        super().__init__(addr, ctx)
+    def __init__(self, addr, ctx=None, batching=False, hwm=HighWaterMarks.Contribution,
+                 spill_depth=HighWaterMarks.Spill):
+        super().__init__(addr, ctx, batching, hwm, spill_depth)
         self.stores = {}
 
     def __bool__(self):
@@ -398,7 +641,9 @@ class ResultStore(ZmqHandler):
     def collect(self, identity, heartbeat):
         size = 0
         for name, store in self.stores.items():
-            size += self.collector_message(identity, heartbeat, name, store.version, store.namespace)
+            size += self.collector_message(identity, heartbeat, name, store.version, store.namespace, defer=True)
+        # the end of the heartbeat, so send everything collected in one go
+        self.flush_batch()
         return size
 
     def version(self, name):
@@ -417,6 +662,9 @@ class ContributionBuilder(abc.ABC):
         self.num_contribs = num_contribs
         self.pending = {}
         self.contribs = {}
+        # the bitmask of the active contributors that are needed for completion
+        self.members = (1 << num_contribs) - 1
+        self.members_version = 0
 
     @abc.abstractmethod
     def _complete(self, eb_key, identity, drop):
@@ -452,20 +700,78 @@ class ContributionBuilder(abc.ABC):
             raise ValueError("eb_id of %d is invalid for %d contributors" % (eb_id, self.num_contribs))
 
     def ready(self, eb_key):
-        if eb_key not in self.contribs:
+        if eb_key not in self.contribs or not self.members:
             return False
-        return ((1 << self.num_contribs) - 1) == self.contribs[eb_key]
+        return self.members == (self.contribs[eb_key] & self.members)
+
+    def set_members(self, eb_ids, version):
+        """
+        Sets which contributors are active. Only the active contributors are
+        needed for a key to be ready, but any valid contributor can still
+        contribute data.
+
+        Args:
+            eb_ids (iterable): the ids of the active contributors
+            version (int): the version of the membership, older versions
+                than the current one are ignored.
+
+        Returns:
+            True if the membership was updated, False otherwise.
+        """
+        if version <= self.members_version:
+            return False
+        members = 0
+        for eb_id in eb_ids:
+            if 0 <= eb_id < self.num_contribs:
+                members |= (1 << eb_id)
+            else:
+                raise ValueError("eb_id of %d is invalid for %d contributors" % (eb_id, self.num_contribs))
+        self.members = members
+        self.members_version = version
+        return True
+
+    def ready_keys(self):
+        """
+        Returns:
+            A sorted list of the pending keys that are ready for completion.
+        """
+        return sorted(eb_key for eb_key in self.contribs if self.ready(eb_key))
 
 
 class GraphBuilder(ContributionBuilder):
-    def __init__(self, num_contribs, depth, color, completion):
+    def __init__(self, num_contribs, depth, color, completion, incremental=False, timeout=None,
+                 max_bytes=None):
         super().__init__(num_contribs)
         self.depth = depth
+        self.max_bytes = max_bytes
+        # the estimated size of the contributions buffered for each pending key
+        self.sizes = {}
         self.color = color
+        self.incremental = incremental
+        self.timeout = timeout
         self.latest = Heartbeat(0, 0)
+        self.order = []
+        # the time the first contribution for each pending key arrived
+        self.arrival = {}
+        # how long after the first contribution of its key each contribution arrived keyed by eb_id
+        self.offsets = collections.defaultdict(list)
+        # the time from the first contribution to completion of each completed key
+        self.completions = []
+        # the number of workers whose data is included in each pending key
+        self.counts = {}
+        # in incremental mode the heartbeat whose contributions have been folded into the graph
+        self.active = None
+        self.last_completed = None
+        self.fold_times = {}
+        self.late = collections.Counter()
+        self.missing = collections.Counter()
         self.graph = None
         self.pending_graphs = {}
         self.version = None
+        # the checkpointed version and node state to restore once that version of the graph is applied
+        self.restore = None
+        # the outputs of the graph which are no longer viewed
+        self.unviewed = set()
         self.completion = completion
 
     def _init(self, name):
@@ -478,12 +784,101 @@ class GraphBuilder(ContributionBuilder):
         elif cmd == "add":
             self.graph.add(obj)
         elif cmd == "del":
-            for node in obj:
-                self.graph.remove(node)
+            self.graph.remove(list(obj))
 
     def _compile(self, args):
         if self.graph:
             self.graph.compile(**args)
+            self.graph.set_unviewed(self.unviewed)
+
+    def set_unviewed(self, names):
+        self.unviewed = set(names)
+        if self.graph:
+            self.graph.set_unviewed(self.unviewed)
+
+    def complete(self, eb_key, identity, drop=False):
+        if self.incremental and eb_key in self.pending:
+            # heartbeats share the state of the graph so they must be completed oldest first
+            while self.order and self.order[0] < eb_key:
+                logger.debug("Completing uncompleted key %d ahead of key %d", self.order[0], eb_key)
+                self._complete_key(self.order[0], identity, drop)
+        times, size = self._complete_key(eb_key, identity, drop)
+        if self.incremental and self.order and self.foldable(self.order[0]):
+            self._fold(self.order[0])
+        return times, size
+
+    def _complete_key(self, eb_key, identity, drop):
+        idx = bisect.bisect_left(self.order, eb_key)
+        if idx < len(self.order) and self.order[idx] == eb_key:
+            del self.order[idx]
+        if eb_key in self.pending:
+            if self.last_completed is None or eb_key > self.last_completed:
+                self.last_completed = eb_key
+            if not drop and not self.ready(eb_key):
+                for eb_id in range(self.num_contribs):
+                    if (self.members & ~self.contribs[eb_key]) & (1 << eb_id):
+                        self.missing[eb_id] += 1
+            arrival = self.arrival.pop(eb_key, None)
+            if not drop and arrival is not None:
+                self.completions.append(time.time() - arrival)
+            self.sizes.pop(eb_key, None)
+        return super().complete(eb_key, identity, drop)
+
+    def update(self, eb_key, eb_id, *args, **kwargs):
+        if (self.incremental or self.timeout is not None) and self.is_late(eb_key):
+            # the heartbeat has already been completed without this contribution
+            logger.debug("Dropped late contribution for key %s from id %s", eb_key, eb_id)
+            self.late[eb_id] += 1
+        else:
+            super().update(eb_key, eb_id, *args, **kwargs)
+
+    def expired(self, now=None):
+        """
+        Finds the pending keys whose first contribution arrived longer ago
+        than the completion timeout.
+
+        Args:
+            now (float): the current time. Defaults to `time.time()`.
+
+        Returns:
+            A list of the expired keys ordered oldest first.
+        """
+        if self.timeout is None:
+            return []
+        if now is None:
+            now = time.time()
+        return [eb_key for eb_key in self.order if now - self.arrival[eb_key] >= self.timeout]
+
+    @property
+    def pending_bytes(self):
+        """
+        The estimated number of bytes buffered for all the pending keys.
+        """
+        return sum(self.sizes.values())
+
+    def over_budget(self):
+        # the newest key is never pruned to stay under the byte budget
+        return self.max_bytes is not None and len(self.order) > 1 and self.pending_bytes > self.max_bytes
+
+    def foldable(self, eb_key):
+        """
+        Checks if the contributions for a heartbeat can be folded into the graph as they arrive. Heartbeats share
+        the state of the graph, so only the heartbeat directly after the last completed one is folded. Any other
+        heartbeat is buffered, since an older one may still arrive after it.
+
+        Args:
+            eb_key: the heartbeat to check
+
+        Returns:
+            True if the heartbeat can be folded, False otherwise.
+        """
+        return (self.active is None and self.last_completed is not None and
+                eb_key == self.last_completed + 1 and eb_key == self.order[0])
+
+    def is_late(self, eb_key):
+        if self.active is not None and eb_key < self.active:
+            return True
+        return self.last_completed is not None and eb_key <= self.last_completed
 
     def prune(self, identity, prune_key=None, drop=False):
         times = {}
@@ -491,24 +886,39 @@ class GraphBuilder(ContributionBuilder):
         if prune_key is None:
             depth = self.depth
         elif prune_key < self.latest:
-            depth = self.latest.identity - prune_key.identity
+            depth = self.latest - prune_key
         elif prune_key > self.latest:
             depth = 0
         else:
             depth = 1
 
-        if len(self.pending) > depth:
-            for eb_key in reversed(sorted(self.pending.keys(), reverse=True)[depth:]):
-                logger.debug("Pruned uncompleted key %d", eb_key)
-                times, size = self.complete(eb_key, identity, drop)
+        # self.order holds the pending keys sorted oldest first
+        while len(self.order) > depth or self.over_budget():
+            eb_key = self.order[0]
+            logger.debug("Pruned uncompleted key %d", eb_key)
+            times, size = self.complete(eb_key, identity, drop)
 
         return times, size
 
+    def settled(self, eb_key):
+        """
+        Finds the pending keys up to and including eb_key, which every
+        contributor has already sent all of its contributions for.
+
+        Args:
+            eb_key (int): the last key sent by all the contributors.
+
+        Returns:
+            A list of the settled keys ordered oldest first.
+        """
+        return [key for key in self.order if key <= eb_key]
+
     def flush(self, identity, drop=False):
         size = self.prune(identity, self.latest.identity + 1, drop)
         if drop and self.graph:
             self.graph.reset()
         self.latest = Heartbeat(0, 0)
+        self.last_completed = None
         return size
 
     def begin_run(self):
@@ -547,6 +957,7 @@ class GraphBuilder(ContributionBuilder):
                     del self.pending_graphs[version]
                 self._compile(args)
                 self.version = ver_key
+                self._restore()
                 return True
             else:
                 return False
@@ -555,75 +966,253 @@ class GraphBuilder(ContributionBuilder):
         else:
             return False
 
+    def checkpoint(self):
+        """
+        Returns:
+            A tuple of the graph version and the state of its nodes for this
+            color, or None if there is no graph yet.
+        """
+        if self.graph and self.version is not None:
+            return self.version, self.graph.get_state(self.color)
+
+    def restore_state(self, version, states):
+        """
+        Restores checkpointed node state when the matching version of the graph
+        is applied.
+
+        Args:
+            version (int): the graph version of the checkpoint.
+            states (dict): the node state returned by `Graph.get_state`.
+        """
+        self.restore = (version, states)
+        if self.version is not None:
+            self._restore()
+
+    def _restore(self):
+        if self.restore is None:
+            return
+        version, states = self.restore
+        if version == self.version and self.graph:
+            logger.info("Restoring checkpointed state of graph (%s v%d)", self.graph.name, version)
+            self.graph.set_state(states)
+            self.restore = None
+        elif self.version is not None and self.version > version:
+            logger.warning("Discarding checkpoint of graph v%d, which has been replaced by v%d", version, self.version)
+            self.restore = None
+
+    def _fold(self, eb_key):
+        """
+        Starts folding the contributions for a heartbeat into the graph as they arrive. Any contributions that
+        were buffered while an earlier heartbeat was being folded are run through the graph immediately.
+
+        Args:
+            eb_key: the heartbeat to fold
+
+        Returns:
+            True if the heartbeat is now being folded, False if its graph version is not available yet.
+        """
+        if not self.apply_graph(self.pending[eb_key].version):
+            return False
+
+        self.active = eb_key
+        contribs = self.pending[eb_key].namespace
+        self.pending[eb_key].clear()
+        self.sizes[eb_key] = 0
+        for data in contribs.values():
+            self._execute(eb_key, data)
+        return True
+
+    def _execute(self, eb_key, data):
+        times = self.fold_times.setdefault(eb_key, [])
+        if self.graph:
+            start = time.time()
+            graph_result = self.graph(data, color=self.color)
+            stop = time.time()
+            self.pending[eb_key].update(graph_result)
+            exec_time = self.graph.times()
+            if exec_time:
+                times.append((start, stop, exec_time))
+        return times
+
     def _complete(self, eb_key, identity, drop):
         times = []
-        if self.apply_graph(self.pending[eb_key].version):
-            contribs = self.pending[eb_key].namespace
+        if eb_key == self.active:
+            # the contributions have already been folded into the results
+            times = self.fold_times.pop(eb_key, [])
+            self.active = None
+        elif self.apply_graph(self.pending[eb_key].version):
+            contribs = list(self.pending[eb_key].namespace.values())
             self.pending[eb_key].clear()
             if self.graph:
-                for data in contribs.values():
-                    start = time.time()
-                    graph_result = self.graph(data, color=self.color)
-                    stop = time.time()
-                    self.pending[eb_key].update(graph_result)
-                    exec_time = self.graph.times()
-                    if exec_time:
-                        times.append((start, stop, exec_time))
+                # typed reductions combine all the contributions so the graph only runs once
+                contribs = self.graph.merge(contribs, self.color)
+            for data in contribs:
+                times = self._execute(eb_key, data)
+            self.fold_times.pop(eb_key, None)
         else:
             self.pending[eb_key].clear()
 
-        size = self.completion(eb_key, identity, self.pending[eb_key], drop)
+        size = self.completion(eb_key, identity, self.pending[eb_key], drop, self.counts.pop(eb_key, 0))
 
         if self.graph:
             self.graph.heartbeat_finished()
 
         return times, size
 
-    def _update(self, eb_key, eb_id, ver_key, data):
+    def _update(self, eb_key, eb_id, ver_key, data, contributors=1):
+        now = time.time()
         if eb_key not in self.pending:
             self.pending[eb_key] = Store(version=ver_key)
             self.contribs[eb_key] = 0
+            self.counts[eb_key] = 0
+            self.sizes[eb_key] = 0
+            self.arrival[eb_key] = now
+            # heartbeats almost always arrive in order so this is an append
+            bisect.insort(self.order, eb_key)
+        self.offsets[eb_id].append(now - self.arrival[eb_key])
         if eb_key > self.latest:
             self.latest = eb_key
         if ver_key != self.pending[eb_key].version:
             logger.error("Graph version mismatch: heartbeat %s from id %s has version %s when %s was expected",
                          eb_key, eb_id, ver_key, self.pending[eb_key].version)
+            return
+        folding = self.incremental and (eb_key == self.active or (self.foldable(eb_key) and self._fold(eb_key)))
+        if folding:
+            self._execute(eb_key, data)
         else:
             self.pending[eb_key].put(eb_id, data)
+            self.sizes[eb_key] += payload_size(data)
+        self.counts[eb_key] += contributors
 
 
 class TransitionBuilder(ContributionBuilder, ZmqHandler):
+    """
+    Builds the transitions sent by all the contributors. Transitions are keyed
+    by their sequence number since the last Configure, so transitions of the
+    same type from different steps are never mixed up, and contributions for
+    transitions that have already been completed are dropped as duplicates.
+
+    Collectors send their transitions and datagrams on different sockets, so
+    the datagrams sent before a transition can arrive after it. Each
+    contribution carries the number of datagrams its sender had sent (see
+    `undelivered`) so the transition can wait for them.
+    """
     def __init__(self, num_contribs, addr, ctx=None):
         ContributionBuilder.__init__(self, num_contribs)
         ZmqHandler.__init__(self, addr, ctx)
+        # the sequence number of the last completed transition
+        self.last_seq = None
+        self.duplicates = 0
+        # the datagrams sent before each pending transition keyed by eb_id
+        self.sent = {}
+
+    def ready_keys(self):
+        # transitions are completed in the order they arrived, since Configure restarts the sequence
+        return [eb_key for eb_key in self.pending if self.ready(eb_key)]
+
+    def undelivered(self, eb_key, received):
+        """
+        Finds the datagrams the contributors sent before a transition which
+        have not been received yet.
+
+        Args:
+            eb_key (int): the sequence number of the transition.
+            received (Counter): the number of datagrams received keyed by
+                (eb_id, graph name).
+
+        Returns:
+            A dictionary of the number of datagrams sent keyed by (eb_id,
+            graph name) for those not all received yet.
+        """
+        missing = {}
+        for eb_id, sent in self.sent.get(eb_key, {}).items():
+            for name, count in sent.items():
+                if received[(eb_id, name)] < count:
+                    missing[(eb_id, name)] = count
+        return missing
+
+    def boundary(self, eb_key):
+        """
+        The last heartbeat that every contributor sent before the transition.
+
+        Args:
+            eb_key (int): the sequence number of the transition
+
+        Returns:
+            The heartbeat id or None if any of the contributors did not report one.
+        """
+        return self.pending[eb_key].heartbeat
+
+    def update(self, eb_key, eb_id, *args, **kwargs):
+        # Configure restarts the sequence, so it is never a duplicate
+        if eb_key > 0 and self.last_seq is not None and eb_key <= self.last_seq:
+            logger.debug("Dropped duplicate transition %d from id %s", eb_key, eb_id)
+            self.duplicates += 1
+        else:
+            super().update(eb_key, eb_id, *args, **kwargs)
+
+    def reset_duplicates(self):
+        duplicates = self.duplicates
+        self.duplicates = 0
+        return duplicates
 
     def _complete(self, eb_key, identity, drop):
+        self.last_seq = eb_key
+        self.sent.pop(eb_key, None)
         if not drop:
-            self.message(MsgTypes.Transition, identity, Transition(eb_key, self.pending[eb_key]))
+            self.message(MsgTypes.Transition, identity, self.pending[eb_key])
         return [], 0
 
-    def _update(self, eb_key, eb_id, payload):
-        if eb_key not in self.pending:
-            self.pending[eb_key] = payload
-        elif payload != self.pending[eb_key]:
-            logger.error("Transition mismatch: %s payload from id %s does not match the other contributers",
-                         eb_key, eb_id)
+    def _update(self, eb_key, eb_id, transition):
+        if transition.sent is not None:
+            self.sent.setdefault(eb_key, {})[eb_id] = transition.sent
+        pending = self.pending.get(eb_key)
+        if pending is None:
+            self.pending[eb_key] = Transition(transition.ttype, transition.payload, eb_key, transition.heartbeat)
+        elif transition.ttype != pending.ttype or transition.payload != pending.payload:
+            logger.error("Transition mismatch: %s (seq %d) from id %s does not match the other contributers",
+                         transition.ttype, eb_key, eb_id)
+        elif pending.heartbeat is not None:
+            if transition.heartbeat is None:
+                pending.heartbeat = None
+            else:
+                pending.heartbeat = min(pending.heartbeat, transition.heartbeat)
 
 
 class EventBuilder(ZmqHandler):
 
-    def __init__(self, num_contribs, depth, color, addr, ctx=None):
-        super().__init__(addr, ctx)
+    def __init__(self, num_contribs, depth, color, addr, ctx=None, batching=False, incremental=False,
+                 timeout=None, max_bytes=None):
+        super().__init__(addr, ctx, batching)
         self.num_contribs = num_contribs
         self.depth = depth
+        self.max_bytes = max_bytes
+        # the depth and byte budget of graphs that don't use the defaults
+        self.limits = {}
+        # the outputs of each graph which are no longer viewed
+        self.unviewed = {}
         self.color = color
+        self.incremental = incremental
+        self.timeout = timeout
+        self.members = None
+        self.members_version = 0
         self.builders = {}
+        # the number of datagrams sent for each graph, which the transitions carry to the next tier
+        self.sent = collections.Counter()
 
     def create(self, name):
+        depth, max_bytes = self.limits.get(name, (self.depth, self.max_bytes))
         self.builders[name] = GraphBuilder(self.num_contribs,
-                                           self.depth,
+                                           depth,
                                            self.color,
-                                           functools.partial(self.completion, name))
+                                           functools.partial(self.completion, name),
+                                           self.incremental,
+                                           self.timeout,
+                                           max_bytes)
+        if self.members is not None:
+            self.builders[name].set_members(self.members, self.members_version)
+        if name in self.unviewed:
+            self.builders[name].set_unviewed(self.unviewed[name])
 
     def destroy(self, name):
         del self.builders[name]
@@ -668,6 +1257,89 @@ class EventBuilder(ZmqHandler):
             self.create(name)
         self.builders[name].del_graph(name, ver_key, args, graph)
 
+    def set_limits(self, name, depth=None, max_bytes=None):
+        """
+        Sets the maximum number of pending heartbeats and the byte budget of a
+        graph. When either is exceeded the oldest pending heartbeats are
+        completed with the contributions received so far.
+
+        Args:
+            name (str): the name of the graph.
+            depth (int): the maximum number of pending heartbeats. If None the
+                default depth is used.
+            max_bytes (int): the maximum number of bytes of contributions
+                buffered for pending heartbeats. If None the default is used.
+        """
+        depth = self.depth if depth is None else depth
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        self.limits[name] = (depth, max_bytes)
+        if name not in self.builders:
+            self.create(name)
+        self.builders[name].depth = depth
+        self.builders[name].max_bytes = max_bytes
+
+    def set_unviewed(self, name, names):
+        """
+        Sets the outputs of a graph which are no longer viewed, so the nodes
+        only needed for them are skipped (see Graph.set_unviewed).
+
+        Args:
+            name (str): the name of the graph.
+            names (set): the names of the outputs which are no longer viewed.
+        """
+        self.unviewed[name] = names
+        if name in self.builders:
+            self.builders[name].set_unviewed(names)
+
+    def checkpoint(self):
+        """
+        Returns:
+            A dictionary of the graph version and node state keyed by graph
+            name, for all the graphs that have been applied.
+        """
+        checkpoints = {}
+        for name, builder in self.builders.items():
+            checkpoint = builder.checkpoint()
+            if checkpoint is not None:
+                checkpoints[name] = checkpoint
+        return checkpoints
+
+    def restore_state(self, name, version, states):
+        if name not in self.builders:
+            self.create(name)
+        self.builders[name].restore_state(version, states)
+
+    def pending_stats(self):
+        """
+        Returns:
+            A dictionary of the number of pending heartbeats and the estimated
+            number of bytes buffered for them keyed by graph name.
+        """
+        return {name: (len(builder.order), builder.pending_bytes) for name, builder in self.builders.items()}
+
+    def set_members(self, eb_ids, version):
+        """
+        Sets the active contributors of all the graphs, including any graphs
+        created later.
+
+        Args:
+            eb_ids (iterable): the ids of the active contributors
+            version (int): the version of the membership
+
+        Returns:
+            A list of (name, heartbeat) tuples for the heartbeats which are
+            ready for completion with the new membership.
+        """
+        if version <= self.members_version:
+            return []
+        self.members = set(eb_ids)
+        self.members_version = version
+        ready = []
+        for name, builder in self.builders.items():
+            builder.set_members(self.members, version)
+            ready.extend((name, eb_key) for eb_key in builder.ready_keys())
+        return ready
+
     def purge_graph(self, name, ver_key, args, graph):
         if name in self.builders:
             self.destroy(name)
@@ -675,18 +1347,82 @@ class EventBuilder(ZmqHandler):
     def complete(self, name, eb_key, identity, drop=False):
         return self.builders[name].complete(eb_key, identity, drop)
 
-    def completion(self, name, eb_key, identity, payload, drop):
+    def completion(self, name, eb_key, identity, payload, drop, contributors=1):
         if not drop:
-            return self.collector_message(identity, eb_key, name, payload.version, payload.namespace)
+            self.sent[name] += 1
+            return self.collector_message(identity, eb_key, name, payload.version, payload.namespace,
+                                          defer=True, contributors=contributors)
 
-    def update(self, name, eb_key, eb_id, ver_key, data):
+    def update(self, name, eb_key, eb_id, ver_key, data, contributors=1):
         if name not in self.builders:
             self.create(name)
-        self.builders[name].update(eb_key, eb_id, ver_key, data)
+        self.builders[name].update(eb_key, eb_id, ver_key, data, contributors)
+
+    def expired(self):
+        """
+        Finds the pending heartbeats of all the graphs which have exceeded the
+        completion timeout.
+
+        Returns:
+            A list of (name, heartbeat) tuples for the expired heartbeats.
+        """
+        now = time.time()
+        return [(name, eb_key) for name, builder in self.builders.items() for eb_key in builder.expired(now)]
+
+    def settled(self, eb_key):
+        """
+        Finds the pending heartbeats of all the graphs up to and including
+        eb_key, which every contributor has already sent.
+
+        Args:
+            eb_key (int): the last heartbeat sent by all the contributors.
+
+        Returns:
+            A list of (name, heartbeat) tuples for the settled heartbeats.
+        """
+        return [(name, key) for name, builder in self.builders.items() for key in builder.settled(eb_key)]
 
     def contribs(self, name):
         return self.builders[name].contribs
 
+    def reset_stragglers(self):
+        """
+        Returns the contributions that arrived after their heartbeat was
+        completed and the contributions missing from completed heartbeats
+        since the last call, then resets them.
+
+        Returns:
+            A tuple of Counters of late and missing contributions keyed by eb_id.
+        """
+        late = collections.Counter()
+        missing = collections.Counter()
+        for builder in self.builders.values():
+            late.update(builder.late)
+            missing.update(builder.missing)
+            builder.late.clear()
+            builder.missing.clear()
+        return late, missing
+
+    def reset_arrivals(self):
+        """
+        Returns how long after the first contribution of their heartbeat the
+        contributions arrived and how long the completed heartbeats took to
+        complete since the last call, then resets them.
+
+        Returns:
+            A tuple of a dictionary of lists of arrival offsets keyed by eb_id
+            and a list of completion times, all in seconds.
+        """
+        offsets = collections.defaultdict(list)
+        completions = []
+        for builder in self.builders.values():
+            for eb_id, values in builder.offsets.items():
+                offsets[eb_id].extend(values)
+            completions.extend(builder.completions)
+            builder.offsets.clear()
+            builder.completions.clear()
+        return offsets, completions
+
     def pending(self, name):
         return self.builders[name].pending
 
@@ -746,7 +1482,10 @@ class Node(abc.ABC):
         self.graph_comm.add_handler("add", self.recv_graph_add)
         self.graph_comm.add_handler("del", self.recv_graph_del)
         self.graph_comm.add_handler("purge", self.recv_graph_purge)
+        self.graph_comm.add_handler("members", self.recv_members)
         self.graph_comm.add_handler("update_path", self.update_path)
+        self.graph_comm.add_handler("update_limits", self.update_limits)
+        self.graph_comm.add_handler("update_unviewed", self.update_unviewed)
 
         if export_addr is None:
             self.export_comm = None
@@ -787,6 +1526,47 @@ class Node(abc.ABC):
         """
         pass
 
+    def recv_members(self, name, version, args, members):
+        """
+        This method is called everytime that the set of active workers
+        changes. By default it does nothing.
+
+        Args:
+            name (str):      unused.
+            version (int):   the version number of the membership.
+            args (dict):     the keyword arguments to be used for compilation.
+            members (dict):  the active workers and the layout of the collectors.
+        """
+        pass
+
+    def report_membership(self, active=True):
+        """
+        Registers (or deregisters) this node as an active contributor with the
+        AMI graph manager.
+
+        Args:
+            active (bool): if False the node is deregistered.
+
+        Returns:
+            True if the registration was sent, False if it should be retried.
+        """
+        try:
+            self.report("register" if active else "deregister", self.node)
+            return True
+        except zmq.Again:
+            return False
+
+    def report_alive(self):
+        """
+        Tells the AMI graph manager that this node has collected another
+        heartbeat, so that it is not expired as an active contributor.
+        """
+        try:
+            self.report("alive", self.node)
+        except zmq.Again:
+            # the next heartbeat will tell the manager instead
+            pass
+
     def recv_graph_init(self, name, version, args, graph):
         """
         This method is called everytime that a graph init update is received.
@@ -870,13 +1650,13 @@ class Node(abc.ABC):
             payload (obj): the payload of the report. This can be any arbitrary
                 object that can be serialized using dill.
         """
-        self.node_msg_comm.send_string(topic, zmq.NOBLOCK | zmq.SNDMORE)
-        self.node_msg_comm.send_string(self.name, zmq.NOBLOCK | zmq.SNDMORE)
+        frames = [topic.encode(), self.name.encode()]
         if topic == "profile":
-            self.node_msg_comm.send_string(payload['graph'], zmq.NOBLOCK | zmq.SNDMORE)
-            self.node_msg_comm.send_serialized(payload, self.serializer, zmq.NOBLOCK, copy=False)
+            frames.append(payload['graph'].encode())
+            frames.extend(self.serializer(payload))
         else:
-            self.node_msg_comm.send(dill.dumps(payload), zmq.NOBLOCK, copy=False)
+            frames.append(dill.dumps(payload))
+        self.node_msg_comm.send_multipart(frames, zmq.NOBLOCK, copy=False)
 
     def update_path(self, name, version, args, paths):
         exists = True
@@ -888,6 +1668,32 @@ class Node(abc.ABC):
         if exists:
             sys.path.extend(paths)
 
+    def update_limits(self, name, version, args, limits):
+        """
+        This method is called when the event builder limits of a graph are
+        changed. Nodes that build events should override it.
+
+        Args:
+            name (str):      the name of the graph.
+            version (int):   the version number of the graph.
+            args (dict):     the keyword arguments to be used for compilation.
+            limits (dict):   the 'depth' and 'max_bytes' limits of the graph.
+        """
+        pass
+
+    def update_unviewed(self, name, version, args, names):
+        """
+        This method is called when the outputs of a graph which are no longer
+        viewed change. Nodes that run the graph should override it.
+
+        Args:
+            name (str):      the name of the graph.
+            version (int):   the version number of the graph.
+            args (dict):     the keyword arguments to be used for compilation.
+            names (set):     the names of the outputs which are no longer viewed.
+        """
+        pass
+
     def start_prometheus(self):
         port = self.prometheus_port
         while True:
@@ -930,27 +1736,68 @@ class Collector(abc.ABC):
         addr (str): the zmq address for receiving the collected results.
         ctx (zmq.Context): optional zmq context for the node to use. If none is
             passed it creates one.
+        hutch (str): the hutch used for labeling the prometheus metrics.
+        hwm (int): the receive high-water mark of the collection socket.
+        drain_limit (int): the maximum number of messages received from the
+            collection socket each time the poller wakes up.
+        recv_threads (int): the number of receiver threads used to
+            deserialize messages from the collection socket. If zero the
+            messages are deserialized on the main thread. With more than one
+            a single thread receives the messages and the others deserialize
+            them, so they are still processed in the order they were
+            received. Defaults to zero.
     """
 
-    def __init__(self, addr, ctx=None, hutch=None):
+    def __init__(self, addr, ctx=None, hutch=None, hwm=HighWaterMarks.Collection, drain_limit=100,
+                 recv_threads=0):
         if ctx is None:
             self.ctx = zmq.Context(io_threads=2)
         else:
             self.ctx = ctx
         self.poller = zmq.Poller()
         self.collector = self.ctx.socket(zmq.PULL)
+        self.collector.setsockopt(zmq.RCVHWM, hwm)
         self.collector.bind(addr)
-        self.poller.register(self.collector, zmq.POLLIN)
         self.handlers = {}
         self.running = True
         self.exitcode = 0
         self.deserializer = Deserializer()
         self.hutch = hutch
+        self.drain_limit = drain_limit
+        # the maximum time in ms to wait for data before calling process_timers
+        self.poll_timeout = None
+        self.receivers = []
+        if recv_threads > 0:
+            # receiver threads put lists of deserialized messages on the queue
+            # and then wake up the main thread via the recv_sock
+            self.recv_queue = queue.Queue(maxsize=hwm)
+            ready_addr = "inproc://collector-ready-%x" % id(self)
+            self.recv_sock = self.ctx.socket(zmq.PULL)
+            self.recv_sock.bind(ready_addr)
+            if recv_threads == 1:
+                self.receivers.append(threading.Thread(target=self._receive,
+                                                       args=(self.collector, ready_addr),
+                                                       daemon=True))
+            else:
+                # the received messages are numbered so the decoders can queue them in order
+                self.decode_queue = queue.Queue(maxsize=hwm)
+                self.decode_lock = threading.Lock()
+                self.decoded = {}
+                self.next_seq = 0
+                self.receivers.append(threading.Thread(target=self._dispatch, daemon=True))
+                for _ in range(recv_threads):
+                    self.receivers.append(threading.Thread(target=self._decode, args=(ready_addr,), daemon=True))
+        else:
+            self.recv_queue = None
+            self.recv_sock = self.collector
+        self.poller.register(self.recv_sock, zmq.POLLIN)
 
         self.event_counter = pc.Counter('ami_event_count', 'Event Counter', ['hutch', 'type', 'process'])
         self.event_time = pc.Gauge('ami_event_time_secs', 'Event Time', ['hutch', 'type', 'process'])
         self.event_size = pc.Gauge('ami_event_size_bytes', 'Event Size', ['hutch', 'process'])
         self.event_latency = pc.Gauge('ami_event_latency_secs', 'Event Latency', ['hutch', 'sender', 'process'])
+        self.event_batch = pc.Gauge('ami_event_batch_count', 'Messages Received Per Wakeup', ['hutch', 'process'])
+        self.event_queue = pc.Gauge('ami_event_queue_depth', 'Deserialized Messages Queued', ['hutch', 'process'])
 
     def register(self, sock, handler):
         """
@@ -990,6 +1837,22 @@ class Collector(abc.ABC):
         """
         pass
 
+    def process_batch_end(self):
+        """
+        Called after all the messages from a single receive on the collector
+        socket have been processed. Subclasses can override this to flush any
+        output they deferred while processing the batch.
+        """
+        pass
+
+    def process_timers(self):
+        """
+        Called each time the main collection loop wakes up, including when
+        polling times out after `poll_timeout` ms without any data arriving.
+        Subclasses can override this to handle any time based work.
+        """
+        pass
+
     def run(self):
         """
         The main collector loop runs forever polling the collector socket
@@ -1000,27 +1863,166 @@ class Collector(abc.ABC):
         Returns:
             The current value of the exitcode attribute of the class.
         """
+        for receiver in self.receivers:
+            receiver.start()
+
         idle_start = time.time()
-        reset_idle = False
         while self.running:
-            for sock, flag in self.poller.poll():
-                if flag != zmq.POLLIN:
-                    continue
+            # don't block if the receiver threads have already queued up more messages
+            queued = self.recv_queue is not None and not self.recv_queue.empty()
+            ready = [sock for sock, flag in self.poller.poll(0 if queued else self.poll_timeout)
+                     if flag == zmq.POLLIN]
+            queued = self.recv_queue is not None and not self.recv_queue.empty()
+            self.process_timers()
+            if not (ready or queued):
+                continue
+
+            self.event_time.labels(self.hutch, 'Idle', self.name).set(time.time() - idle_start)
+
+            # drain the collector socket before servicing the other sockets
+            if self.recv_sock in ready or queued:
+                self.event_batch.labels(self.hutch, self.name).set(self.drain())
+
+            for sock in ready:
+                if sock in self.handlers:
+                    self.handlers[sock]()
 
-                self.event_time.labels(self.hutch, 'Idle', self.name).set(time.time() - idle_start)
-                reset_idle = True
+            idle_start = time.time()
+
+        return self.exitcode
+
+    def drain(self):
+        """
+        Receives and processes messages waiting on the collector socket until
+        none are left or the `drain_limit` is reached.
 
-                if sock is self.collector:
-                    msg = self.collector.recv_serialized(self.deserializer, copy=False)
+        Returns:
+            The number of messages received from the collector socket.
+        """
+        count = 0
+        if self.recv_queue is None:
+            while count < self.drain_limit:
+                try:
+                    frames = self.collector.recv_multipart(flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                for msg_frames in unbatch_frames(frames):
+                    self.process_msg(self.deserializer(msg_frames))
+                count += 1
+        else:
+            # clear the wake up notifications from the receiver threads
+            while True:
+                try:
+                    self.recv_sock.recv(flags=zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+            while count < self.drain_limit:
+                try:
+                    msgs = self.recv_queue.get_nowait()
+                except queue.Empty:
+                    break
+                for msg in msgs:
                     self.process_msg(msg)
-                elif sock in self.handlers:
-                    self.handlers[sock]()
+                count += 1
+            self.event_queue.labels(self.hutch, self.name).set(self.recv_queue.qsize())
+        self.process_batch_end()
+        return count
 
-            if reset_idle:
-                reset_idle = False
-                idle_start = time.time()
+    def _dispatch(self):
+        """
+        Receives messages from the collection socket and numbers them in the
+        order they arrived for the decoder threads. This is run in its own
+        thread when there is more than one receiver thread.
+        """
+        seq = 0
+        try:
+            while True:
+                self.decode_queue.put((seq, self.collector.recv_multipart(copy=False)))
+                seq += 1
+        except zmq.ContextTerminated:
+            pass
 
-        return self.exitcode
+    def _decode(self, ready_addr):
+        """
+        The loop run by each decoder thread. Messages are deserialized in
+        parallel, but only put on the receive queue once all the messages
+        received before them have been, so the messages from each sender are
+        processed in the order they were sent.
+
+        Args:
+            ready_addr (str): the zmq address used to wake up the main thread.
+        """
+        ready = self.ctx.socket(zmq.PUSH)
+        ready.connect(ready_addr)
+        deserializer = Deserializer()
+        while True:
+            seq, frames = self.decode_queue.get()
+            # the seq is always recorded, even when nothing could be deserialized, so the later messages can follow
+            msgs = self._deserialize(deserializer, frames)
+            with self.decode_lock:
+                self.decoded[seq] = msgs
+                while self.next_seq in self.decoded:
+                    self.recv_queue.put(self.decoded.pop(self.next_seq))
+                    self.next_seq += 1
+            try:
+                ready.send(b'', flags=zmq.NOBLOCK)
+            except zmq.Again:
+                # the main thread already has a wake up pending
+                pass
+            except zmq.ContextTerminated:
+                ready.close(linger=0)
+                return
+
+    def _deserialize(self, deserializer, frames):
+        """
+        Deserializes the messages in a received envelope on a receiver thread.
+        Messages which can't be deserialized are logged and skipped, so a bad
+        frame doesn't stop the thread.
+
+        Args:
+            deserializer (Deserializer): the deserializer of the thread.
+            frames (list): the frames of the received multipart message.
+
+        Returns:
+            The list of deserialized messages.
+        """
+        msgs = []
+        try:
+            for msg_frames in unbatch_frames(frames):
+                try:
+                    msgs.append(deserializer(msg_frames))
+                except Exception:
+                    logger.exception("Failure encountered deserializing a received message:")
+                    self.event_counter.labels(self.hutch, 'Invalid Message', self.name).inc()
+        except Exception:
+            logger.exception("Failure encountered unpacking a batch of received messages:")
+            self.event_counter.labels(self.hutch, 'Invalid Message', self.name).inc()
+        return msgs
+
+    def _receive(self, sock, ready_addr):
+        """
+        The loop run by each receiver thread. Messages are received from the
+        socket and deserialized, then put on the receive queue for the main
+        thread to process.
+
+        Args:
+            sock (zmq.Socket): the socket to receive messages from.
+            ready_addr (str): the zmq address used to wake up the main thread.
+        """
+        ready = self.ctx.socket(zmq.PUSH)
+        ready.connect(ready_addr)
+        deserializer = Deserializer()
+        try:
+            while True:
+                frames = sock.recv_multipart(copy=False)
+                self.recv_queue.put(self._deserialize(deserializer, frames))
+                try:
+                    ready.send(b'', flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    # the main thread already has a wake up pending
+                    pass
+        except zmq.ContextTerminated:
+            ready.close(linger=0)
 
 
 class BaseReceiver(abc.ABC):
@@ -1618,6 +2620,24 @@ class CommHandler(abc.ABC):
     def updatePlots(self, plots):
         return self._post_dill('update_plots', plots)
 
+    def updateLimits(self, depth=None, max_bytes=None):
+        """
+        Sets how many heartbeats the collectors hold for the current graph
+        while waiting for contributions, and how many bytes they may buffer
+        for them. The oldest heartbeats are completed early when either limit
+        is exceeded.
+
+        Args:
+            depth (int): the maximum number of pending heartbeats, or None for
+                the collector default.
+            max_bytes (int): the maximum number of bytes of pending
+                contributions, or None for the collector default.
+
+        Returns:
+            True if the limits were updated.
+        """
+        return self._post_dill('update_limits', {'depth': depth, 'max_bytes': max_bytes})
+
     def fetch(self, names):
         """
         Attempts to fetch a feature with the requested name from the global
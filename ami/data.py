@@ -83,8 +83,22 @@ class Transitions(Enum):
 
 @dataclass
 class Transition:
+    """
+    Transition container.
+
+    Args:
+        ttype (Transitions): the type of the transition
+        payload (dict): the payload of the transition
+        seq (int): the sequence number of the transition since the last Configure
+        heartbeat (int): the last heartbeat sent before the transition, or None if unknown
+        sent (dict): the number of datagrams of each graph the sender has sent before the transition on
+            a different socket, or None if they were sent on the same socket as the transition
+    """
     ttype: Transitions
     payload: dict
+    seq: int = 0
+    heartbeat: int = None
+    sent: dict = None
 
     def _serialize(self):
         return asdict(self)
@@ -94,41 +108,45 @@ class Transition:
         return cls(**data)
 
 
-@dataclass(frozen=True)
-class Heartbeat:
+class Heartbeat(int):
     """
     Heartbeat contatiner.
 
-    Comparison/equality operators are implemented so that it can be
-    compared to integers.
+    The heartbeat is an `int` whose value is the heartbeat id number, so
+    hashing, sorting and comparisons to integers (or other heartbeats) use
+    the native integer operations. The timestamp is carried alongside and
+    is ignored by all comparisons.
 
     Args:
         identity (int): Heartbeat integer id number
         timestamp (float): Unix timestamp associated with heartbeat
     """
-    identity: int = 0
-    timestamp: float = 0.0
+    # int subtypes only support empty __slots__, so the timestamp lives in the
+    # instance dict.
 
-    def __hash__(self):
-        return hash(self.identity)
+    def __new__(cls, identity=0, timestamp=0.0):
+        self = super().__new__(cls, identity)
+        self.timestamp = timestamp
+        return self
 
-    def __eq__(self, other):
-        return self.identity == other
+    @property
+    def identity(self):
+        return int(self)
 
-    def __lt__(self, other):
-        return self.identity < other
+    def __repr__(self):
+        return "%s(identity=%d, timestamp=%r)" % (self.__class__.__name__, self, self.timestamp)
 
-    def __le__(self, other):
-        return self.identity <= other
+    def __reduce__(self):
+        return self.__class__, (int(self), self.timestamp)
 
-    def __gt__(self, other):
-        return self.identity > other
+    def __copy__(self):
+        return self
 
-    def __ge__(self, other):
-        return self.identity >= other
+    def __deepcopy__(self, memo):
+        return self
 
     def _serialize(self):
-        return asdict(self)
+        return {'identity': int(self), 'timestamp': self.timestamp}
 
     @classmethod
     def _deserialize(cls, data):
@@ -186,16 +204,23 @@ class CollectorMessage(Message):
         name (str): name
 
         version (int): version
+
+        contributors (int): number of workers whose data is included
     """
     heartbeat: Heartbeat = Heartbeat()
     name: str = ""
     version: int = 0
+    contributors: int = 1
 
     def _serialize(self):
-        return self.__dict__
+        data = dict(self.__dict__)
+        # pyarrow serializes int subclasses as plain ints, which would lose the timestamp
+        data['heartbeat'] = (int(self.heartbeat), getattr(self.heartbeat, 'timestamp', 0.0))
+        return data
 
     @classmethod
     def _deserialize(cls, data):
+        data['heartbeat'] = Heartbeat(*data['heartbeat'])
         return cls(**data)
 
 
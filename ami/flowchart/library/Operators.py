@@ -94,7 +94,7 @@ class MeanVsScan(CtrlNode):
                        func=func, **kwargs),
                 gn.ReduceByKey(name=self.name()+'_reduce',
                                inputs=map_outputs, outputs=reduce_outputs,
-                               reduction=lambda cv, v: (cv[0]+v[0], cv[1]+v[1]), **kwargs),
+                               reduction=gn.Reductions.Mean, **kwargs),
                 gn.Map(name=self.name()+'_mean', inputs=reduce_outputs, outputs=outputs, func=mean,
                        **kwargs)
             ]
@@ -114,7 +114,7 @@ class MeanVsScan(CtrlNode):
                        func=lambda a: (a, 1), **kwargs),
                 gn.ReduceByKey(name=self.name()+'_reduce',
                                inputs=[inputs['Bin']]+map_outputs, outputs=reduce_outputs,
-                               reduction=lambda cv, v: (cv[0]+v[0], cv[1]+v[1]), **kwargs),
+                               reduction=gn.Reductions.Mean, **kwargs),
                 gn.Map(name=self.name()+'_mean', inputs=reduce_outputs, outputs=outputs, func=mean,
                        **kwargs)
             ]
@@ -178,7 +178,7 @@ class MeanWaveformVsScan(CtrlNode):
                        func=func, **kwargs),
                 gn.ReduceByKey(name=self.name()+'_reduce',
                                inputs=map_outputs, outputs=reduce_outputs,
-                               reduction=lambda cv, v: (cv[0]+v[0], cv[1]+v[1]), **kwargs),
+                               reduction=gn.Reductions.Mean, **kwargs),
                 gn.Map(name=self.name()+'_mean', inputs=reduce_outputs, outputs=outputs, func=mean,
                        **kwargs)
             ]
@@ -199,7 +199,7 @@ class MeanWaveformVsScan(CtrlNode):
                        func=lambda a: (a, 1), **kwargs),
                 gn.ReduceByKey(name=self.name()+'_reduce',
                                inputs=[inputs['Bin']]+map_outputs, outputs=reduce_outputs,
-                               reduction=lambda cv, v: (cv[0]+v[0], cv[1]+v[1]), **kwargs),
+                               reduction=gn.Reductions.Mean, **kwargs),
                 gn.Map(name=self.name()+'_mean', inputs=reduce_outputs, outputs=outputs, func=mean,
                        **kwargs)
             ]
@@ -4,6 +4,129 @@ import numpy as np
 from networkfox import operation
 
 
+class Reduction:
+    """
+    An associative reduction that can combine many values with a single NumPy
+    call. When a ReduceByKey or Accumulator node has one of these as its
+    reduction, the collectors merge the contributions for it from all their
+    contributors at once instead of one contribution at a time.
+
+    Values can be scalars, arrays or tuples of them (e.g. a sum with its
+    count), which are reduced element by element.
+
+    Args:
+        name (str): the name of the reduction.
+        ufunc (numpy.ufunc): the binary ufunc which combines the values.
+        pairwise (function): an optional faster function for combining two
+            values. Defaults to the ufunc.
+    """
+
+    def __init__(self, name, ufunc, pairwise=None):
+        self.name = name
+        self.ufunc = ufunc
+        self.pairwise = ufunc if pairwise is None else pairwise
+
+    def __repr__(self):
+        return "%s('%s')" % (self.__class__.__name__, self.name)
+
+    def __call__(self, res, *values):
+        value = values[0] if len(values) == 1 else values
+        if res is None:
+            return value
+        elif isinstance(value, tuple):
+            return tuple(map(self.pairwise, res, value))
+        else:
+            return self.pairwise(res, value)
+
+    def reduce(self, values):
+        """
+        Combines a list of values.
+
+        Args:
+            values (list): the values to combine, which must all have the same
+                shape.
+
+        Returns:
+            The reduced value.
+        """
+        first = values[0]
+        if isinstance(first, tuple):
+            return tuple(self.reduce([value[i] for value in values]) for i in range(len(first)))
+        elif len(values) == 1:
+            return first
+        return self._native(first, self.ufunc.reduce(np.asarray(values), axis=0))
+
+    def reduce_by_key(self, dicts):
+        """
+        Merges dictionaries, reducing the values of any keys found in more than
+        one of them. The values are grouped by a single sort of all the keys
+        and then each group is reduced with one call to `ufunc.reduceat`.
+
+        Args:
+            dicts (list): the dictionaries to merge. The keys must be sortable
+                scalars of one type.
+
+        Returns:
+            The merged dictionary.
+        """
+        keys = [key for d in dicts for key in d]
+        if not keys:
+            return {}
+        # numpy silently converts mixed numbers and strings to strings
+        is_text = [isinstance(key, (str, bytes)) for key in keys]
+        keys = np.asarray(keys)
+        if keys.ndim != 1 or keys.dtype.kind not in 'biufUS' or any(is_text) != all(is_text):
+            raise TypeError("keys must be sortable scalars of one type")
+        values = [value for d in dicts for value in d.values()]
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        return dict(zip(keys[starts].tolist(), self._reduceat(values, order, starts)))
+
+    def _reduceat(self, values, order, starts):
+        first = values[0]
+        if isinstance(first, tuple):
+            return list(zip(*(self._reduceat([value[i] for value in values], order, starts)
+                              for i in range(len(first)))))
+        reduced = self.ufunc.reduceat(np.asarray(values)[order], starts, axis=0)
+        if isinstance(first, (np.ndarray, np.generic)):
+            return list(reduced)
+        return reduced.tolist()
+
+    @staticmethod
+    def _native(first, value):
+        # keep python scalars as python scalars
+        if isinstance(first, (np.ndarray, np.generic)):
+            return value
+        return value.item()
+
+
+class Reductions:
+    Sum = Reduction('sum', np.add, operator.add)
+    Min = Reduction('min', np.minimum)
+    Max = Reduction('max', np.maximum)
+    # the values are (sum, count) tuples
+    Mean = Reduction('mean', np.add, operator.add)
+
+    @classmethod
+    def lookup(cls, name):
+        """
+        Returns the typed reduction with the passed name, e.g. 'sum'.
+        """
+        for reduction in (cls.Sum, cls.Min, cls.Max, cls.Mean):
+            if reduction.name == name:
+                return reduction
+        raise ValueError("Unknown reduction: %s" % name)
+
+
+def _zero():
+    return 0
+
+
+def _no_result():
+    return None
+
+
 class Transformation(abc.ABC):
 
     def __init__(self, **kwargs):
@@ -13,6 +136,8 @@ class Transformation(abc.ABC):
             inputs (list): List of inputs
             outputs (list): List of outputs
             func (function): Function node will call
+            vectorized (bool): Whether func can be called once on the stacked inputs of a batch of events
+                instead of once per event (see Graph.__call__)
         """
 
         self.name = kwargs['name']
@@ -36,6 +161,7 @@ class Transformation(abc.ABC):
         self.end_run_func = kwargs.get('end_run', None)
         self.begin_step_func = kwargs.get('begin_step', None)
         self.end_step_func = kwargs.get('end_step', None)
+        self.vectorized = kwargs.get('vectorized', False)
         self.is_global_operation = False
 
     def __hash__(self):
@@ -88,6 +214,7 @@ class Map(Transformation):
             inputs (list): List of inputs
             outputs (list): List of outputs
             func (function): Function node will call
+            vectorized (bool): Whether func can be called on the stacked inputs of a batch of events
         """
         super().__init__(**kwargs)
 
@@ -100,10 +227,13 @@ class StatefulTransformation(Transformation):
             name (str): Name of node
             inputs (list): List of inputs
             outputs (list): List of outputs
-            reduction (function): Reduction function
+            reduction (function): Reduction function, or the name of one of
+                the typed Reductions
         """
 
         reduction = kwargs.pop('reduction', None)
+        if isinstance(reduction, str):
+            reduction = Reductions.lookup(reduction)
 
         kwargs.setdefault('func', None)
         super().__init__(**kwargs)
@@ -129,6 +259,22 @@ class StatefulTransformation(Transformation):
         """
         return
 
+    def get_state(self):
+        """
+        Returns the accumulated state of the node, so it can be carried over to
+        an equivalent node when the graph is recompiled.
+        """
+        return {}
+
+    def set_state(self, state):
+        """
+        Restores state previously returned by get_state.
+
+        Args:
+            state (dict): the state of an equivalent node
+        """
+        return
+
     def to_operation(self):
         return operation(name=self.name, needs=self.inputs, provides=self.outputs,
                          color=self.color, metadata={'parent': self.parent})(self)
@@ -168,6 +314,23 @@ class GlobalTransformation(StatefulTransformation):
         """
         return {"parent": self.parent}
 
+    def can_merge(self):
+        """
+        Returns True if the values a collector receives for the inputs of this
+        node can be combined with `merge` before the node is called, instead
+        of calling it once per contributor.
+        """
+        return False
+
+    def merge(self, values):
+        """
+        Combines the values received from many contributors for one input.
+
+        Args:
+            values (list): the values from each contributor.
+        """
+        raise NotImplementedError("%s does not support merging" % self.__class__.__name__)
+
 
 class ReduceByKey(GlobalTransformation):
 
@@ -184,16 +347,31 @@ class ReduceByKey(GlobalTransformation):
                 self.res[k] = self.reduction(self.res[k], v)
             else:
                 self.res[k] = v
-        else:
+        elif isinstance(self.reduction, Reduction):
             # localCollector, globalCollector
-            for r in args:
-                for k, v in r.items():
-                    if k in self.res:
-                        self.res[k] = self.reduction(self.res[k], v)
-                    else:
-                        self.res[k] = v
+            try:
+                self.res = self.reduction.reduce_by_key([self.res, *args])
+            except (TypeError, ValueError):
+                self.res = self._merge_items(self.res, args)
+        else:
+            self.res = self._merge_items(self.res, args)
         return self.res
 
+    def _merge_items(self, res, args):
+        for r in args:
+            for k, v in r.items():
+                if k in res:
+                    res[k] = self.reduction(res[k], v)
+                else:
+                    res[k] = v
+        return res
+
+    def can_merge(self):
+        return self.is_expanded and isinstance(self.reduction, Reduction)
+
+    def merge(self, values):
+        return self.reduction.reduce_by_key(values)
+
     def reset(self):
         self.res = {}
 
@@ -201,12 +379,20 @@ class ReduceByKey(GlobalTransformation):
         if self.color != 'globalCollector':
             self.reset()
 
+    def get_state(self):
+        return {'res': self.res}
+
+    def set_state(self, state):
+        self.res = state['res']
+
 
 class Accumulator(GlobalTransformation):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.res_factory = kwargs.pop('res_factory', lambda: 0)
+        # typed reductions start from the first value they are given
+        default_factory = _no_result if isinstance(self.reduction, Reduction) else _zero
+        self.res_factory = kwargs.pop('res_factory', default_factory)
         assert hasattr(self.res_factory, '__call__'), 'res_factory is not callable'
         self.res = self.res_factory()
 
@@ -214,6 +400,12 @@ class Accumulator(GlobalTransformation):
         self.res = self.reduction(self.res, *args)
         return self.res
 
+    def can_merge(self):
+        return self.is_expanded and isinstance(self.reduction, Reduction)
+
+    def merge(self, values):
+        return self.reduction.reduce(values)
+
     def reset(self):
         self.res = self.res_factory()
 
@@ -221,6 +413,12 @@ class Accumulator(GlobalTransformation):
         if self.color != 'globalCollector':
             self.reset()
 
+    def get_state(self):
+        return {'res': self.res}
+
+    def set_state(self, state):
+        self.res = state['res']
+
     def on_expand(self):
         return {'parent': self.parent, 'res_factory': self.res_factory}
 
@@ -261,6 +459,16 @@ class PickN(GlobalTransformation):
     def reset(self):
         self.res = [None]*self.N
 
+    def get_state(self):
+        return {'res': list(self.res), 'idx': self.idx, 'clear': self.clear}
+
+    def set_state(self, state):
+        # keep as many of the picked values as fit if N is different
+        res = state['res'][:self.N]
+        self.res = res + [None]*(self.N - len(res))
+        self.idx = state['idx'] % self.N
+        self.clear = state['clear']
+
 
 class RollingBuffer(GlobalTransformation):
 
@@ -327,5 +535,21 @@ class RollingBuffer(GlobalTransformation):
     def on_expand(self):
         return {'parent': self.parent, 'use_numpy': self.use_numpy, 'unique': self.unique}
 
+    def get_state(self):
+        return {'res': self.res, 'idx': self.idx}
+
+    def set_state(self, state):
+        # the buffer may have been resized if the number of contributors changed
+        res = state['res']
+        self.idx = min(state['idx'], self.N)
+        if self.use_numpy and res is not None and len(res) != self.N:
+            self.res = np.zeros(self.N, dtype=res.dtype)
+            nelem = min(len(res), self.N)
+            self.res[..., -nelem:] = res[..., -nelem:]
+        elif res is not None:
+            self.res = res[-self.N:]
+        else:
+            self.res = res
+
     def reset(self):
         self.idx = 0
@@ -1,3 +1,9 @@
+import re
+import copy
+import time
+import types
+import functools
+import numpy as np
 import networkx as nx
 import collections
 import ami.graph_nodes as gn
@@ -8,6 +14,337 @@ def skip(n):
     return type(n) is str or type(n) is modifiers.optional
 
 
+def _values_key(values):
+    return tuple((type(value), value) for value in values)
+
+
+def signature(func):
+    """
+    Makes a key which is equal for functions that compute the same thing given the same inputs: functions built
+    from the same code with equal defaults and captured values, partials of such functions with equal arguments, or
+    the same builtin.
+
+    Args:
+        func (callable): the function to make a key for.
+
+    Returns:
+        A hashable key, or None if the function cannot be compared, e.g. a callable object which may keep state.
+    """
+    try:
+        if isinstance(func, functools.partial):
+            inner = signature(func.func)
+            if inner is None:
+                return None
+            key = (inner, _values_key(func.args), _values_key(sorted(func.keywords.items())))
+        elif isinstance(func, types.FunctionType):
+            cells = [cell.cell_contents for cell in func.__closure__ or ()]
+            key = (func.__code__, _values_key(func.__defaults__ or ()), _values_key(cells),
+                   _values_key(sorted((func.__kwdefaults__ or {}).items())))
+        elif isinstance(func, types.BuiltinFunctionType):
+            key = func
+        else:
+            return None
+        hash(key)
+    except (TypeError, ValueError):
+        # unhashable captured values or empty closure cells
+        return None
+    return key
+
+
+def unbatched(func, outputs):
+    """
+    Wraps a vectorized function so it can be run on the inputs of a single event, as a batch of one event.
+
+    Args:
+        func (callable): the vectorized function.
+        outputs (int): the number of outputs of the node.
+
+    Returns:
+        The wrapped function.
+    """
+    def call(*args, **kwargs):
+        result = func(*[np.stack([arg]) for arg in args], **{name: np.stack([arg]) for name, arg in kwargs.items()})
+        if result is None:
+            return None
+        elif outputs == 1:
+            return result[0]
+        else:
+            return tuple(values[0] for values in result)
+    return call
+
+
+class FusedMap():
+    """
+    A linear chain of map nodes run as a single step of an execution plan, where every node after the first only
+    consumes the output of the one before it. The chain stops at the first None result, and the execution time of
+    each node is still recorded for profiling. The times add up over calls until clear is called.
+
+    Args:
+        funcs (list): the functions of the nodes in order.
+        names (list): the names of the nodes.
+    """
+
+    def __init__(self, funcs, names):
+        self.funcs = funcs
+        self.names = names
+        self.elapsed = [0.0] * len(funcs)
+        self.zeros = [0.0] * len(funcs)
+
+    def clear(self):
+        self.elapsed[:] = self.zeros
+
+    def __call__(self, *args, **kwargs):
+        funcs = self.funcs
+        elapsed = self.elapsed
+        start = time.perf_counter()
+        result = funcs[0](*args, **kwargs)
+        stop = time.perf_counter()
+        elapsed[0] += stop - start
+        for stage in range(1, len(funcs)):
+            if result is None:
+                break
+            result = funcs[stage](result)
+            start, stop = stop, time.perf_counter()
+            elapsed[stage] += stop - start
+        return result
+
+
+class ExecutionPlan():
+    """
+    The nodes of one color of a compiled graph flattened into a list of steps in topological order. Every name used
+    by the nodes has a fixed slot in a list which is reused between runs, so running the plan only indexes into that
+    list instead of building dictionaries and walking the graph.
+
+    A node is skipped when any of its required inputs is missing or None, e.g. downstream of a filter which returned
+    None, and its outputs are then None as well. Optional inputs are passed as keyword arguments when present.
+
+    Map nodes which compute the same thing from the same inputs, see signature, are only run once: the slots of the
+    outputs of the later ones are shared with the first one, and the merged names are recorded in merged. Stateful
+    nodes and nodes with run or step callbacks are never merged.
+
+    Linear chains of map nodes whose intermediate results are used by nothing else, e.g. Roi2D -> Sum -> Polynomial,
+    are fused into a single step, see FusedMap.
+
+    A batch of events can also be run at once, see batch. Outside of a batch vectorized nodes are run on a batch of
+    one event.
+
+    Args:
+        nodes (list): the nodes of the color in topological order.
+        outputs (set): the names returned by each run.
+    """
+
+    def __init__(self, nodes, outputs):
+        slots = {}
+
+        def slot(name):
+            if name not in slots:
+                slots[name] = len(slots)
+                if name not in produced:
+                    self.loads.append((name, slots[name]))
+            return slots[name]
+
+        produced = set()
+        seen = {}
+        fusable = []
+        vectorized = []
+        names = []
+        self.loads = []
+        self.steps = []
+        self.merged = {}
+        for node in nodes:
+            args = [slot(name) for name in node.inputs if type(name) is not modifiers.optional]
+            optionals = [(name, slot(name)) for name in node.inputs if type(name) is modifiers.optional]
+            produced.update(node.outputs)
+            key = self.common_key(node, args, optionals)
+            if key in seen:
+                original, outs = seen[key]
+                slots.update(zip(node.outputs, outs))
+                self.merged[node.name] = original
+                continue
+            outs = [slot(name) for name in node.outputs]
+            if key is not None:
+                seen[key] = (node.name, outs)
+            if isinstance(node, gn.StatefulTransformation):
+                func = node
+            elif node.vectorized:
+                func = unbatched(node.func, len(outs))
+            else:
+                func = node.func
+            self.steps.append((func, args, optionals, outs))
+            fusable.append(type(node) is gn.Map and not node.vectorized)
+            vectorized.append(node.func if node.vectorized else None)
+            names.append(node.name)
+        self.returns = [(name, slot(name)) for name in outputs]
+        self.slots = [None] * len(slots)
+        self.names = names
+        heads = self.fuse(fusable, names)
+        # vectorized nodes are never fused so they are still a step of their own
+        self.vectorized = {step: vectorized[head] for step, head in enumerate(heads) if vectorized[head] is not None}
+        self.fused = [func for func, args, optionals, outs in self.steps if type(func) is FusedMap]
+        self.elapsed = [0.0] * len(self.steps)
+
+    def fuse(self, fusable, names):
+        """
+        Replaces the linear chains of map nodes in the steps by FusedMaps.
+
+        Args:
+            fusable (list): whether each step is a map node.
+            names (list): the node name of each step.
+
+        Returns:
+            The index of the first of the original steps in each step after fusing.
+        """
+        consumers = collections.Counter(idx for name, idx in self.returns)
+        for func, args, optionals, outs in self.steps:
+            consumers.update(args)
+            consumers.update(idx for name, idx in optionals)
+
+        chains = []
+        tails = {}
+        for step, (func, args, optionals, outs) in enumerate(self.steps):
+            head = None
+            if fusable[step] and len(args) == 1 and not optionals and consumers[args[0]] == 1:
+                head = tails.pop(args[0], None)
+            if head is None:
+                head = len(chains)
+                chains.append([step])
+            else:
+                chains[head].append(step)
+            if fusable[step] and len(outs) == 1:
+                tails[outs[0]] = head
+
+        steps = []
+        self.step_names = []
+        for chain in chains:
+            func, args, optionals, outs = self.steps[chain[0]]
+            if len(chain) > 1:
+                func = FusedMap([self.steps[step][0] for step in chain], [names[step] for step in chain])
+                outs = self.steps[chain[-1]][3]
+                self.step_names.append(None)
+            else:
+                self.step_names.append(names[chain[0]])
+            steps.append((func, args, optionals, outs))
+        self.steps = steps
+        return [chain[0] for chain in chains]
+
+    @staticmethod
+    def common_key(node, args, optionals):
+        if type(node) is not gn.Map or node.vectorized:
+            return None
+        if any(callable(func) for func in (node.begin_run_func, node.end_run_func,
+                                           node.begin_step_func, node.end_step_func)):
+            return None
+        func = signature(node.func)
+        if func is None:
+            return None
+        return (func, tuple(args), tuple(optionals), len(node.outputs))
+
+    def __call__(self, data):
+        """
+        Runs the nodes of the plan.
+
+        Args:
+            data (dict): the inputs of the plan.
+
+        Returns:
+            A dictionary of the outputs of the plan which are not None.
+        """
+        slots = self.slots
+        elapsed = self.elapsed
+        for fused in self.fused:
+            fused.clear()
+        for name, idx in self.loads:
+            slots[idx] = data.get(name)
+        for step, (func, args, optionals, outs) in enumerate(self.steps):
+            start = time.perf_counter()
+            result = None
+            for idx in args:
+                if slots[idx] is None:
+                    break
+            else:
+                if optionals:
+                    result = func(*[slots[idx] for idx in args],
+                                  **{name: slots[idx] for name, idx in optionals if slots[idx] is not None})
+                else:
+                    result = func(*[slots[idx] for idx in args])
+            if len(outs) == 1:
+                slots[outs[0]] = result
+            elif result is None:
+                for idx in outs:
+                    slots[idx] = None
+            else:
+                for idx, value in zip(outs, result):
+                    slots[idx] = value
+            elapsed[step] = time.perf_counter() - start
+        return {name: slots[idx] for name, idx in self.returns if slots[idx] is not None}
+
+    def batch(self, events):
+        """
+        Runs the nodes of the plan over a batch of events. Each node is run for all the events before the next one,
+        so stateful nodes still see the events in order. Vectorized nodes are run once on the stacked inputs of the
+        events they are not skipped for, and return a sequence with the result of each of those events, or a tuple
+        of sequences for nodes with several outputs. The other nodes are run once per event.
+
+        Args:
+            events (list): the inputs of each event.
+
+        Returns:
+            A list with a dictionary of the outputs of each event which are not None.
+        """
+        size = len(events)
+        columns = [[None] * size for _ in self.slots]
+        for fused in self.fused:
+            fused.clear()
+        for name, idx in self.loads:
+            columns[idx] = [data.get(name) for data in events]
+        for step, (func, args, optionals, outs) in enumerate(self.steps):
+            start = time.perf_counter()
+            rows = [row for row in range(size) if all(columns[idx][row] is not None for idx in args)]
+            if step in self.vectorized:
+                results = self._run_vectorized(self.vectorized[step], args, optionals, columns, rows)
+                if results is not None:
+                    if len(outs) == 1:
+                        results = (results,)
+                    for idx, values in zip(outs, results):
+                        for row, value in zip(rows, values):
+                            columns[idx][row] = value
+            else:
+                for row in rows:
+                    kwargs = {name: columns[idx][row] for name, idx in optionals if columns[idx][row] is not None}
+                    result = func(*[columns[idx][row] for idx in args], **kwargs)
+                    if len(outs) == 1:
+                        columns[outs[0]][row] = result
+                    elif result is not None:
+                        for idx, value in zip(outs, result):
+                            columns[idx][row] = value
+            self.elapsed[step] = time.perf_counter() - start
+        return [{name: columns[idx][row] for name, idx in self.returns if columns[idx][row] is not None}
+                for row in range(size)]
+
+    @staticmethod
+    def _run_vectorized(func, args, optionals, columns, rows):
+        if not rows:
+            return None
+        stacked = [np.stack([columns[idx][row] for row in rows]) for idx in args]
+        # optional inputs are only passed when every event has them
+        kwargs = {name: np.stack([columns[idx][row] for row in rows]) for name, idx in optionals
+                  if all(columns[idx][row] is not None for row in rows)}
+        return func(*stacked, **kwargs)
+
+    def times(self):
+        """
+        Returns:
+            A dictionary of the execution time of each node during the last run keyed by node name.
+        """
+        times = {}
+        for name, elapsed, (func, args, optionals, outs) in zip(self.step_names, self.elapsed, self.steps):
+            if name is not None:
+                times[name] = elapsed
+            else:
+                times.update(zip(func.names, func.elapsed))
+        return times
+
+
 class Graph():
 
     def __init__(self, name):
@@ -24,10 +361,63 @@ class Graph():
         self.children_of_global_operations = {}
         self.inputs = collections.defaultdict(set)
         self.outputs = collections.defaultdict(set)
+        self.mergers = {}
+        # the operation nodes in the graph keyed by name, and by name keyed by the name of their parent
+        self.nodes_by_name = {}
+        self.children = {}
+        # the nodes inserted since the last compile, which are the only ones that need coloring
+        self.dirty = set()
+        # the networkfox operations of the compiled nodes
+        self.operations = {}
+        # the arguments the graph was last compiled with
+        self.compiler_args = None
+        # the execution plan of each color, which are built the first time the color is run
+        self.plans = {}
+        self.last_plan = None
+        # the outputs of the global collector which are no longer viewed
+        self.unviewed = set()
+        # the names and nodes needed to produce the outputs which are still viewed
+        self.needed = None
 
     def __bool__(self):
         return self.graph.size() != 0
 
+    def copy(self):
+        """
+        Makes a structural copy of the graph which can be edited and compiled without changing this one, e.g. to
+        check that an edit compiles or to roll it back. The nodes are shallow copies, so their functions and state
+        are shared instead of serialized, and the networkfox operations are rebuilt when the copy is compiled.
+
+        Returns:
+            The copy of the graph.
+        """
+        copies = {}
+
+        def node(n):
+            if skip(n):
+                return n
+            if id(n) not in copies:
+                copies[id(n)] = copy.copy(n)
+            return copies[id(n)]
+
+        graph = Graph(self.name)
+        graph.graph.add_nodes_from(node(n) for n in self.graph.nodes)
+        graph.graph.add_edges_from((node(u), node(v)) for u, v in self.graph.edges)
+        graph.global_operations = {node(n) for n in self.global_operations}
+        graph.expanded_global_operations = {node(n) for n in self.expanded_global_operations}
+        graph.children_of_global_operations = {parent: {node(n) for n in children}
+                                               for parent, children in self.children_of_global_operations.items()}
+        for color, names in self.inputs.items():
+            graph.inputs[color] = set(names)
+        for color, names in self.outputs.items():
+            graph.outputs[color] = set(names)
+        graph.nodes_by_name = {name: node(n) for name, n in self.nodes_by_name.items()}
+        graph.children = {parent: {name: node(n) for name, n in children.items()}
+                          for parent, children in self.children.items()}
+        graph.dirty = {node(n) for n in self.dirty}
+        graph.unviewed = set(self.unviewed)
+        return graph
+
     def name_is_valid(self, name):
         """
         Returns true if the name passed is a valid user-defined name for inputs
@@ -43,7 +433,8 @@ class Graph():
             True if the name is valid, False otherwise.
         """
         if isinstance(name, str):
-            return not name.endswith(('_worker', '_localCollector', '_globalCollector'))
+            return not (name.endswith(('_worker', '_localCollector', '_globalCollector')) or
+                        re.search(r'_midCollector\d+$', name))
         else:
             return False
 
@@ -108,46 +499,74 @@ class Graph():
         assert op not in self.graph.nodes(), "Operation may only be added once %s" % op.name
 
         if op.is_global_operation:
-            for n in self.graph.nodes:
-                if skip(n):
-                    continue
-                if n.is_global_operation and n.parent == op.parent and n.outputs == op.outputs:
+            for n in self.children.get(op.parent, {}).values():
+                if n.is_global_operation and n.outputs == op.outputs:
                     assert False, "Operation may only be added once %s" % op.name
 
+        self._add_node(op)
+
+        # nodes are equal by name so drop any replaced node with the same name first
+        self.dirty.discard(op)
+        self.dirty.add(op)
+        self.graphkit = None
+
+    def _add_node(self, op):
         for i in op.inputs:
             self.graph.add_edge(i, op)
 
         for o in op.outputs:
             self.graph.add_edge(op, o)
 
-        self.graphkit = None
+        self.nodes_by_name[op.name] = op
+        self.children.setdefault(op.parent, {})[op.name] = op
 
-    def remove(self, name):
+    def _remove_nodes(self, nodes):
+        nodes = list(nodes)
+        self.graph.remove_nodes_from(nodes)
+        for node in nodes:
+            if skip(node):
+                continue
+            self.nodes_by_name.pop(node.name, None)
+            children = self.children.get(node.parent)
+            if children is not None:
+                children.pop(node.name, None)
+                if not children:
+                    del self.children[node.parent]
+
+    def remove(self, names):
         """
-        Recursively removes a node and its descendants from the graph.
+        Recursively removes nodes and their descendants from the graph. Removing many nodes at once and compiling
+        afterwards is much faster than compiling after each one.
 
         Args:
-            name (str): Name of node to remove from graph.
+            names (list or str): Names of nodes to remove from graph.
         """
 
-        for n in self.graph.nodes:
-            if skip(n):
-                continue
-            if n.name == name or n.parent == name:
-                desc = nx.dag.descendants(self.graph, n)
-                self.graph.remove_nodes_from(desc)
-                self.graph.remove_node(n)
-                break
+        if type(names) is not list:
+            names = [names]
+
+        for name in names:
+            self._remove(name)
+
+        self.graphkit = None
+
+    def _remove(self, name):
+        n = self.nodes_by_name.get(name)
+        if n is None:
+            # the node may have been expanded into children which share its name as parent
+            n = next(iter(self.children.get(name, {}).values()), None)
+        if n is not None:
+            desc = nx.dag.descendants(self.graph, n)
+            desc.add(n)
+            self._remove_nodes(desc)
 
         if name in self.children_of_global_operations:
             for child in self.children_of_global_operations[name]:
-                self.remove(child.name)
+                self._remove(child.name)
                 if child in self.expanded_global_operations:
                     self.expanded_global_operations.remove(child)
             del self.children_of_global_operations[name]
 
-        self.graphkit = None
-
     def replace(self, new_node):
         """
         Replace a node in the graph. Inputs and outputs of new_node must match the existing node in the graph otherwise
@@ -173,30 +592,24 @@ class Graph():
                     assert set(child.outputs) == set(new_node.outputs), "Outputs must match."
             nodes_to_remove = descendants.intersection(ancestors)
 
-            self.graph.remove_nodes_from(nodes_to_remove)
+            self._remove_nodes(nodes_to_remove)
             for node in nodes_to_remove:
                 if node in self.expanded_global_operations:
                     self.expanded_global_operations.remove(node)
 
             self.children_of_global_operations[new_node.parent].difference_update(nodes_to_remove)
         else:
-            old_node = None
-            for n in self.graph.nodes:
-                if skip(n):
-                    continue
-                if n.name == new_node.name:
-                    old_node = n
-                    break
+            old_node = self.nodes_by_name.get(new_node.name)
 
             if old_node is not None:
                 # assert old_node is not None, "Old node not found: %s" % new_node.name
                 # assert set(old_node.inputs) == set(new_node.inputs), "Inputs must match."
-                self.graph.remove_node(old_node)
+                self._remove_nodes([old_node])
 
                 diff = set(old_node.outputs).difference(new_node.outputs)
                 for node in diff:
                     desc = nx.dag.descendants(self.graph, node)
-                    self.graph.remove_nodes_from(desc)
+                    self._remove_nodes(desc)
 
         self.insert(new_node)
         self.graphkit = None
@@ -208,6 +621,43 @@ class Graph():
         nodes = list(filter(lambda node: isinstance(node, gn.StatefulTransformation), self.graph.nodes))
         list(map(lambda node: node.reset(), nodes))
 
+    def get_state(self, color=None):
+        """
+        Returns the accumulated state of the StatefulTransformation nodes in the graph, e.g. for checkpointing.
+
+        Args:
+            color (str): only include the nodes of this color. Defaults to all the nodes.
+
+        Returns:
+            A dictionary of the node type name and state keyed by node name.
+        """
+        return {node.name: (type(node).__name__, node.get_state()) for node in self.graph.nodes
+                if isinstance(node, gn.StatefulTransformation) and (color is None or node.color == color)}
+
+    def set_state(self, states):
+        """
+        Restores the state returned by get_state to the nodes with the same name and type in this graph.
+
+        Args:
+            states (dict): the state returned by get_state.
+        """
+        for node in self.graph.nodes:
+            if isinstance(node, gn.StatefulTransformation) and node.name in states:
+                node_type, state = states[node.name]
+                if node_type == type(node).__name__:
+                    node.set_state(state)
+
+    def transfer_state(self, other):
+        """
+        Copies the accumulated state of the StatefulTransformation nodes in another graph to the nodes with
+        the same name and type in this graph. This allows a graph to be recompiled, e.g. for a different number
+        of workers, without losing what it has accumulated.
+
+        Args:
+            other (Graph): the graph to copy the state from.
+        """
+        self.set_state(other.get_state())
+
     def heartbeat_finished(self):
         """
         Execute post heartbeat hook on StatefulTransformation nodes in the graph.
@@ -244,15 +694,20 @@ class Graph():
         nodes = list(filter(lambda node: hasattr(node, "end_step"), self.graph.nodes))
         list(map(lambda node: node.end_step(step, color), nodes))
 
-    def _color_nodes(self):
+    def _color_nodes(self, dirty):
         """
         Generate all paths from inputs to outputs, for each path look for nodes which have the ``is_global_operation``
         attribute set to True. If in a given path for which we've found a global operation node there is no
         other node with ``is_global_operation`` true which preceeds it then we mark that node for expansion.
+
+        Only the nodes inserted since the last compile are colored, the rest keep the colors they already have.
+
+        Args:
+            dirty (set): the nodes inserted since the last compile.
         """
         self.global_operations = set()
 
-        global_operations = list(filter(lambda node: getattr(node, 'is_global_operation', False), self.graph.nodes))
+        global_operations = list(filter(lambda node: getattr(node, 'is_global_operation', False), dirty))
         for node in global_operations:
             if node in self.expanded_global_operations:
                 continue
@@ -277,7 +732,9 @@ class Graph():
                 if descendant.color == '':
                     descendant.color = 'globalCollector'
 
-        for node in nx.algorithms.topological_sort(self.graph):
+        # the data nodes between the new nodes are needed to sort them
+        subgraph = self.graph.subgraph(dirty.union(*(node.outputs for node in dirty)))
+        for node in nx.algorithms.topological_sort(subgraph):
             if skip(node) or node.color:
                 continue
 
@@ -291,16 +748,20 @@ class Graph():
             else:
                 node.color = 'worker'
 
-    def _expand_global_operations(self, num_workers, num_local_collectors):
+    def _expand_global_operations(self, num_workers, num_local_collectors, num_mid_collectors=None):
         """
-        Expand the nodes found in color_nodes into three nodes which execute on the worker, local collector, and
-        global collector respectively. The number of workers and number of local collectors must be known in order to
-        properly expand PickN operations.
+        Expand the nodes found in color_nodes into nodes which execute on the worker, local collector, any
+        intermediate collector tiers, and global collector respectively. The number of workers and number of
+        collectors in each tier must be known in order to properly expand PickN operations.
 
         Args:
             num_workers (int): Total number of workers.
             num_local_collectors (int): Total number of local collectors.
+            num_mid_collectors (list): Number of collectors in each intermediate tier between the local
+                collectors and the global collector.
         """
+        if num_mid_collectors is None:
+            num_mid_collectors = []
 
         inputs = [n for n, d in self.graph.in_degree() if d == 0]
         self.inputs['worker'].update(inputs)
@@ -311,12 +772,15 @@ class Graph():
             if node.parent not in self.children_of_global_operations:
                 self.children_of_global_operations[node.parent] = set()
 
-            self.graph.remove_node(node)
+            self._remove_nodes([node])
             NewNode = getattr(gn, node.__class__.__name__)
 
-            color_order = ['worker', 'localCollector', 'globalCollector']
+            mid_colors = ['midCollector%d' % tier for tier in range(len(num_mid_collectors))]
+            color_order = ['worker', 'localCollector'] + mid_colors + ['globalCollector']
             worker_outputs = None
             local_collector_outputs = None
+            upstream_outputs = None
+            upstream_collectors = None
             extras = node.on_expand()
 
             for color in color_order:
@@ -336,10 +800,7 @@ class Graph():
                     worker_node.is_global_operation = False
                     self.children_of_global_operations[node.parent].add(worker_node)
                     self.outputs[color].update(worker_outputs)
-                    for i in inputs:
-                        self.graph.add_edge(i, worker_node)
-                    for o in worker_outputs:
-                        self.graph.add_edge(worker_node, o)
+                    self._add_node(worker_node)
 
                 elif color == 'localCollector':
                     self.inputs[color].update(worker_outputs)
@@ -359,38 +820,59 @@ class Graph():
                     local_collector_node.is_global_operation = False
                     self.children_of_global_operations[node.parent].add(local_collector_node)
                     self.outputs[color].update(local_collector_outputs)
-                    for i in worker_outputs:
-                        self.graph.add_edge(i, local_collector_node)
-                    for o in local_collector_outputs:
-                        self.graph.add_edge(local_collector_node, o)
+                    self._add_node(local_collector_node)
+                    upstream_outputs = local_collector_outputs
+                    upstream_collectors = num_local_collectors
+
+                elif color in mid_colors:
+                    self.inputs[color].update(upstream_outputs)
+                    mid_collector_outputs = list(map(lambda o: o+'_'+color, node.outputs))
+                    num_collectors = num_mid_collectors[mid_colors.index(color)]
+
+                    mid_collector_N = 1
+                    collectors_per_mid_collector = None
+                    if hasattr(node, 'N'):
+                        mid_collector_N = max(node.N // num_collectors, 1)
+                        collectors_per_mid_collector = max(upstream_collectors // num_collectors, 1)
+
+                    mid_collector_node = NewNode(name=node.name+'_'+color, inputs=upstream_outputs,
+                                                 outputs=mid_collector_outputs, reduction=node.reduction,
+                                                 N=mid_collector_N, is_expanded=True,
+                                                 num_contributors=collectors_per_mid_collector, **extras)
+                    mid_collector_node.color = color
+                    mid_collector_node.is_global_operation = False
+                    self.children_of_global_operations[node.parent].add(mid_collector_node)
+                    self.outputs[color].update(mid_collector_outputs)
+                    self._add_node(mid_collector_node)
+                    upstream_outputs = mid_collector_outputs
+                    upstream_collectors = num_collectors
 
                 elif color == 'globalCollector':
-                    self.inputs[color].update(local_collector_outputs)
+                    self.inputs[color].update(upstream_outputs)
 
                     N = getattr(node, 'N', 1)
                     N = max((N // num_workers)*num_workers, 1)
 
                     global_collector_node = NewNode(name=node.name+'_globalCollector',
-                                                    inputs=local_collector_outputs,
+                                                    inputs=upstream_outputs,
                                                     outputs=outputs, reduction=node.reduction, N=N,
                                                     is_expanded=True,
-                                                    num_contributors=num_local_collectors, **extras)
+                                                    num_contributors=upstream_collectors, **extras)
                     global_collector_node.color = color
                     self.children_of_global_operations[node.parent].add(global_collector_node)
                     self.expanded_global_operations.add(global_collector_node)
-                    for i in local_collector_outputs:
-                        self.graph.add_edge(i, global_collector_node)
-                    for o in outputs:
-                        self.graph.add_edge(global_collector_node, o)
+                    self._add_node(global_collector_node)
 
-    def _collect_global_inputs(self):
+    def _collect_global_inputs(self, dirty):
         """
         Insert Pick1 for nodes which run global collector but depend on inputs which are only available on worker.
+
+        Args:
+            dirty (set): the nodes inserted since the last compile, the inputs of the others are already collected.
         """
-        inputs = [n for n, d in self.graph.in_degree() if d == 0]
+        inputs = {n for n, d in self.graph.in_degree() if d == 0}
 
-        global_collector_nodes = list(filter(lambda node: getattr(node, 'color', '') == 'globalCollector',
-                                             self.graph.nodes))
+        global_collector_nodes = list(filter(lambda node: getattr(node, 'color', '') == 'globalCollector', dirty))
 
         for node in global_collector_nodes:
             new_inputs = []
@@ -406,12 +888,12 @@ class Graph():
                     new_inputs.extend(pickone.outputs)
                 else:
                     new_inputs.append(i)
-            self.graph.remove_node(node)
             if update_inputs:
+                self._remove_nodes([node])
                 node.inputs = new_inputs
-            self.add(node)
+                self.add(node)
 
-    def compile(self, num_workers=1, num_local_collectors=1):
+    def compile(self, num_workers=1, num_local_collectors=1, num_mid_collectors=None):
         """
         Convert an AMI graph to a networkfox graph. This function must be called after any function which modifies the
         graph, ie add, insert, remove, or replace.
@@ -419,26 +901,99 @@ class Graph():
         This is done by coloring nodes, expanding global operations, and replacing filter nodes with the appropriate
         networkfox equivalents.
 
+        Compilation is incremental: only the nodes inserted since the last compile are colored and expanded, and
+        the networkfox operations of the other nodes are reused. A graph which has not changed since it was compiled
+        with the same arguments, e.g. because it was compiled before being sent, is not compiled again.
+
         Args:
             num_workers (int): Total number of workers.
             num_local_collectors (int): Total number of local collectors.
+            num_mid_collectors (list): Number of collectors in each intermediate tier of the reduction tree.
         """
-        self.inputs = collections.defaultdict(set)
-        self._color_nodes()
-        self._collect_global_inputs()
-        self._expand_global_operations(num_workers, num_local_collectors)
+        compiler_args = {'num_workers': num_workers, 'num_local_collectors': num_local_collectors,
+                         'num_mid_collectors': list(num_mid_collectors or [])}
+        if self.graphkit is not None and not self.dirty and compiler_args == self.compiler_args:
+            self.plans = {}
+            self.last_plan = None
+            self.needed = None
+            return
+
+        # forget the names of removed nodes, the inputs of the worker are recomputed when expanding
+        for names in (self.inputs, self.outputs):
+            for color in names:
+                names[color] = {name for name in names[color] if name in self.graph}
+        self.inputs['worker'] = set()
+
+        dirty = {node for node in self.dirty if node in self.graph}
+        self._color_nodes(dirty)
+        self._collect_global_inputs(dirty)
+        self._expand_global_operations(num_workers, num_local_collectors, num_mid_collectors)
+        self.dirty = set()
 
-        seen = set()
         outputs = [n for n, d in self.graph.out_degree() if d == 0]
-        body = []
-
+        operations = {}
         for node in self.graph.nodes:
-            if node in seen or skip(node):
+            if skip(node):
                 continue
-            body.append(node.to_operation())
+            if node in dirty or node not in self.operations:
+                operations[node] = node.to_operation()
+            else:
+                operations[node] = self.operations[node]
+        self.operations = operations
 
         self.outputs['globalCollector'].update(outputs)
-        self.graphkit = compose(name=self.name)(*body)
+        self.graphkit = compose(name=self.name)(*operations.values())
+        self.plans = {}
+        self.last_plan = None
+        self.needed = None
+        self._find_mergers()
+        self.compiler_args = compiler_args
+
+    def _find_mergers(self):
+        """
+        Finds the collector colors whose inputs are each consumed by a single global operation with a typed
+        reduction. The contributions for these colors can be merged before the graph is run.
+        """
+        self.mergers = {}
+        for color, inputs in self.inputs.items():
+            if color == 'worker' or not inputs:
+                continue
+            mergers = {}
+            for name in inputs:
+                consumers = [node for node in self.graph.successors(name)
+                             if getattr(node, 'color', None) == color] if name in self.graph else []
+                if len(consumers) != 1 or not isinstance(consumers[0], gn.GlobalTransformation) \
+                        or not consumers[0].can_merge():
+                    break
+                mergers[name] = consumers[0]
+            else:
+                self.mergers[color] = mergers
+
+    def merge(self, contributions, color):
+        """
+        Combines the contributions a collector received from each of its contributors into one when every node
+        consuming them has a typed reduction (see graph_nodes.Reduction), so the graph is run once instead of once
+        per contributor. Otherwise the contributions are returned unchanged.
+
+        Args:
+            contributions (list): the contributions, which are dictionaries of the inputs of the graph.
+            color (str): the color of the collector.
+
+        Returns:
+            A list of the contributions to run through the graph in order.
+        """
+        mergers = self.mergers.get(color)
+        if mergers is None or len(contributions) < 2:
+            return contributions
+        # every contribution has to provide the same inputs for them to be merged
+        names = set(mergers)
+        for data in contributions:
+            if data.keys() != names or any(value is None for value in data.values()):
+                return contributions
+        try:
+            return [{name: node.merge([data[name] for data in contributions]) for name, node in mergers.items()}]
+        except (TypeError, ValueError):
+            return contributions
 
     def nxplot(self, filename=None):
         A = nx.nx_agraph.to_agraph(self.graph)
@@ -466,29 +1021,100 @@ class Graph():
         Executes the graph. The dictionary returned by this function will only contain entries for
         the keys in self.outputs for the given color.
 
+        A batch of events is executed at once when args[0] is a list of dictionaries, or a dictionary of
+        columns with one value per event when batch is True, and a list of dictionaries is returned, one per
+        event (see ExecutionPlan.batch).
+
         :param args: args[0] should be dictionary of arguments required to execute graph nodes.
         :param kwargs: Should contain a key called color with a valid color, either worker, localCollector,
-                       or globalCollector.
+                       midCollector<tier>, or globalCollector. A key called batch set to True passes a batch of
+                       events as a dictionary of columns.
         :raises AssertionError: if compile() has not been falled first or if color is None.
         """
-        missing_inputs = [k for k, v in args[0].items() if v is None]
-
-        for missed_inputs in missing_inputs:
-            args[0].pop(missed_inputs)
-
         assert self.graphkit is not None, "call compile first"
         color = kwargs.get('color', None)
         assert color is not None
-        result = self.graphkit(*args, **kwargs)
-        outputs = self.outputs[color]
-        return {k: result[k] for k in outputs if k in result}
+        plan = self.plans.get(color)
+        if plan is None:
+            plan = self.plan(color)
+        self.last_plan = plan
+        data = args[0]
+        if isinstance(data, (list, tuple)):
+            return plan.batch(data)
+        elif kwargs.get('batch', False):
+            size = min((len(column) for column in data.values()), default=0)
+            return plan.batch([{name: column[row] for name, column in data.items()} for row in range(size)])
+        return plan(data)
+
+    def set_unviewed(self, names):
+        """
+        Sets which outputs of the global collector are no longer viewed, e.g. because their plot windows were
+        closed. Nodes which are only needed for these outputs are not run by any color, so their state is not
+        updated until the outputs are viewed again.
+
+        Args:
+            names (iterable): the names of the outputs which are no longer viewed.
+        """
+        self.unviewed = set(names)
+        self.plans = {}
+        self.last_plan = None
+        self.needed = None
+
+    def _ancestors(self, names, color=None):
+        """
+        Finds the names and nodes that names are computed from, including names.
+
+        Args:
+            names (iterable): the names to start from.
+            color (str): only follow nodes of this color. Defaults to following all the nodes.
+
+        Returns:
+            The set of names and nodes.
+        """
+        found = set()
+        stack = [name for name in names if name in self.graph]
+        while stack:
+            item = stack.pop()
+            if item in found:
+                continue
+            found.add(item)
+            for predecessor in self.graph.predecessors(item):
+                if color is None or skip(predecessor) or predecessor.color == color:
+                    stack.append(predecessor)
+        return found
+
+    def plan(self, color):
+        """
+        Builds the execution plan which runs the nodes of a color (see ExecutionPlan). Nodes which contribute
+        neither to the outputs of the color needed downstream nor to the outputs of the graph which are still viewed
+        are left out. Nodes producing outputs of the graph which are never viewed, e.g. to put a value to a PV, are
+        always run.
+
+        Args:
+            color (str): the color of the nodes.
+
+        Returns:
+            The execution plan.
+        """
+        assert self.graphkit is not None, "call compile first"
+        if self.needed is None:
+            self.needed = self._ancestors(self.outputs['globalCollector'] - self.unviewed)
+        outputs = self.outputs[color] & self.needed
+        # the outputs of the graph include the results of nodes of any color that nothing else uses
+        required = self._ancestors(outputs | (self.outputs['globalCollector'] & self.needed), color)
+        nodes = [node for node in nx.algorithms.topological_sort(self.graph)
+                 if not skip(node) and node.color == color and node in required]
+        self.plans[color] = ExecutionPlan(nodes, outputs)
+        return self.plans[color]
 
     def times(self):
         """
-        Return time per execution of graphkit node.
+        Return time per execution of graph node during the last run of the graph.
         """
         assert self.graphkit is not None, "call compile first"
-        return self.graphkit.times()
+        if self.last_plan is None:
+            return {}
+        return self.last_plan.times()
 
     def metadata(self):
         """
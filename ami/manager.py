@@ -4,6 +4,7 @@ import os
 import sys
 import zmq
 import dill
+import pickle
 import logging
 import collections
 import argparse
@@ -13,7 +14,8 @@ import time
 import datetime as dt
 import prometheus_client as pc
 from ami import LogConfig
-from ami.comm import BasePort, Ports, AutoExport, Collector, Store, ZMQ_TOPIC_DELIM
+from ami.comm import BasePort, Ports, AutoExport, Collector, Store, HighWaterMarks, ZMQ_TOPIC_DELIM, collector_tiers, \
+    rank_stragglers
 from ami.data import MsgTypes, Transitions, Serializer, Deserializer
 from ami.graphkit_wrapper import Graph
 
@@ -41,7 +43,9 @@ class Manager(Collector):
                  export_addr,
                  view_addr,
                  prometheus_dir,
-                 hutch):
+                 hutch,
+                 fan_in=None,
+                 member_heartbeats=None):
         """
         protocol right now only tells you how to communicate with workers
         """
@@ -49,6 +53,17 @@ class Manager(Collector):
         self.name = "manager"
         self.num_workers = num_workers
         self.num_nodes = num_nodes
+        self.fan_in = fan_in
+        # the workers contributing to the graphs, which can change during a run. The graphs stay compiled for
+        # num_workers, which is also the most workers the collectors have room for
+        self.members = set(range(num_workers))
+        self.members_version = 0
+        # workers which miss this many heartbeats in a row are removed from the members, if None they never are
+        self.member_heartbeats = member_heartbeats
+        # the number of heartbeats reported by all the workers, and its value at the last report of each member
+        self.alive_count = 0
+        self.alive = {identity: 0 for identity in self.members}
+        self.workers_per_node = max((num_workers + num_nodes - 1) // num_nodes, 1)
         self.heartbeats = {}
         self.partition = {}
         self.feature_stores = {}
@@ -56,10 +71,14 @@ class Manager(Collector):
         self.view_req = re.compile(r"view:(?P<graph>.*):(?P<name>.*)")
         self.graphs = {}
         self.paths = collections.defaultdict(set)
+        self.limits = {}  # { graph_name : {'depth': ..., 'max_bytes': ...} }
         self.versions = {}  # { graph_name : version_number}
+        self.compiled = {}  # { graph_name : (version_number, compiler_args, compiled graph, dill.dumps(graph)) }
         self.purged = set()
         self.purged_graphs = {}  # { graph_name : dill.dumps(graph) }
-        self.global_cmds = {"list_graphs"}
+        self.stragglers = {}  # { collector_name : [contributor arrival statistics] }
+        self.unviewed = collections.defaultdict(set)  # { graph_name : outputs whose viewers have all closed }
+        self.global_cmds = {"list_graphs", "get_members"}
         self.no_auto_create_cmds = {"create_graph", "destroy_graph"}
 
         self.export = self.ctx.socket(zmq.XPUB)
@@ -89,10 +108,14 @@ class Manager(Collector):
 
         self.view_comm = self.ctx.socket(zmq.XPUB)  # exports plot data to clients
         self.view_comm.setsockopt(zmq.XPUB_VERBOSE, True)
+        # updates are dropped for each viewer that falls behind by this many, without holding up the others
+        self.view_comm.setsockopt(zmq.SNDHWM, HighWaterMarks.View)
         self.view_comm.bind(view_addr)
         self.register(self.view_comm, self.view_request)
 
         self.prometheus_dir = prometheus_dir
+        self.event_contributors = pc.Gauge('ami_event_contributors', 'Workers Contributing To Heartbeat',
+                                           ['hutch', 'graph', 'process'])
 
     def __enter__(self):
         return self
@@ -137,6 +160,8 @@ class Manager(Collector):
                 self.export_data(msg.name, msg.payload)
                 # update the latest heartbeat indicator
                 self.heartbeats[msg.name] = msg.heartbeat
+                # heartbeats completed by a timeout are missing data from some workers
+                self.event_contributors.labels(self.hutch, msg.name, self.name).set(msg.contributors)
                 # export the heartbeat to epics
                 self.export_heartbeat(msg.name)
                 # export data for viewing in the AMI GUI
@@ -156,7 +181,9 @@ class Manager(Collector):
 
     @property
     def compiler_args(self):
-        return {'num_workers': self.num_workers, 'num_local_collectors': self.num_nodes}
+        return {'num_workers': max(self.num_workers, 1),
+                'num_local_collectors': self.num_nodes,
+                'num_mid_collectors': collector_tiers(self.num_nodes, self.fan_in)}
 
     def exists(self, name):
         return all(name in val for val in [self.feature_stores, self.graphs, self.versions, self.heartbeats])
@@ -181,8 +208,10 @@ class Manager(Collector):
             del self.graphs[name]
             del self.versions[name]
             del self.heartbeats[name]
+            self.compiled.pop(name, None)
             # notify export of the removed graph
             self.export_destroy(name)
+            self.unviewed.pop(name, None)
             # add the graph name to the purged list
             self.purged.add(name)
         else:
@@ -237,16 +266,50 @@ class Manager(Collector):
 
     def compile_graph(self, name):
         """
-        Tries to compile the named graph. A copy of the original graph is made,
-        so the original graph is uneffected by the compilation.
+        Tries to compile the named graph. A structural copy of the original graph
+        is made, so the original graph is uneffected by the compilation.
 
         Args:
             name (str): the name of the graph to compile.
         """
-        graph = dill.loads(dill.dumps(self.graphs[name]))
+        graph = self.graphs[name].copy()
         graph.compile(**self.compiler_args)
         return graph
 
+    def validate_graph(self, name):
+        """
+        Compiles the named graph to check that an edit is valid. The result is
+        cached as the compiled graph of the version about to be published, so
+        it is not compiled a second time when it is sent.
+
+        Args:
+            name (str): the name of the graph to validate.
+        """
+        graph = self.compile_graph(name) if self.graphs[name] else None
+        self.compiled[name] = (self.versions[name] + 1, self.compiler_args, graph, None)
+
+    def compiled_graph(self, name):
+        """
+        Returns the compiled copy of the named graph and its serialized bytes. These are cached until the graph
+        is published again or the compiler arguments change, so the graph is only compiled and serialized once
+        however many workers and collectors request it.
+
+        Args:
+            name (str): the name of the graph.
+
+        Returns:
+            A tuple of the compiled graph, or None for an empty graph, and the bytes to send.
+        """
+        version, args, graph, payload = self.compiled.get(name, (None, None, None, None))
+        if version != self.versions[name] or args != self.compiler_args:
+            args = self.compiler_args
+            graph = self.compile_graph(name) if self.graphs[name] else None
+            payload = None
+        if payload is None:
+            payload = dill.dumps(graph)
+            self.compiled[name] = (self.versions[name], args, graph, payload)
+        return graph, payload
+
     def cmd_unknown(self, name=None):
         self.comm.send_string('error')
 
@@ -290,6 +353,9 @@ class Manager(Collector):
 
     def cmd_destroy_graph(self, name):
         if self.exists(name):
+            # put the event builder limits back to the collector defaults
+            if self.limits.pop(name, None) is not None:
+                self.publish_limits(name, {'depth': None, 'max_bytes': None})
             # send a null graph to workers
             self.publish_purge(name)
             # delete the local graph information
@@ -310,6 +376,9 @@ class Manager(Collector):
     def cmd_list_graphs(self):
         self.comm.send_pyobj(set(self.graphs))
 
+    def cmd_get_members(self):
+        self.comm.send_pyobj((self.members_version, sorted(self.members)))
+
     def cmd_get_graph(self, name):
         self.comm.send(dill.dumps(self.graphs[name]))
 
@@ -321,12 +390,12 @@ class Manager(Collector):
 
     def cmd_add_graph(self, name):
         nodes = dill.loads(self.comm.recv())
-        backup = dill.dumps(self.graphs[name])
+        # edit a copy so the original can be restored if the edit fails
+        backup = self.graphs[name]
         try:
-            if self.graphs[name] is None:
-                self.graphs[name] = Graph(name)
+            self.graphs[name] = Graph(name) if backup is None else backup.copy()
             self.graphs[name].add(nodes)
-            self.compile_graph(name)
+            self.validate_graph(name)
             self.publish_delta(name, "add", nodes)
         except Exception:
             if isinstance(nodes, list):
@@ -334,27 +403,28 @@ class Manager(Collector):
                                  ", ".join(n.name for n in nodes))
             else:
                 logger.exception("Failure encountered adding node \"%s\" to the graph:", nodes.name)
-            self.graphs[name] = dill.loads(backup)
+            self.graphs[name] = backup
+            self.compiled.pop(name, None)
             logger.info("Restored previous version of the graph (%s v%d)", name, self.versions[name])
             self.comm.send_string('error')
 
     def cmd_del_graph(self, name):
         nodes = dill.loads(self.comm.recv())
         if self.graphs[name] is not None:
-            backup = dill.dumps(self.graphs[name])
+            backup = self.graphs[name]
             try:
-                for node in nodes:
-                    self.graphs[name].remove(node)
+                self.graphs[name] = backup.copy()
+                self.graphs[name].remove(list(nodes))
                 # Check if the resulting graph is non-empty
-                if self.graphs[name]:
-                    self.compile_graph(name)
-                else:
+                if not self.graphs[name]:
                     # if the graph is empty remove it
                     self.graphs[name] = None
+                self.validate_graph(name)
                 self.publish_delta(name, "del", nodes)
             except (AssertionError, TypeError):
                 logger.exception("Failure encountered removing nodes \"%s\" from the graph:", nodes)
-                self.graphs[name] = dill.loads(backup)
+                self.graphs[name] = backup
+                self.compiled.pop(name, None)
                 logger.info("Restored previous version of the graph (%s v%d)", name, self.versions[name])
                 self.comm.send_string('error')
         else:
@@ -362,24 +432,23 @@ class Manager(Collector):
             self.comm.send_string('ok')
 
     def cmd_set_graph(self, name):
-        backup = dill.dumps(self.graphs[name])
+        backup = self.graphs[name]
         try:
             self.graphs[name] = dill.loads(self.comm.recv())
             # Check if the graph can be compiled
-            if self.graphs[name]:
-                self.compile_graph(name)
+            self.validate_graph(name)
             self.publish_graph(name)
         except (AssertionError, TypeError):
             logger.exception("Failure encountered compiling the requested graph:")
-            self.graphs[name] = dill.loads(backup)
+            self.graphs[name] = backup
+            self.compiled.pop(name, None)
             logger.info("Restored previous version of the graph (%s v%d)", name, self.versions[name])
             self.comm.send_string('error')
 
     def cmd_get_metadata(self, name):
         if name in self.graphs and self.graphs[name]:
-            graph = self.compile_graph(name)
-            metadata = graph.metadata()
-            self.comm.send(dill.dumps(metadata))
+            graph, _ = self.compiled_graph(name)
+            self.comm.send(dill.dumps(graph.metadata()))
         else:
             self.comm.send(dill.dumps({}))
 
@@ -409,6 +478,19 @@ class Manager(Collector):
         self.graph_comm.send(dill.dumps(paths))
         self.comm.send_string('ok')
 
+    def cmd_update_limits(self, name):
+        limits = self.comm.recv_pyobj()
+        for key in ('depth', 'max_bytes'):
+            value = limits.get(key)
+            if value is not None and (not isinstance(value, int) or value < 1):
+                logger.error("Invalid event builder %s of %s for graph %s", key, value, name)
+                self.comm.send_string('error')
+                return
+
+        self.limits[name] = limits
+        self.publish_limits(name, limits)
+        self.comm.send_string('ok')
+
     def cmd_update_plots(self, name):
         plots = self.comm.recv_pyobj()
         self.feature_stores[name].update_plots(plots)
@@ -451,13 +533,14 @@ class Manager(Collector):
             if reply:
                 self.comm.send_string('error')
 
-    def publish_graph(self, name, reply=True):
+    def publish_graph(self, name, reply=True, topic="graph"):
         logger.info("Sending requested graph...")
         try:
             self.versions[name] += 1
-            self.graph_comm.send_string("graph", zmq.SNDMORE)
+            _, payload = self.compiled_graph(name)
+            self.graph_comm.send_string(topic, zmq.SNDMORE)
             self.graph_comm.send_pyobj(self.publish_info(name), zmq.SNDMORE)
-            self.graph_comm.send(dill.dumps(self.graphs[name]))
+            self.graph_comm.send(payload)
             self.export_graph(name)
             logger.info("Sending of graph (%s v%d) completed", name, self.versions[name])
             if reply:
@@ -467,30 +550,149 @@ class Manager(Collector):
             if reply:
                 self.comm.send_string('error')
 
+    def publish_limits(self, name, limits):
+        self.graph_comm.send_string("update_limits", zmq.SNDMORE)
+        self.graph_comm.send_pyobj(self.publish_info(name), zmq.SNDMORE)
+        self.graph_comm.send(dill.dumps(limits))
+
+    def publish_unviewed(self, name):
+        self.graph_comm.send_string("update_unviewed", zmq.SNDMORE)
+        self.graph_comm.send_pyobj(self.publish_info(name), zmq.SNDMORE)
+        self.graph_comm.send(dill.dumps(self.unviewed[name]))
+
+    def update_viewed(self, graph, name, viewed):
+        """
+        Tracks the outputs of a graph whose viewers have all closed, so the
+        workers and collectors can skip the nodes only needed for them.
+        Exported outputs are always computed.
+
+        Args:
+            graph (str): the name of the graph.
+            name (str): the name of the output.
+            viewed (bool): whether the output is now viewed.
+        """
+        unviewed = self.unviewed[graph]
+        if viewed:
+            changed = name in unviewed
+            unviewed.discard(name)
+        else:
+            changed = name not in unviewed and not AutoExport.is_auto(name)
+            if changed:
+                unviewed.add(name)
+        if changed and self.exists(graph):
+            logger.info("Output %s of graph %s is %s", name, graph, "viewed again" if viewed else "no longer viewed")
+            self.publish_unviewed(graph)
+
+    def publish_members(self):
+        members = {'workers': sorted(self.members),
+                   'workers_per_node': self.workers_per_node,
+                   'fan_in': self.fan_in}
+        self.graph_comm.send_string("members", zmq.SNDMORE)
+        self.graph_comm.send_pyobj(("", self.members_version, self.compiler_args), zmq.SNDMORE)
+        self.graph_comm.send(dill.dumps(members))
+
+    def update_members(self, identity, active):
+        """
+        Adds or removes a worker from the set of workers contributing to the
+        graphs. Only the new membership is published, the graphs are not
+        resent. Workers with an identity outside of the `num_workers` the
+        collectors were started with cannot be added.
+
+        Args:
+            identity (int): the identity of the worker.
+            active (bool): True if the worker is being added, False if it is
+                being removed.
+        """
+        if active:
+            if not 0 <= identity < self.num_workers:
+                logger.warning("Worker %d can not be added, only %d workers are supported", identity,
+                               self.num_workers)
+                return
+            members = self.members | {identity}
+            self.alive.setdefault(identity, self.alive_count)
+        else:
+            members = self.members - {identity}
+            self.alive.pop(identity, None)
+        if members == self.members:
+            return
+
+        self.members = members
+        self.members_version += 1
+        logger.info("Worker %d %s, %d workers are now active (v%d)", identity,
+                    "added" if active else "removed", len(members), self.members_version)
+        self.publish_members()
+        self.publish_message("members", "manager", dill.dumps(sorted(self.members)))
+
+    def update_alive(self, identity):
+        """
+        Records that a worker has collected another heartbeat. A member which
+        misses `member_heartbeats` heartbeats in a row, judged by how many the
+        other members have reported in the meantime, is removed as if it had
+        deregistered. A removed worker which reports again is added back.
+        Nothing expires while no heartbeats are being collected, e.g. between
+        runs, or at all if `member_heartbeats` is None.
+
+        Args:
+            identity (int): the identity of the worker.
+        """
+        if self.member_heartbeats is None or not 0 <= identity < self.num_workers:
+            return
+        self.alive_count += 1
+        if identity not in self.members:
+            self.update_members(identity, True)
+        self.alive[identity] = self.alive_count
+
+        # each member reports once per heartbeat, so only check once every round of reports
+        others = max(len(self.alive) - 1, 1)
+        if self.alive_count % others:
+            return
+        limit = self.member_heartbeats * others
+        for member, count in list(self.alive.items()):
+            if self.alive_count - count > limit:
+                logger.warning("Worker %d has missed %d heartbeats, removing it", member, self.member_heartbeats)
+                self.update_members(member, False)
+
+    def publish_stragglers(self):
+        """
+        Publishes the contributors of all the collectors ranked from the worst
+        straggler to the best, using the latest report of each collector.
+        """
+        stragglers = [dict(entry, collector=collector)
+                      for collector, entries in self.stragglers.items() for entry in entries]
+        self.publish_message("stragglers", "manager", dill.dumps(rank_stragglers(stragglers)))
+
     def publish_message(self, topic, node, payload):
         self.info_comm.send_string(topic, zmq.SNDMORE)
         self.info_comm.send_string(node, zmq.SNDMORE)
         self.info_comm.send(payload)
 
     def publish_view(self, topic, timestamp, data):
-        self.view_comm.send_string(topic + ZMQ_TOPIC_DELIM, zmq.SNDMORE)
-        self.view_comm.send_pyobj(timestamp, zmq.SNDMORE)
         data = self.serializer(data)
-        self.view_comm.send_multipart(data, copy=False, flags=zmq.NOBLOCK)
+        frames = [(topic + ZMQ_TOPIC_DELIM).encode(), pickle.dumps(timestamp)]
+        frames.extend(data)
+        self.view_comm.send_multipart(frames, copy=False, flags=zmq.NOBLOCK)
         return self.serializer.sizeof(data)
 
     def graph_request(self):
         request = self.graph_comm.recv_string()
 
         if request == "\x01":
-            for name, graph in self.graphs.items():
+            if self.members_version:
+                self.publish_members()
+            for name in self.graphs:
                 if name in self.paths:
                     self.graph_comm.send_string("update_path", zmq.SNDMORE)
                     self.graph_comm.send_pyobj(self.publish_info(name), zmq.SNDMORE)
                     self.graph_comm.send(dill.dumps(self.paths[name]))
+                if name in self.limits:
+                    self.publish_limits(name, self.limits[name])
+                if self.unviewed.get(name):
+                    self.publish_unviewed(name)
+                # the compiled graph is shared by all the subscribers so they do not compile it again
+                _, payload = self.compiled_graph(name)
                 self.graph_comm.send_string("init", zmq.SNDMORE)
                 self.graph_comm.send_pyobj(self.publish_info(name), zmq.SNDMORE)
-                self.graph_comm.send(dill.dumps(graph))
+                self.graph_comm.send(payload)
             # re-ask for config information on connect
             self.graph_comm.send_string("cmd", zmq.SNDMORE)
             self.graph_comm.send_string("config")
@@ -504,6 +706,14 @@ class Manager(Collector):
             # payload = self.node_msg_comm.recv_multipart(copy=False)
             self.node_msg_comm.recv_string()
             self.node_msg_comm.recv_multipart(copy=False)
+        elif topic in ("register", "deregister"):
+            identity = dill.loads(self.node_msg_comm.recv(copy=False))
+            self.update_members(identity, topic == "register")
+        elif topic == "alive":
+            self.update_alive(dill.loads(self.node_msg_comm.recv(copy=False)))
+        elif topic == "stragglers":
+            self.stragglers[node] = dill.loads(self.node_msg_comm.recv(copy=False))
+            self.publish_stragglers()
         elif topic == "purge":
             name = dill.loads(self.node_msg_comm.recv(copy=False))
             if self.exists(name):
@@ -521,16 +731,20 @@ class Manager(Collector):
 
         if request == "\x01" or request == "\x01sources":
             self.publish_message("sources", "manager", dill.dumps(self.partition))
+        if (request == "\x01" or request == "\x01stragglers") and self.stragglers:
+            self.publish_stragglers()
 
     def view_request(self):
         request = self.view_comm.recv_string()
 
+        # subscribers terminate their topics with the delimiter, which is not part of the name
         if request.startswith("\x01"):
-            request = request.strip('\x01')
+            request = request[1:].rstrip(ZMQ_TOPIC_DELIM)
             matched = self.view_req.match(request)
             if matched:
                 graph = matched.group('graph')
                 name = matched.group('name')
+                self.update_viewed(graph, name, True)
                 if self.exists(graph) and name in self.feature_stores[graph]:
                     self.publish_view("view:%s:%s" % (graph, name),
                                       self.heartbeats[graph],
@@ -539,6 +753,11 @@ class Manager(Collector):
                     logger.debug("Received view request for unknown graph/feature: %s", request)
             else:
                 logger.warn("Received invalid view request: %s", request)
+        elif request.startswith("\x00"):
+            # the last viewer of the output has unsubscribed
+            matched = self.view_req.match(request[1:].rstrip(ZMQ_TOPIC_DELIM))
+            if matched:
+                self.update_viewed(matched.group('graph'), matched.group('name'), False)
 
     def export_view(self, name, keys=[]):
         size = 0
@@ -654,7 +873,9 @@ def run_manager(num_workers,
                 view_addr,
                 prometheus_dir,
                 prometheus_port,
-                hutch):
+                hutch,
+                fan_in=None,
+                member_heartbeats=None):
     logger.info('Starting manager, controlling %d workers on %d nodes PID: %d',
                 num_workers, num_nodes, os.getpid())
     with Manager(
@@ -668,7 +889,9 @@ def run_manager(num_workers,
             export_addr,
             view_addr,
             prometheus_dir,
-            hutch) as manager:
+            hutch,
+            fan_in,
+            member_heartbeats) as manager:
         if prometheus_port:
             manager.start_prometheus(prometheus_port)
         return manager.run()
@@ -708,6 +931,22 @@ def main():
         help='number of nodes (a.k.a local collector processes) (default: 1)'
     )
 
+    parser.add_argument(
+        '--fan-in',
+        type=int,
+        default=None,
+        help='maximum number of contributors per collector, adds intermediate collector tiers when the '
+             'number of nodes exceeds it (default: no intermediate tiers)'
+    )
+
+    parser.add_argument(
+        '--member-heartbeats',
+        type=int,
+        default=None,
+        help='number of heartbeats in a row a worker can miss before it is no longer treated as active, workers '
+             'beyond --num-workers can never be added (default: workers are only removed when they exit)'
+    )
+
     parser.add_argument(
         '--log-level',
         default=LogConfig.Level,
@@ -768,7 +1007,9 @@ def main():
                            view_addr,
                            args.prometheus_dir,
                            args.prometheus_port,
-                           args.hutch)
+                           args.hutch,
+                           args.fan_in,
+                           args.member_heartbeats)
     except KeyboardInterrupt:
         logger.info("Manager killed by user...")
         return 0
@@ -9,9 +9,9 @@ from mpi4py import MPI
 
 from ami import LogConfig
 from ami.multiproc import check_mp_start_method
-from ami.comm import Ports
+from ami.comm import Ports, collector_tiers
 from ami.worker import run_worker
-from ami.collector import run_node_collector
+from ami.collector import run_node_collector, run_mid_collector
 
 
 logger = logging.getLogger(__name__)
@@ -70,6 +70,21 @@ def build_parser():
         help='data source configuration (exampes: static://test.json, psana://exp=xcsdaq13:run=14)'
     )
 
+    parser.add_argument(
+        '--fan-in',
+        type=int,
+        default=None,
+        help='maximum number of contributors per collector, adds intermediate collector tiers when the '
+             'number of nodes exceeds it (default: no intermediate tiers)'
+    )
+
+    parser.add_argument(
+        '--prometheus-port',
+        type=int,
+        default=Ports.Prometheus,
+        help='port for prometheus'
+    )
+
     parser.add_argument(
         '--prometheus-dir',
         help='directory for prometheus configuration',
@@ -115,6 +130,23 @@ def cleanup(procs):
     return failed_proc
 
 
+def tier_addr(args, hosts, tier, index):
+    """
+    Returns the address of a collector in an intermediate tier of the reduction
+    tree. Each collector runs on the first node of the subtree it reduces.
+
+    Args:
+        args (Namespace): the parsed command line arguments
+        hosts (list): the hostnames of the nodes ordered by node rank
+        tier (int): the intermediate tier of the collector
+        index (int): the index of the collector within its tier
+
+    Returns:
+        The zmq address of the collector.
+    """
+    return "tcp://%s:%d" % (hosts[index * args.fan_in ** (tier + 1)], args.port + Ports.MidCollector + tier)
+
+
 def run_ami(args, queue=None):
     flags = {}
     if queue is None:
@@ -165,20 +197,50 @@ def run_ami(args, queue=None):
         # name = MPI.Get_processor_name()
         # print(f"SIZE: {size}, RANK: {global_rank}, LOCAL RANK: {local_rank}, NODE RANK: {node_rank} NAME: {name}")
 
+        # the node leaders share their hostnames so the reduction tree can be laid out
+        leader_comm = comm.Split(0 if local_rank == 0 else MPI.UNDEFINED, global_rank)
+
         if local_rank == 0:
+            hosts = leader_comm.allgather(MPI.Get_processor_name())
+            tiers = collector_tiers(len(hosts), args.fan_in)
+
             collector_proc = mp.Process(
                 name=f'nodecol-n{node_rank}',
                 target=functools.partial(_sys_exit, run_node_collector),
-                args=(node_rank, local_rank_size, collector_addr, globalcol_addr, graph_addr, msg_addr,
-                      args.prometheus_dir, args.hutch)
+                args=(node_rank, local_rank_size, collector_addr,
+                      tier_addr(args, hosts, 0, node_rank // args.fan_in) if tiers else globalcol_addr,
+                      graph_addr, msg_addr, args.prometheus_dir, args.prometheus_port, args.hutch)
             )
             collector_proc.daemon = True
             collector_proc.start()
             procs.append(collector_proc)
 
+            # start the intermediate collectors of the subtrees rooted at this node
+            num_contribs = len(hosts)
+            for tier, num_collectors in enumerate(tiers):
+                span = args.fan_in ** (tier + 1)
+                if node_rank % span == 0:
+                    index = node_rank // span
+                    if tier + 1 < len(tiers):
+                        downstream_addr = tier_addr(args, hosts, tier + 1, index // args.fan_in)
+                    else:
+                        downstream_addr = globalcol_addr
+                    mid_proc = mp.Process(
+                        name=f'midcol-t{tier}-n{index}',
+                        target=functools.partial(_sys_exit, run_mid_collector),
+                        args=(tier, index, min(args.fan_in, num_contribs - index * args.fan_in),
+                              "tcp://*:%d" % (args.port + Ports.MidCollector + tier), downstream_addr,
+                              graph_addr, msg_addr, args.prometheus_dir, args.prometheus_port, args.hutch),
+                        kwargs={'fan_in': args.fan_in}
+                    )
+                    mid_proc.daemon = True
+                    mid_proc.start()
+                    procs.append(mid_proc)
+                num_contribs = num_collectors
+
         run_worker(global_rank, size, args.heartbeat, src_cfg,
                    collector_addr, graph_addr, msg_addr, export_addr,
-                   flags, args.prometheus_dir, args.hutch)
+                   flags, args.prometheus_dir, args.prometheus_port, args.hutch)
 
         # register a signal handler for cleanup on sigterm
         signal.signal(signal.SIGTERM, functools.partial(_sig_handler, procs))
@@ -31,12 +31,19 @@ class Worker(Node):
 
         self.src = src
         self.pending_src = False
-        self.store = ResultStore(collector_addr, self.ctx)
+        self.registered = False
+        # the sequence number of the last transition since the last Configure
+        self.transition_seq = 0
+        # the last heartbeat collected by this worker
+        self.last_heartbeat = None
+        self.store = ResultStore(collector_addr, self.ctx, batching=True)
 
         self.graph_comm.add_command("config", self.send_configure)
         self.graph_comm.add_handler("update_sources", self.update_sources)
 
         self.exports = {}
+        # the outputs of each graph which are no longer viewed
+        self.unviewed = {}
 
     def __enter__(self):
         return self
@@ -49,14 +56,36 @@ class Worker(Node):
         return "worker%03d" % self.node
 
     def close(self):
+        if self.registered:
+            self.report_membership(False)
         self.ctx.destroy()
 
     def send_configure(self):
         if self.src:
-            self.store.send(self.src.configure())
+            self.send_transition(self.src.configure())
         else:
-            self.store.send(Message(MsgTypes.Transition, self.node,
-                                    Transition(Transitions.Configure, {})))
+            self.send_transition(Message(MsgTypes.Transition, self.node,
+                                         Transition(Transitions.Configure, {})))
+
+    def send_transition(self, msg):
+        """
+        Numbers the transition in the sequence of transitions since the last
+        Configure and stamps it with the last heartbeat collected before it,
+        then forwards it to the collector.
+
+        Args:
+            msg (Message): the transition message
+        """
+        if msg.payload.ttype == Transitions.Configure:
+            self.transition_seq = 0
+        else:
+            self.transition_seq += 1
+        msg.payload.seq = self.transition_seq
+        msg.payload.heartbeat = self.last_heartbeat
+        if msg.payload.ttype == Transitions.Configure:
+            # the heartbeats of the new run may be numbered from the start again
+            self.last_heartbeat = None
+        self.store.send(msg)
 
     def init_graph(self, name):
         if name not in self.graphs or self.graphs[name] is None:
@@ -82,9 +111,15 @@ class Worker(Node):
     def update_graph(self, name, version, args):
         if self.graphs[name]:
             self.graphs[name].compile(**args)
+            self.graphs[name].set_unviewed(self.unviewed.get(name, ()))
         self.update_requests()
         self.store.configure(name, version)
 
+    def update_unviewed(self, name, version, args, names):
+        self.unviewed[name] = names
+        if self.graphs.get(name):
+            self.graphs[name].set_unviewed(names)
+
     def recv_graph(self, name, version, args, graph):
         self.graphs[name] = graph
         self.update_graph(name, version, args)
@@ -96,8 +131,7 @@ class Worker(Node):
 
     def recv_graph_del(self, name, version, args, nodes):
         self.init_graph(name)
-        for node in nodes:
-            self.graphs[name].remove(node)
+        self.graphs[name].remove(list(nodes))
         self.update_graph(name, version, args)
 
     def recv_graph_purge(self, name, version, args, nodes):
@@ -140,6 +174,7 @@ class Worker(Node):
     def collect(self, heartbeat):
         # send the data from the store to collector
         size = self.store.collect(self.node, heartbeat)
+        self.last_heartbeat = heartbeat.identity
 
         # update the profiler data
         # if self.times:
@@ -179,6 +214,8 @@ class Worker(Node):
 
         while True:
             for msg in self.src.events():
+                # retry anything the collector could not take yet, e.g. the last transition
+                self.store.drain_spill()
                 idle_stop = time.time()
                 event_time.labels(self.hutch, 'Idle', self.name).set(idle_stop - idle_start)
 
@@ -206,7 +243,17 @@ class Worker(Node):
                         except zmq.Again:
                             break
 
+                    # let the manager know this worker is contributing, e.g. if it was added during a run
+                    if not self.registered:
+                        self.registered = self.report_membership()
+                    self.report_alive()
+
                     event_counter.labels(self.hutch, 'Heartbeat', self.name).inc()
+                    deferred, dropped = self.store.reset_counts()
+                    if deferred:
+                        event_counter.labels(self.hutch, 'Deferred Heartbeat', self.name).inc(deferred)
+                    if dropped:
+                        event_counter.labels(self.hutch, 'Dropped Heartbeat', self.name).inc(dropped)
 
                     if self.pending_src:
                         break
@@ -281,7 +328,7 @@ class Worker(Node):
                                 graph.end_step(msg.payload.payload, color=Colors.Worker)
 
                     # forward the transition
-                    self.store.send(msg)
+                    self.send_transition(msg)
                     event_counter.labels(self.hutch, 'Transition', self.name).inc()
                 else:
                     self.store.send(msg)
@@ -289,9 +336,10 @@ class Worker(Node):
 
                 idle_start = time.time()
 
+            self.store.drain_spill()
             if self.pending_src:
                 msg = self.src.unconfigure()
-                self.store.send(msg)
+                self.send_transition(msg)
                 self.src = None
                 self.update_sources(**self.source_args)
 
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tracemalloc
+from ami.comm import collector_tiers
+from ami.graphkit_wrapper import Graph
+from ami.graph_nodes import Map, PickN, Accumulator
+
+
+parser = argparse.ArgumentParser(description='Benchmark compiling, editing and running synthetic AMI graphs.')
+parser.add_argument('--topologies', nargs='+', default=['chain', 'fanout', 'global', 'pickn', 'mixed'],
+                    help='Shapes of the synthetic graphs.')
+parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 1000], help='Number of nodes in the graph.')
+parser.add_argument('--width', type=int, default=10, help='Number of independent chains in the mixed graphs.')
+parser.add_argument('--repeat', type=int, default=5, help='Number of times each compile is timed.')
+parser.add_argument('--events', type=int, default=200, help='Number of events run through each color.')
+parser.add_argument('--edits', type=int, default=10, help='Number of times each kind of edit is timed.')
+parser.add_argument('--workers', type=int, default=16, help='Number of workers to compile for.')
+parser.add_argument('--local-collectors', type=int, default=4, help='Number of local collectors to compile for.')
+parser.add_argument('--fan-in', type=int, default=None,
+                    help='Maximum contributors per collector, which adds intermediate collector tiers.')
+parser.add_argument('--output', help='Save the results as JSON to this file.')
+
+
+def square(x):
+    return x*x
+
+
+def double(x):
+    return 2*x
+
+
+def add(c, x):
+    return c + x
+
+
+def chain(num_nodes, width):
+    """
+    One long chain of Map nodes ending in a PickN.
+    """
+    nodes = [Map(name='Op_node%d' % idx, inputs=['node%d' % (idx - 1) if idx else 'input0'],
+                 outputs=['node%d' % idx], func=double) for idx in range(num_nodes - 1)]
+    nodes.append(PickN(name='Op_pick', inputs=['node%d' % (num_nodes - 2)], outputs=['picked'], N=1))
+    return nodes
+
+
+def fanout(num_nodes, width):
+    """
+    Map nodes which all read the same input, and a PickN of the first one.
+    """
+    nodes = [Map(name='Op_node%d' % idx, inputs=['input0'], outputs=['node%d' % idx], func=double)
+             for idx in range(num_nodes - 1)]
+    nodes.append(PickN(name='Op_pick', inputs=['node0'], outputs=['picked'], N=1))
+    return nodes
+
+
+def global_ops(num_nodes, width):
+    """
+    Pairs of a Map node and an Accumulator on independent inputs.
+    """
+    nodes = []
+    for idx in range(num_nodes // 2):
+        nodes.append(Map(name='Op_node%d' % idx, inputs=['input%d' % idx], outputs=['node%d' % idx], func=square))
+        nodes.append(Accumulator(name='Op_sum%d' % idx, inputs=['node%d' % idx], outputs=['sum%d' % idx],
+                                 reduction=add))
+    return nodes
+
+
+def pickn(num_nodes, width):
+    """
+    Pairs of a Map node and a PickN on independent inputs.
+    """
+    nodes = []
+    for idx in range(num_nodes // 2):
+        nodes.append(Map(name='Op_node%d' % idx, inputs=['input%d' % idx], outputs=['node%d' % idx], func=square))
+        nodes.append(PickN(name='Op_pick%d' % idx, inputs=['node%d' % idx], outputs=['picked%d' % idx], N=4))
+    return nodes
+
+
+def mixed(num_nodes, width):
+    """
+    Chains of Map nodes where every tenth node is an Accumulator and every tenth a PickN.
+    """
+    nodes = []
+    for idx in range(num_nodes):
+        inputs = ['input%d' % (idx % width)] if idx < width else ['node%d' % (idx - width)]
+        outputs = ['node%d' % idx]
+        if idx % 10 == 9:
+            nodes.append(Accumulator(name='Op_node%d' % idx, inputs=inputs, outputs=outputs, reduction=add))
+        elif idx % 10 == 5:
+            nodes.append(PickN(name='Op_node%d' % idx, inputs=inputs, outputs=outputs, N=1))
+        else:
+            nodes.append(Map(name='Op_node%d' % idx, inputs=inputs, outputs=outputs, func=square))
+    return nodes
+
+
+topologies = {'chain': chain, 'fanout': fanout, 'global': global_ops, 'pickn': pickn, 'mixed': mixed}
+
+
+def build(topology, num_nodes, width):
+    graph = Graph(name=topology)
+    graph.add(topologies[topology](num_nodes, width))
+    return graph
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_compile(topology, num_nodes, args, compiler_args):
+    times = []
+    for _ in range(args.repeat):
+        graph = build(topology, num_nodes, args.width)
+        times.append(timed(graph.compile, **compiler_args))
+
+    tracemalloc.start()
+    graph = build(topology, num_nodes, args.width)
+    graph.compile(**compiler_args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return graph, {'compile_secs': statistics.median(times), 'memory_bytes': current, 'peak_memory_bytes': peak}
+
+
+def bench_events(graph, args, colors):
+    """
+    Runs events through every color in turn, feeding the outputs of each color to the next one like the workers and
+    collectors do, and returns the median latency of each color.
+    """
+    sources = sorted(graph.sources)
+    latencies = {color: [] for color in colors}
+    for event in range(args.events):
+        data = {source: float(event) for source in sources}
+        for color in colors:
+            start = time.perf_counter()
+            data = graph(data, color=color)
+            latencies[color].append(time.perf_counter() - start)
+    return {'%s_event_secs' % color: statistics.median(times) for color, times in latencies.items()}
+
+
+def bench_edits(graph, args, compiler_args):
+    """
+    Times adding, replacing and removing a Map node at the end of the graph, including the compile after each edit.
+    """
+    def compiled(edit, *params):
+        start = time.perf_counter()
+        edit(*params)
+        graph.compile(**compiler_args)
+        return time.perf_counter() - start
+
+    leaf = sorted(name for name in graph.names if name.startswith('node'))[-1]
+    times = {'add': [], 'replace': [], 'remove': []}
+    for edit in range(args.edits):
+        name = 'Edit%d' % edit
+        times['add'].append(compiled(graph.add, Map(name=name, inputs=[leaf], outputs=[name.lower()], func=square)))
+        # adding a node with the same name and outputs replaces it
+        times['replace'].append(compiled(graph.add, Map(name=name, inputs=[leaf], outputs=[name.lower()],
+                                                        func=double)))
+        times['remove'].append(compiled(graph.remove, name))
+    return {'%s_secs' % edit: statistics.median(values) for edit, values in times.items()}
+
+
+def bench(topology, num_nodes, args, compiler_args, colors):
+    graph, result = bench_compile(topology, num_nodes, args, compiler_args)
+    result.update(bench_events(graph, args, colors))
+    result.update(bench_edits(graph, args, compiler_args))
+    result.update({'topology': topology, 'nodes': num_nodes})
+    return result
+
+
+def report(result, colors):
+    events = ", ".join("%s %.1f us" % (color, result['%s_event_secs' % color] * 1e6) for color in colors)
+    print("%-7s %5d nodes: compile %8.3f ms, peak %7.1f MiB, add/replace/remove %.3f/%.3f/%.3f ms, events: %s" %
+          (result['topology'], result['nodes'], result['compile_secs'] * 1e3, result['peak_memory_bytes'] / 2**20,
+           result['add_secs'] * 1e3, result['replace_secs'] * 1e3, result['remove_secs'] * 1e3, events))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    num_mid_collectors = collector_tiers(args.local_collectors, args.fan_in) if args.fan_in else []
+    compiler_args = {'num_workers': args.workers, 'num_local_collectors': args.local_collectors,
+                     'num_mid_collectors': num_mid_collectors}
+    colors = ['worker', 'localCollector'] + \
+        ['midCollector%d' % tier for tier in range(len(num_mid_collectors))] + ['globalCollector']
+
+    results = []
+    for topology in args.topologies:
+        for num_nodes in args.nodes:
+            result = bench(topology, num_nodes, args, compiler_args, colors)
+            report(result, colors)
+            results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.time(),
+                       'python': sys.version,
+                       'platform': platform.platform(),
+                       'args': vars(args),
+                       'results': results}, f, indent=2)
@@ -10,6 +10,7 @@ import itertools
 import subprocess
 import signal
 import numpy as np
+import prometheus_client as pc
 import ami.multiproc as mp
 try:
     import psana
@@ -61,6 +62,20 @@ def ipc_dir(tmpdir_factory):
         yield tmpdir_factory.mktemp("ipc", False)
 
 
+@pytest.fixture(scope='function')
+def metrics():
+    """
+    Yields a list that tests append the objects which create prometheus metrics to, e.g. collectors. Their metrics
+    are unregistered afterwards so the next test can create them again in the same process.
+    """
+    owners = []
+    yield owners
+    for owner in owners:
+        for value in vars(owner).values():
+            if isinstance(value, pc.metrics.MetricWrapperBase):
+                pc.REGISTRY.unregister(value)
+
+
 @pytest.fixture(scope='function')
 def complex_graph_file(tmpdir, qtbot):
     graph = Graph(name='graph')
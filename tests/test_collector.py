@@ -0,0 +1,90 @@
+import time
+import pytest
+import zmq
+
+from ami.data import MsgTypes, Message, CollectorMessage, Heartbeat, Transitions, Transition, Deserializer
+from ami.comm import Colors, unbatch_frames
+from ami.collector import GraphCollector
+
+
+@pytest.fixture(scope='function')
+def graph_collector(ipc_dir, metrics):
+    addrs = {name: 'ipc://%s/graph_collector_%s' % (ipc_dir, name)
+             for name in ['collector', 'downstream', 'graph', 'msg']}
+    collector = GraphCollector(0, 'localCollector%03d', 2, Colors.LocalCollector, addrs['collector'],
+                               addrs['downstream'], addrs['graph'], addrs['msg'], None, None, None)
+    metrics.append(collector)
+    downstream = collector.ctx.socket(zmq.PULL)
+    downstream.bind(addrs['downstream'])
+    # give the push sockets of the collector time to connect
+    time.sleep(0.1)
+    yield collector, downstream
+
+    collector.close()
+
+
+def received(sock, timeout=1000):
+    deserializer = Deserializer()
+    msgs = []
+    while sock.poll(timeout):
+        msgs.extend(deserializer(frames) for frames in unbatch_frames(sock.recv_multipart(copy=False)))
+        timeout = 100
+    return msgs
+
+
+def transition(identity, ttype, seq, heartbeat=None, sent=None):
+    return Message(MsgTypes.Transition, identity, Transition(ttype, {}, seq, heartbeat, sent))
+
+
+def datagram(identity, heartbeat):
+    return CollectorMessage(mtype=MsgTypes.Datagram, identity=identity, heartbeat=Heartbeat(heartbeat, time.time()),
+                            name='graph', version=0, payload={}, contributors=1)
+
+
+def test_collector_members_transition(graph_collector):
+    collector, downstream = graph_collector
+
+    for identity in range(2):
+        collector.process_msg(transition(identity, Transitions.Configure, 0))
+    assert [msg.payload.ttype for msg in received(downstream)] == [Transitions.Configure]
+
+    # the second worker goes away while the transition is still waiting for it
+    collector.process_msg(transition(0, Transitions.Disable, 1))
+    assert not received(downstream, 100)
+    collector.recv_members('', 1, {}, {'workers': [0], 'workers_per_node': 1, 'fan_in': None})
+
+    msgs = received(downstream)
+    assert [msg.payload.ttype for msg in msgs] == [Transitions.Disable]
+    assert msgs[0].payload.seq == 1
+
+
+@pytest.mark.parametrize('transition_timeout', [5, 0])
+def test_collector_transition_order(graph_collector, transition_timeout):
+    collector, downstream = graph_collector
+    collector.transition_timeout = transition_timeout
+
+    for identity in range(2):
+        collector.process_msg(transition(identity, Transitions.Configure, 0))
+    assert [msg.payload.ttype for msg in received(downstream)] == [Transitions.Configure]
+
+    # the datagram of the second contributor arrives after the transition sent behind it
+    collector.process_msg(datagram(0, 0))
+    for identity in range(2):
+        collector.process_msg(transition(identity, Transitions.Disable, 1, 0, {'graph': 1}))
+
+    if transition_timeout:
+        assert not received(downstream, 100)
+        assert collector.waiting is not None
+        collector.process_msg(datagram(1, 0))
+        contributors = 2
+    else:
+        # without the datagram the transition is completed once the timeout has passed
+        contributors = 1
+    assert collector.waiting is None
+
+    msgs = received(downstream)
+    datagrams = [msg for msg in msgs if msg.mtype == MsgTypes.Datagram]
+    transitions = [msg for msg in msgs if msg.mtype == MsgTypes.Transition]
+    assert [(msg.heartbeat, msg.contributors) for msg in datagrams] == [(0, contributors)]
+    assert [msg.payload.ttype for msg in transitions] == [Transitions.Disable]
+    assert transitions[0].payload.sent == {'graph': 1}
@@ -1,11 +1,15 @@
+import time
+import threading
 import pytest
 import zmq
 import dill
+import numpy as np
 
-from ami.data import MsgTypes, Transitions, Message, CollectorMessage, Deserializer, Heartbeat
+from ami.data import MsgTypes, Transitions, Transition, Message, CollectorMessage, Deserializer, Heartbeat
 from ami.comm import Colors, ContributionBuilder, TransitionBuilder, EventBuilder
 from ami.graphkit_wrapper import Graph
-from ami.graph_nodes import PickN
+from ami.graph_nodes import PickN, Accumulator
+from ami.collector import GraphLane, CheckpointWriter, StragglerTracker
 
 
 class FakeBuilder(ContributionBuilder):
@@ -34,8 +38,8 @@ def eb_graph():
 
 @pytest.fixture(scope='function')
 def event_builder(request):
-    num, depth = request.param
-    eb = EventBuilder(num, depth, Colors.LocalCollector, "inproc://eb_test")
+    num, depth, *kwargs = request.param
+    eb = EventBuilder(num, depth, Colors.LocalCollector, "inproc://eb_test", **(kwargs[0] if kwargs else {}))
     yield eb
 
     # clean up all the zmq stuff
@@ -120,6 +124,33 @@ def test_builder_valid_contributors(test_builder, contrib_id, bad):
         assert bad
 
 
+@pytest.mark.parametrize('test_builder', [3], indirect=True)
+def test_builder_members(test_builder):
+    test_builder.update(0, 0, "test_data")
+    test_builder.update(0, 1, "test_data")
+    test_builder.update(1, 0, "test_data")
+    assert not test_builder.ready_keys()
+
+    # the third contributor leaves so only the first two are needed
+    assert test_builder.set_members([0, 1], 1)
+    assert test_builder.ready_keys() == [0]
+
+    # an older membership is ignored
+    assert not test_builder.set_members([0], 1)
+    assert test_builder.ready_keys() == [0]
+
+    # a contributor which is no longer active can still contribute
+    test_builder.update(1, 2, "test_data")
+    assert not test_builder.ready(1)
+
+    # an empty membership is never ready
+    assert test_builder.set_members([], 2)
+    assert not test_builder.ready_keys()
+
+    with pytest.raises(ValueError):
+        test_builder.set_members([3], 3)
+
+
 @pytest.mark.parametrize('transition_builder, ttype',
                          [
                             (1, Transitions.Configure),
@@ -135,21 +166,24 @@ def test_tb_comp(transition_builder, ttype):
     sock = tb.ctx.socket(zmq.PULL)
     sock.bind(addr)
     idnum = 0
-    alt_key = "alt_key"
+    seq = 0
+    alt_seq = 1
     payload = {"test": "val"}
 
     for contrib in range(contribs):
-        assert not tb.ready(alt_key)
-        assert not tb.ready(ttype)
+        assert not tb.ready(alt_seq)
+        assert not tb.ready(seq)
         # update the transition
-        tb.update(ttype, contrib, payload)
-    # check that the builder is ready for the expected type
-    assert tb.ready(ttype)
-    # check that other keys aren't ready
-    assert not tb.ready(alt_key)
+        tb.update(seq, contrib, Transition(ttype, payload, seq, 10 + contrib))
+    # check that the builder is ready for the expected sequence number
+    assert tb.ready(seq)
+    # check that other sequence numbers aren't ready
+    assert not tb.ready(alt_seq)
+    # the boundary is the last heartbeat sent by every contributor
+    assert tb.boundary(seq) == 10
 
     # complete the transition
-    tb.complete(ttype, idnum)
+    tb.complete(seq, idnum)
 
     deserializer = Deserializer()
     try:
@@ -164,6 +198,50 @@ def test_tb_comp(transition_builder, ttype):
     # test the value in the results dictionary from the message
     assert msg.payload.ttype == ttype
     assert msg.payload.payload == payload
+    assert msg.payload.seq == seq
+    assert msg.payload.heartbeat == 10
+
+
+@pytest.mark.parametrize('transition_builder', [2], indirect=True)
+def test_tb_sequence(transition_builder):
+    contribs, addr, tb = transition_builder
+    transitions = [
+        Transition(Transitions.Configure, {}, 0, None),
+        Transition(Transitions.BeginStep, 1, 1, 4),
+        Transition(Transitions.EndStep, 1, 2, 9),
+        Transition(Transitions.BeginStep, 2, 3, 9),
+    ]
+
+    # the first contributor runs ahead of the second one
+    for transition in transitions:
+        tb.update(transition.seq, 0, transition)
+    for transition in transitions:
+        assert not tb.ready(transition.seq)
+        tb.update(transition.seq, 1, transition)
+        # steps of the same type are kept apart by their sequence number
+        assert tb.ready(transition.seq)
+        assert tb.pending[transition.seq].ttype == transition.ttype
+        tb.complete(transition.seq, 0, drop=True)
+
+    # a resent transition that has already been completed is dropped
+    tb.update(2, 1, transitions[2])
+    assert not tb.ready(2)
+    assert tb.reset_duplicates() == 1
+    assert tb.reset_duplicates() == 0
+
+    # a heartbeat boundary is only known if every contributor reports one
+    tb.update(4, 0, Transition(Transitions.EndStep, 2, 4, 15))
+    tb.update(4, 1, Transition(Transitions.EndStep, 2, 4, None))
+    assert tb.boundary(4) is None
+    tb.complete(4, 0, drop=True)
+
+    # the next Configure restarts the sequence
+    tb.update(0, 0, transitions[0])
+    tb.update(0, 1, transitions[0])
+    assert tb.ready(0)
+    tb.complete(0, 0, drop=True)
+    tb.update(1, 0, transitions[1])
+    assert tb.reset_duplicates() == 0
 
 
 @pytest.mark.parametrize('event_builder', [(1, 5), (2, 5), (3, 5)], indirect=True)
@@ -332,3 +410,299 @@ def test_pending_graph(event_builder, eb_graph):
         for nv in range(ver+1, graph_versions):
             assert nv in event_builder.pending_graphs(graph_name)
             assert event_builder.version(graph_name) == ver
+
+
+@pytest.mark.parametrize('event_builder', [(2, 3)], indirect=True)
+def test_eb_prune_order(event_builder):
+    name = 'test'
+    # heartbeats arriving out of order should still be pruned oldest first
+    hbs = [4, 2, 6, 5, 1, 3]
+    event_builder.create(name)
+
+    for hb in hbs:
+        event_builder.update(name, Heartbeat(hb, 0), 0, 0, {})
+    assert event_builder.builders[name].order == sorted(hbs)
+
+    event_builder.prune(name, 0)
+    assert set(event_builder.pending(name).keys()) == {4, 5, 6}
+    assert event_builder.builders[name].order == [4, 5, 6]
+
+    event_builder.complete(name, 5, 0)
+    assert event_builder.builders[name].order == [4, 6]
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5, {'incremental': True})], indirect=True)
+def test_eb_incremental(event_builder, eb_graph):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+
+    idnum = 0
+    graph_version = 0
+    graph_name = 'test'
+    nworkers = event_builder.num_contribs
+    graph_args = {'num_workers': nworkers, 'num_local_collectors': 1}
+    event_builder.set_graph(graph_name, graph_version, graph_args, dill.loads(eb_graph))
+
+    # nothing has been completed yet, so the first heartbeat is buffered
+    for i in range(nworkers):
+        event_builder.update(graph_name, 0, i, graph_version, {'value_%s' % Colors.Worker: 7})
+    assert event_builder.builders[graph_name].active is None
+    event_builder.complete(graph_name, 0, idnum)
+
+    # the heartbeat after the last completed one is folded into the graph as contributions arrive
+    event_builder.update(graph_name, 1, 0, graph_version, {'value_%s' % Colors.Worker: 1})
+    assert event_builder.builders[graph_name].active == 1
+    assert 0 not in event_builder.pending(graph_name)[1].namespace
+    # later heartbeats are buffered until the earlier ones are completed
+    event_builder.update(graph_name, 2, 0, graph_version, {'value_%s' % Colors.Worker: 2})
+    assert 0 in event_builder.pending(graph_name)[2].namespace
+    event_builder.update(graph_name, 1, 1, graph_version, {'value_%s' % Colors.Worker: 3})
+    assert event_builder.ready(graph_name, 1)
+
+    event_builder.complete(graph_name, 1, idnum)
+    # the next heartbeat takes over and its buffered contributions are folded in
+    assert event_builder.builders[graph_name].active == 2
+    assert 0 not in event_builder.pending(graph_name)[2].namespace
+
+    # contributions for heartbeats that have already been completed are dropped
+    event_builder.update(graph_name, 1, 1, graph_version, {'value_%s' % Colors.Worker: 4})
+    assert 1 not in event_builder.pending(graph_name)
+    late, missing = event_builder.reset_stragglers()
+    assert late == {1: 1}
+    assert not missing
+
+    event_builder.update(graph_name, 2, 1, graph_version, {'value_%s' % Colors.Worker: 5})
+    event_builder.complete(graph_name, 2, idnum)
+    event_builder.flush_batch()
+
+    deserializer = Deserializer()
+    for hb, value in [(0, 7), (1, 3), (2, 5)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert isinstance(msg, CollectorMessage)
+        assert msg.heartbeat == hb
+        assert msg.payload.get('value_%s' % Colors.LocalCollector) == value
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5, {'incremental': True})], indirect=True)
+def test_eb_incremental_order(event_builder, eb_graph):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+
+    idnum = 0
+    graph_version = 0
+    graph_name = 'test'
+    nworkers = event_builder.num_contribs
+    graph_args = {'num_workers': nworkers, 'num_local_collectors': 1}
+    event_builder.set_graph(graph_name, graph_version, graph_args, dill.loads(eb_graph))
+
+    # a newer heartbeat arriving first must not cause the older one to be dropped as late
+    event_builder.update(graph_name, 1, 0, graph_version, {'value_%s' % Colors.Worker: 2})
+    event_builder.update(graph_name, 0, 0, graph_version, {'value_%s' % Colors.Worker: 1})
+    event_builder.update(graph_name, 1, 1, graph_version, {'value_%s' % Colors.Worker: 4})
+    event_builder.update(graph_name, 0, 1, graph_version, {'value_%s' % Colors.Worker: 3})
+    assert event_builder.builders[graph_name].active is None
+    assert event_builder.ready(graph_name, 0)
+    assert event_builder.ready(graph_name, 1)
+
+    event_builder.complete(graph_name, 0, idnum)
+    # the buffered contributions of the next heartbeat are folded once the older one completes
+    assert event_builder.builders[graph_name].active == 1
+    event_builder.complete(graph_name, 1, idnum)
+    event_builder.flush_batch()
+
+    late, missing = event_builder.reset_stragglers()
+    assert not late
+    assert not missing
+
+    deserializer = Deserializer()
+    for hb, value in [(0, 3), (1, 4)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert isinstance(msg, CollectorMessage)
+        assert msg.heartbeat == hb
+        assert msg.payload.get('value_%s' % Colors.LocalCollector) == value
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5, {'timeout': 60})], indirect=True)
+def test_eb_timeout(event_builder):
+    sock = event_builder.ctx.socket(zmq.PULL)
+    sock.bind("inproc://eb_test")
+
+    name = 'test'
+    idnum = 0
+    event_builder.update(name, 0, 0, 0, {}, contributors=3)
+    event_builder.update(name, 1, 0, 0, {}, contributors=3)
+    event_builder.update(name, 1, 1, 0, {}, contributors=2)
+
+    # the heartbeats only expire once the timeout has passed
+    assert not event_builder.expired()
+    assert event_builder.builders[name].expired(time.time() + 61) == [0, 1]
+
+    # complete the first heartbeat without the second contributor
+    event_builder.complete(name, 0, idnum)
+    event_builder.complete(name, 1, idnum)
+    event_builder.flush_batch()
+
+    # the contribution for the completed heartbeat is dropped
+    event_builder.update(name, 0, 1, 0, {}, contributors=2)
+    assert 0 not in event_builder.pending(name)
+    assert 0 not in event_builder.contribs(name)
+
+    late, missing = event_builder.reset_stragglers()
+    assert late == {1: 1}
+    assert missing == {1: 1}
+
+    deserializer = Deserializer()
+    for hb, contributors in [(0, 3), (1, 5)]:
+        msg = sock.recv_serialized(deserializer, zmq.NOBLOCK)
+        assert isinstance(msg, CollectorMessage)
+        assert msg.heartbeat == hb
+        assert msg.contributors == contributors
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5, {'max_bytes': 1000})], indirect=True)
+def test_eb_budget(event_builder):
+    name = 'test'
+    data = {'image': np.zeros(100)}
+
+    event_builder.update(name, Heartbeat(0, 0), 0, 0, data)
+    event_builder.prune(name, 0)
+    assert event_builder.pending_stats() == {name: (1, 800)}
+
+    # a single heartbeat over the budget is kept
+    event_builder.update(name, Heartbeat(0, 0), 1, 0, {'image': np.zeros(200)})
+    event_builder.prune(name, 0)
+    assert event_builder.pending_stats() == {name: (1, 2400)}
+
+    # the oldest heartbeats are completed to get back under the budget
+    event_builder.update(name, Heartbeat(1, 0), 0, 0, data)
+    event_builder.prune(name, 0)
+    assert event_builder.pending_stats() == {name: (1, 800)}
+    assert set(event_builder.pending(name)) == {1}
+
+    # the limits can be changed for each graph
+    event_builder.set_limits(name, max_bytes=10000)
+    event_builder.update(name, Heartbeat(2, 0), 0, 0, data)
+    event_builder.prune(name, 0)
+    assert event_builder.pending_stats() == {name: (2, 1600)}
+
+    event_builder.set_limits(name, depth=1, max_bytes=10000)
+    event_builder.prune(name, 0)
+    assert event_builder.pending_stats() == {name: (1, 800)}
+    assert set(event_builder.pending(name)) == {2}
+
+
+@pytest.mark.parametrize('event_builder', [(2, 5)], indirect=True)
+def test_eb_arrivals(event_builder):
+    name = 'test'
+    event_builder.update(name, Heartbeat(0, 0), 0, 0, {})
+    time.sleep(0.01)
+    event_builder.update(name, Heartbeat(0, 0), 1, 0, {})
+    event_builder.complete(name, Heartbeat(0, 0), 0)
+
+    offsets, completions = event_builder.reset_arrivals()
+    # offsets are relative to the first contribution of the heartbeat
+    assert offsets[0] == [0.0]
+    assert offsets[1][0] >= 0.01
+    assert len(completions) == 1
+    assert completions[0] >= offsets[1][0]
+    assert event_builder.reset_arrivals() == ({}, [])
+
+
+def test_straggler_ranking():
+    tracker = StragglerTracker()
+    tracker.record('worker000', [0.0, 0.1])
+    tracker.record('worker001', [0.5])
+    tracker.record('worker002', [0.0], missing=1)
+
+    ranking = tracker.ranking()
+    # contributors missing at completion rank ahead of slow ones
+    assert [entry['sender'] for entry in ranking] == ['worker002', 'worker001', 'worker000']
+    assert ranking[2]['contributions'] == 2
+    assert ranking[2]['mean_offset'] == pytest.approx(0.05)
+    assert ranking[2]['max_offset'] == 0.1
+    # the statistics are reset after each ranking
+    assert tracker.ranking() == []
+
+
+def test_graph_lanes():
+    ctx = zmq.Context()
+    wake = ctx.socket(zmq.PULL)
+    wake.bind("inproc://lane_wake")
+    reports = []
+
+    def report(topic, payload):
+        reports.append((topic, payload))
+
+    lanes = [GraphLane(EventBuilder(1, 5, Colors.LocalCollector, "inproc://eb_test", ctx), report, "inproc://lane_wake")
+             for _ in range(2)]
+    for lane in lanes:
+        lane.start()
+
+    # a slow graph only delays the lane it is assigned to
+    blocker = threading.Event()
+    done = threading.Event()
+    lanes[0].submit(lambda lane: blocker.wait())
+    lanes[1].submit(lambda lane: done.set())
+    assert done.wait(5)
+    blocker.set()
+    lanes[0].wait()
+
+    # reports from the lane threads are only sent from the main thread
+    lanes[1].submit(lambda lane: lane.report("error", "failure"))
+    lanes[1].wait()
+    assert wake.poll(5000)
+    assert not reports
+    lanes[1].process_reports()
+    assert reports == [("error", "failure")]
+
+    # without a thread the work is done right away
+    inline = GraphLane(EventBuilder(1, 5, Colors.LocalCollector, "inproc://eb_test", ctx), report)
+    inline.submit(lambda lane: lane.report("purge", "graph"))
+    assert reports[-1] == ("purge", "graph")
+
+    ctx.destroy()
+
+
+def test_eb_checkpoint(tmpdir):
+    ctx = zmq.Context()
+    name = 'graph'
+    args = {'num_workers': 1, 'num_local_collectors': 1}
+
+    def make_graph():
+        graph = Graph(name=name)
+        graph.add(Accumulator(name='Sum', inputs=['x'], outputs=['sum'], reduction='sum'))
+        return graph
+
+    eb = EventBuilder(1, 5, Colors.GlobalCollector, "inproc://eb_test", ctx)
+    eb.set_graph(name, 1, args, make_graph())
+    eb.update(name, Heartbeat(0, 0), 0, 1, {'sum_localCollector': 5})
+    eb.complete(name, Heartbeat(0, 0), 0)
+    assert eb.checkpoint() == {name: (1, {'Sum_globalCollector': ('Accumulator', {'res': 5})})}
+
+    writer = CheckpointWriter(str(tmpdir), 'globalCollector000')
+    writer.start()
+    writer.write(name, dill.dumps(eb.checkpoint()[name]))
+    writer.wait()
+
+    # a restarted collector picks up where the old one left off
+    restored = EventBuilder(1, 5, Colors.GlobalCollector, "inproc://eb_test", ctx)
+    for graph_name, (version, states) in writer.load().items():
+        restored.restore_state(graph_name, version, states)
+    restored.set_graph(name, 1, args, make_graph())
+    restored.update(name, Heartbeat(1, 0), 0, 1, {'sum_localCollector': 2})
+    restored.complete(name, Heartbeat(1, 0), 0)
+    assert restored.checkpoint()[name][1]['Sum_globalCollector'] == ('Accumulator', {'res': 7})
+
+    # checkpoints of an older version of the graph are discarded
+    stale = EventBuilder(1, 5, Colors.GlobalCollector, "inproc://eb_test", ctx)
+    stale.restore_state(name, 0, {'Sum_globalCollector': ('Accumulator', {'res': 5})})
+    stale.set_graph(name, 1, args, make_graph())
+    stale.update(name, Heartbeat(1, 0), 0, 1, {'sum_localCollector': 2})
+    stale.complete(name, Heartbeat(1, 0), 0)
+    assert stale.checkpoint()[name][1]['Sum_globalCollector'] == ('Accumulator', {'res': 2})
+
+    writer.remove(name)
+    writer.wait()
+    assert not writer.load()
+
+    ctx.destroy()
@@ -1,7 +1,9 @@
+import pytest
 import dill
 import numpy as np
 from ami.graphkit_wrapper import Graph
-from ami.graph_nodes import PickN, RollingBuffer, Map
+from ami.graph_nodes import PickN, RollingBuffer, Map, Accumulator, ReduceByKey, Reductions
+from ami.comm import collector_tiers
 
 
 def test_filter_on(complex_graph):
@@ -116,3 +118,326 @@ def test_rolling_buffer():
     globalCollector = graph(localCollector1, color='globalCollector')
     assert(globalCollector == {'scatter_x': (8, 10, 12, 14, 16, 18, 20, 22),
                                'scatter_y': (9, 11, 13, 15, 17, 19, 21, 23)})
+
+
+def test_transfer_state():
+    graph = Graph(name='graph')
+    graph.add(RollingBuffer(name='Buffer', inputs=['x'], outputs=['buffer'], N=8))
+    graph.add(Accumulator(name='Sum', inputs=['x'], outputs=['sum'], reduction=lambda c, x: c + x))
+    scaled = dill.loads(dill.dumps(graph))
+    graph.compile(num_workers=4, num_local_collectors=2)
+
+    for x in range(3):
+        graph({'x': x}, color='worker')
+    assert graph({'x': 3}, color='worker') == {'buffer_worker': [2, 3], 'sum_worker': 6}
+
+    # recompile for fewer workers, which gives each worker a larger buffer
+    scaled.compile(num_workers=2, num_local_collectors=2)
+    scaled.transfer_state(graph)
+
+    assert scaled({'x': 4}, color='worker') == {'buffer_worker': [2, 3, 4], 'sum_worker': 10}
+
+
+def test_pickn_state():
+    pick = PickN(name='Pick', inputs=['x'], outputs=['picked'], N=3)
+    assert pick(1) is None
+    assert pick(2) is None
+
+    # the values picked so far are kept by the recompiled node
+    scaled = PickN(name='Pick', inputs=['x'], outputs=['picked'], N=3)
+    scaled.set_state(pick.get_state())
+    assert scaled(3) == [1, 2, 3]
+
+
+def test_incremental_compile():
+    def nodes():
+        return [Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x),
+                Accumulator(name='Sum', inputs=['x2'], outputs=['sum'], reduction=lambda c, x: c + x),
+                Map(name='Double', inputs=['sum'], outputs=['sum2'], func=lambda x: 2*x),
+                PickN(name='Pick', inputs=['x', 'y'], outputs=['picked'], N=2)]
+
+    full = Graph(name='full')
+    full.add(nodes())
+    full.compile(num_workers=4, num_local_collectors=2)
+
+    graph = Graph(name='graph')
+    graph.add(nodes()[:2])
+    graph.compile(num_workers=4, num_local_collectors=2)
+    square = next(op for node, op in graph.operations.items() if node.name == 'Square')
+    graph.add(nodes()[2:])
+    graph.compile(num_workers=4, num_local_collectors=2)
+
+    # only the new nodes are compiled again
+    assert not graph.dirty
+    assert next(op for n, op in graph.operations.items() if n.name == 'Square') is square
+    # and the result is the same as compiling everything at once
+    colors = {node.name: node.color for node in graph.operations}
+    assert colors == {node.name: node.color for node in full.operations}
+    assert graph.inputs == full.inputs
+    assert graph.outputs == full.outputs
+    assert graph({'x': 2, 'y': 1}, color='worker') == full({'x': 2, 'y': 1}, color='worker')
+
+    # removed nodes are forgotten
+    graph.remove('Pick')
+    graph.compile(num_workers=4, num_local_collectors=2)
+    assert 'picked' not in graph.outputs['globalCollector']
+    assert not any(node.name.startswith('Pick') for node in graph.operations)
+
+
+def test_bulk_remove():
+    graph = Graph(name='graph')
+    graph.add([Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x, parent='Square'),
+               Map(name='Cube', inputs=['x'], outputs=['x3'], func=lambda x: x**3, parent='Cube'),
+               PickN(name='Pick', inputs=['x2'], outputs=['picked'], parent='Pick'),
+               Map(name='Plot', inputs=['picked'], outputs=['plot'], func=lambda x: x, parent='Plot')])
+    graph.compile(num_workers=4, num_local_collectors=2)
+
+    # the indexes track the expanded nodes
+    assert set(graph.children['Pick']) == {'Pick_worker', 'Pick_localCollector', 'Pick_globalCollector'}
+    assert graph.nodes_by_name['Pick_worker'].parent == 'Pick'
+
+    graph.remove(['Pick', 'Cube'])
+    graph.compile(num_workers=4, num_local_collectors=2)
+    names = {node.name for node in graph.graph.nodes if not isinstance(node, str)}
+    assert names == {'Square'}
+    assert set(graph.nodes_by_name) == names
+    assert set(graph.children) == {'Square'}
+
+
+def test_copy():
+    graph = Graph(name='graph')
+    graph.add([Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x),
+               PickN(name='Pick', inputs=['x2'], outputs=['picked']),
+               Map(name='Plot', inputs=['picked'], outputs=['plot'], func=lambda x: x)])
+
+    clone = graph.copy()
+    clone.compile(num_workers=4, num_local_collectors=2)
+    # compiling the copy leaves the original untouched
+    assert graph.graphkit is None
+    assert set(graph.nodes_by_name) == {'Square', 'Pick', 'Plot'}
+    assert all(node.color == '' for node in graph.nodes_by_name.values())
+    # but the functions of the nodes are shared
+    assert clone.nodes_by_name['Square'].func is graph.nodes_by_name['Square'].func
+
+    clone.remove('Plot')
+    assert 'Plot' in graph.nodes_by_name
+    graph.compile(num_workers=4, num_local_collectors=2)
+    colors = {node.name: node.color for node in graph.operations}
+    assert colors == {'Square': 'worker', 'Pick_worker': 'worker', 'Pick_localCollector': 'localCollector',
+                      'Pick_globalCollector': 'globalCollector', 'Plot': 'globalCollector'}
+    # a copy of a compiled graph compiles to the same nodes
+    clone = graph.copy()
+    clone.compile(num_workers=4, num_local_collectors=2)
+    assert {node.name: node.color for node in clone.operations} == colors
+
+
+def test_compile_once():
+    graph = Graph(name='graph')
+    graph.add([Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x),
+               PickN(name='Pick', inputs=['x2'], outputs=['picked'])])
+    graph.compile(num_workers=4, num_local_collectors=2)
+
+    # a graph compiled before being sent is not compiled again with the same arguments
+    sent = dill.loads(dill.dumps(graph))
+    graphkit = sent.graphkit
+    sent.compile(num_workers=4, num_local_collectors=2)
+    assert sent.graphkit is graphkit
+    assert {node.name for node in sent.operations} == {node.name for node in graph.operations}
+    # but it is after an edit
+    sent.add(Map(name='Cube', inputs=['x'], outputs=['x3'], func=lambda x: x**3))
+    sent.compile(num_workers=4, num_local_collectors=2)
+    assert sent.graphkit is not graphkit
+
+
+def test_execution_plan():
+    graph = Graph(name='graph')
+    graph.add(Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x))
+    graph.add(Map(name='Split', inputs=['x2'], outputs=['lo', 'hi'],
+                  func=lambda x: None if x > 100 else (x - 1, x + 1)))
+    graph.add(Map(name='Sum', inputs=['lo', 'hi'], outputs=['total'], func=lambda lo, hi: lo + hi))
+    graph.compile(num_workers=4, num_local_collectors=2)
+    graph.outputs['worker'].update(['x2', 'total'])
+
+    assert graph({'x': 3}, color='worker') == {'x2': 9, 'total': 18}
+    # the plan of each color is built once and reused
+    plan = graph.plans['worker']
+    assert set(graph.times()) == {'Square', 'Split', 'Sum'}
+    # nodes downstream of a None result are skipped
+    assert graph({'x': 11}, color='worker') == {'x2': 121}
+    assert graph({'x': None}, color='worker') == {}
+    assert graph.plans['worker'] is plan
+    # recompiling throws the plans away
+    graph.compile(num_workers=4, num_local_collectors=2)
+    assert not graph.plans
+
+
+def test_common_subexpressions():
+    calls = []
+
+    def roi(x0, x1):
+        def func(img):
+            calls.append((x0, x1))
+            return img[x0:x1]
+        return func
+
+    graph = Graph(name='graph')
+    graph.add(Map(name='Roi1', inputs=['img'], outputs=['roi1'], func=roi(1, 3)))
+    graph.add(Map(name='Roi2', inputs=['img'], outputs=['roi2'], func=roi(1, 3)))
+    graph.add(Map(name='Roi3', inputs=['img'], outputs=['roi3'], func=roi(0, 2)))
+    graph.add(Map(name='Sum1', inputs=['roi1'], outputs=['sum1'], func=sum))
+    graph.add(Map(name='Sum2', inputs=['roi2'], outputs=['sum2'], func=sum))
+    graph.add(PickN(name='Pick1', inputs=['sum1'], outputs=['picked1']))
+    graph.add(PickN(name='Pick2', inputs=['sum2'], outputs=['picked2']))
+    graph.compile(num_workers=4, num_local_collectors=2)
+    graph.outputs['worker'].update(['roi1', 'roi2', 'roi3', 'sum1', 'sum2'])
+
+    assert graph({'img': [1, 2, 3, 4]}, color='worker') == \
+        {'roi1': [2, 3], 'roi2': [2, 3], 'roi3': [1, 2], 'sum1': 5, 'sum2': 5}
+    # the identical rois and the sums downstream of them are only run once
+    assert sorted(calls) == [(0, 2), (1, 3)]
+    plan = graph.plans['worker']
+    assert {frozenset(pair) for pair in plan.merged.items()} == {frozenset(['Roi1', 'Roi2']),
+                                                                 frozenset(['Sum1', 'Sum2'])}
+    # stateful nodes are never merged
+    assert {'Pick1_worker', 'Pick2_worker'} <= set(plan.names)
+
+
+def test_fused_maps():
+    graph = Graph(name='graph')
+    graph.add(Map(name='Roi', inputs=['img'], outputs=['roi'], func=lambda img: img[1:3]))
+    graph.add(Map(name='Threshold', inputs=['roi'], outputs=['hits'], func=lambda x: None if x[0] > 100 else x))
+    graph.add(Map(name='Sum', inputs=['hits'], outputs=['sum'], func=sum))
+    graph.add(Map(name='Length', inputs=['img'], outputs=['length'], func=len))
+    graph.add(PickN(name='Pick', inputs=['sum'], outputs=['picked']))
+    graph.compile(num_workers=4, num_local_collectors=2)
+    graph.outputs['worker'].add('sum')
+
+    assert graph({'img': [1, 2, 3, 4]}, color='worker')['sum'] == 5
+    plan = graph.plans['worker']
+    # the chain runs as a single step but every node is still timed
+    assert len(plan.steps) == 3
+    assert set(plan.names) == {'Roi', 'Threshold', 'Sum', 'Length', 'Pick_worker'}
+    assert set(graph.times()) == set(plan.names)
+    assert graph.times()['Sum'] > 0
+    # the chain stops at a None result
+    assert 'sum' not in graph({'img': [1, 200, 3, 4]}, color='worker')
+    assert graph.times()['Threshold'] > 0
+    assert graph.times()['Sum'] == 0
+
+
+def test_batch():
+    graph = Graph(name='graph')
+    graph.add(Map(name='Roi', inputs=['img'], outputs=['roi'], func=lambda img: img[1:3]))
+    graph.add(Map(name='Sum', inputs=['roi'], outputs=['sum'], func=lambda roi: roi.sum(axis=-1), vectorized=True))
+    graph.add(PickN(name='Pick', inputs=['sum'], outputs=['picked']))
+    graph.compile(num_workers=4, num_local_collectors=2)
+    graph.outputs['worker'].add('sum')
+
+    events = [{'img': np.arange(4)}, {'img': None}, {'img': np.ones(4)}]
+    assert [result.get('sum') for result in graph(events, color='worker')] == [3, None, 2]
+    # a dictionary of columns is split into events
+    columns = {'img': np.stack([np.arange(4), np.ones(4)])}
+    assert [result['sum'] for result in graph(columns, color='worker', batch=True)] == [3, 2]
+    # vectorized nodes still run on single events
+    assert graph({'img': np.arange(4)}, color='worker')['sum'] == 3
+    assert set(graph.times()) == {'Roi', 'Sum', 'Pick_worker'}
+
+
+def test_dead_nodes():
+    graph = Graph(name='graph')
+    graph.add(Map(name='Square', inputs=['x'], outputs=['x2'], func=lambda x: x*x))
+    graph.add(Map(name='Unused', inputs=['x'], outputs=['unused'], func=lambda x: x))
+    graph.add(Map(name='Consumed', inputs=['x'], outputs=['consumed'], func=lambda x: x))
+    graph.add(PickN(name='Pick', inputs=['x2'], outputs=['picked']))
+    graph.add(Map(name='Plot', inputs=['picked'], outputs=['plot'], func=lambda x: x))
+    graph.add(Map(name='Other', inputs=['picked', 'consumed'], outputs=['other'], func=lambda x, y: x))
+    graph.compile(num_workers=4, num_local_collectors=2)
+
+    def planned(color):
+        graph.plan(color)
+        return set(graph.plans[color].names)
+
+    # nodes whose results are never used are run, since they may have side effects
+    assert planned('worker') == {'Square', 'Pick_worker', 'Unused'}
+    assert planned('globalCollector') == {'Pick_globalCollector', 'Plot', 'Other'}
+
+    # closing the viewers of an output skips everything only needed for it
+    graph.set_unviewed(['plot', 'other'])
+    assert planned('worker') == {'Unused'}
+    assert planned('localCollector') == set()
+    assert planned('globalCollector') == set()
+    assert graph({'x': 2}, color='worker') == {}
+
+    graph.set_unviewed(['other'])
+    assert planned('worker') == {'Square', 'Pick_worker', 'Unused'}
+    assert planned('globalCollector') == {'Pick_globalCollector', 'Plot'}
+
+
+def test_typed_reductions():
+    assert Reductions.lookup('max') is Reductions.Max
+    assert Reductions.Sum.reduce([1, 2, 3]) == 6
+    assert Reductions.Min.reduce([3, 1, 2]) == 1
+    np.testing.assert_equal(Reductions.Max.reduce([np.array([1, 5]), np.array([4, 2])]), np.array([4, 5]))
+    assert Reductions.Mean.reduce([(1.0, 1), (2.0, 2)]) == (3.0, 3)
+
+    merged = Reductions.Mean.reduce_by_key([{1: (1.0, 1), 2: (2.0, 1)}, {2: (3.0, 2)}, {3: (4.0, 1)}])
+    assert merged == {1: (1.0, 1), 2: (5.0, 3), 3: (4.0, 1)}
+    merged = Reductions.Sum.reduce_by_key([{'a': np.ones(2)}, {'a': np.ones(2), 'b': np.zeros(2)}])
+    np.testing.assert_equal(merged['a'], np.array([2., 2.]))
+    np.testing.assert_equal(merged['b'], np.array([0., 0.]))
+
+    # keys which can't be sorted together are rejected
+    with pytest.raises(TypeError):
+        Reductions.Sum.reduce_by_key([{1: 1}, {'a': 2}])
+
+    # a count has to sum ones at the workers but the partial counts upstream, so it is not a typed reduction
+    assert Reductions.Sum.reduce([3, 5, 7]) == 15
+    with pytest.raises(ValueError):
+        Reductions.lookup('count')
+
+
+def test_merge_contributions():
+    graph = Graph(name='graph')
+    graph.add(ReduceByKey(name='Reduce', inputs=['k', 'v'], outputs=['reduced'], reduction='sum'))
+    graph.add(Accumulator(name='Max', inputs=['v'], outputs=['max'], reduction=Reductions.Max))
+    graph.compile(num_workers=4, num_local_collectors=1)
+
+    contribs = [{'reduced_worker': {0: 1, 1: 2}, 'max_worker': 3},
+                {'reduced_worker': {1: 4}, 'max_worker': 7},
+                {'reduced_worker': {2: 8}, 'max_worker': 5}]
+
+    # the contributions are merged so the graph is run once
+    merged = graph.merge(contribs, 'localCollector')
+    assert merged == [{'reduced_worker': {0: 1, 1: 6, 2: 8}, 'max_worker': 7}]
+    assert graph(merged[0], color='localCollector') == {'reduced_localCollector': {0: 1, 1: 6, 2: 8},
+                                                        'max_localCollector': 7}
+
+    # contributions that don't have the same inputs are left alone
+    partial = contribs + [{'max_worker': 1}]
+    assert graph.merge(partial, 'localCollector') is partial
+
+    # other reductions are run once per contribution
+    graph = Graph(name='graph')
+    graph.add(ReduceByKey(name='Reduce', inputs=['k', 'v'], outputs=['reduced']))
+    graph.compile(num_workers=4, num_local_collectors=1)
+    assert graph.merge(contribs, 'localCollector') is contribs
+
+
+@pytest.mark.parametrize('num_nodes, fan_in, expected',
+                         [
+                            (4, None, []),
+                            (4, 4, []),
+                            (5, 4, [2]),
+                            (100, 8, [13, 2]),
+                            (128, 4, [32, 8, 2]),
+                         ])
+def test_collector_tiers(num_nodes, fan_in, expected):
+    assert collector_tiers(num_nodes, fan_in) == expected
+
+
+def test_mid_collector_names():
+    graph = Graph(name='graph')
+    assert graph.name_is_valid('cspad')
+    assert not graph.name_is_valid('cspad_midCollector0')
+    assert not graph.name_is_valid('cspad_midCollector12')
+    assert graph.name_is_valid('cspad_midCollector')
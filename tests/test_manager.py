@@ -9,7 +9,7 @@ import ami.graph_nodes as gn
 import amitypes as at
 
 from ami.data import MsgTypes, Transitions, Transition, Heartbeat
-from ami.comm import AutoExport, Store, Node, ZmqHandler, GraphCommHandler
+from ami.comm import AutoExport, Store, Node, ZmqHandler, GraphCommHandler, ZMQ_TOPIC_DELIM
 from ami.manager import run_manager
 
 
@@ -60,6 +60,8 @@ class ResultsInjector(Node, ZmqHandler):
         self._name = name
         self.version = version
         self.exceptions = {}
+        self.unviewed = {}
+        self.members = None
 
     def __enter__(self):
         return self
@@ -95,6 +97,19 @@ class ResultsInjector(Node, ZmqHandler):
         if name in self.graphs:
             del self.graphs[name]
 
+    def update_unviewed(self, name, version, args, names):
+        self.unviewed[name] = names
+
+    def recv_members(self, name, version, args, members):
+        self.members = members['workers']
+
+    def alive(self, identity):
+        while True:
+            try:
+                return self.report("alive", identity)
+            except zmq.Again:
+                time.sleep(0.01)
+
     def recv_graph_exception(self, name, version, exception):
         if name not in self.exceptions:
             self.exceptions[name] = {}
@@ -157,7 +172,8 @@ def result_data():
 
 
 @pytest.fixture(scope='function')
-def manager_proc(ipc_dir):
+def manager_proc(request, ipc_dir):
+    params = getattr(request, 'param', {})
     try:
         from pytest_cov.embed import cleanup_on_sigterm
         cleanup_on_sigterm()
@@ -178,9 +194,9 @@ def manager_proc(ipc_dir):
     proc = mp.Process(
         name='manager',
         target=run_manager,
-        args=(1, 1, addrs['results'], addrs['graph'], addrs['comm'],
+        args=(params.get('num_workers', 1), 1, addrs['results'], addrs['graph'], addrs['comm'],
               addrs['msg'], addrs['info'], addrs['export'], addrs['view'],
-              None, None, None)
+              None, None, None, None, params.get('member_heartbeats'))
     )
     proc.daemon = False
     proc.start()
@@ -581,6 +597,59 @@ def test_manager_add_node(manager_ctrl, node_info):
     assert kwargs['name'] in names
 
 
+def test_manager_unviewed(manager_proc, manager_ctrl):
+    comm, injector = manager_ctrl
+
+    # create a fake partition and view one of its sources
+    injector.partition({'delta_t': float}, wait=True)
+    assert comm.view('delta_t')
+    output = comm.auto('delta_t')
+
+    def wait_unviewed(expected):
+        start = time.time()
+        while injector.unviewed.get(comm.current) != expected and time.time() - start < 2.0:
+            injector.wait_graph(timeout=0.1)
+        return injector.unviewed.get(comm.current)
+
+    # subscribe to the output the same way the viewers do, with the topic delimiter
+    viewer = injector.ctx.socket(zmq.SUB)
+    viewer.connect(manager_proc['view'])
+    topic = "view:%s:%s" % (comm.current, output) + ZMQ_TOPIC_DELIM
+    viewer.setsockopt_string(zmq.SUBSCRIBE, topic)
+    time.sleep(0.1)
+
+    # closing the last viewer marks the output as no longer viewed
+    viewer.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+    assert wait_unviewed({output}) == {output}
+
+    # and viewing it again clears it
+    viewer.setsockopt_string(zmq.SUBSCRIBE, topic)
+    assert wait_unviewed(set()) == set()
+    viewer.close()
+
+
+@pytest.mark.parametrize('manager_proc', [{'num_workers': 2, 'member_heartbeats': 10}], indirect=True)
+def test_manager_members(manager_ctrl):
+    comm, injector = manager_ctrl
+
+    def wait_members(expected):
+        start = time.time()
+        while injector.members != expected and time.time() - start < 2.0:
+            injector.wait_graph(timeout=0.1)
+        return injector.members
+
+    # a worker is removed once it has missed too many heartbeats
+    for _ in range(11):
+        injector.alive(0)
+    assert wait_members([0]) == [0]
+
+    # workers beyond the number the manager was started with are never added
+    injector.alive(2)
+    # and a removed worker which starts collecting heartbeats again is added back
+    injector.alive(1)
+    assert wait_members([0, 1]) == [0, 1]
+
+
 def test_manager_create(manager_ctrl):
     comm, injector = manager_ctrl
 
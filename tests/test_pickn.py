@@ -33,6 +33,39 @@ def test_pickn(pickN_graph):
     assert globalCollector == {'ncspads': [1, 2, 3, 4, 1, 2, 3, 4]}
 
 
+@pytest.fixture(scope='function')
+def pickTree_graph():
+    graph = Graph(name='graph')
+    graph.add(PickN(name='cspad_pickN', N=8,
+                    inputs=['cspad'],
+                    outputs=['ncspads']))
+    graph.compile(num_workers=8, num_local_collectors=4, num_mid_collectors=[2])
+    return graph
+
+
+def test_pickTree(pickTree_graph):
+    workers = [pickTree_graph({'cspad': i}, color='worker') for i in range(1, 9)]
+
+    localCollectors = []
+    for worker1, worker2 in zip(workers[::2], workers[1::2]):
+        pickTree_graph(worker1, color='localCollector')
+        localCollectors.append(pickTree_graph(worker2, color='localCollector'))
+
+    midCollectors = []
+    for localCollector1, localCollector2 in zip(localCollectors[::2], localCollectors[1::2]):
+        pickTree_graph(localCollector1, color='midCollector0')
+        midCollectors.append(pickTree_graph(localCollector2, color='midCollector0'))
+
+    pickTree_graph(midCollectors[0], color='globalCollector')
+    globalCollector = pickTree_graph(midCollectors[1], color='globalCollector')
+
+    assert workers[0] == {'ncspads_worker': 1}
+    assert localCollectors[0] == {'ncspads_localCollector': [1, 2]}
+    assert midCollectors[0] == {'ncspads_midCollector0': [1, 2, 3, 4]}
+    assert midCollectors[1] == {'ncspads_midCollector0': [5, 6, 7, 8]}
+    assert globalCollector == {'ncspads': [1, 2, 3, 4, 5, 6, 7, 8]}
+
+
 @pytest.fixture(scope='function')
 def pickMultiple_graph():
     graph = Graph(name='graph')
@@ -1,7 +1,7 @@
 import pytest
 import numpy as np
 from conftest import pyarrowtest
-from ami.data import MsgTypes, CollectorMessage, Serializer, Deserializer
+from ami.data import MsgTypes, CollectorMessage, Heartbeat, Serializer, Deserializer
 
 
 @pytest.fixture(scope='module')
@@ -33,3 +33,25 @@ def test_default_serializer(serializer, obj):
 def test_default_serializer_message(serializer, collector_msg):
     serializer, deserializer = serializer
     assert deserializer(serializer(collector_msg)) == collector_msg
+
+
+@pytest.mark.parametrize("serializer",
+                         [None, pytest.param('arrow', marks=pyarrowtest), 'dill', 'pickle'],
+                         indirect=True)
+def test_heartbeat_message(serializer):
+    serializer, deserializer = serializer
+    msg = CollectorMessage(mtype=MsgTypes.Datagram, identity=0, heartbeat=Heartbeat(7, 1234.5),
+                           name="fake", version=1, payload={})
+    result = deserializer(serializer(msg))
+    assert isinstance(result.heartbeat, Heartbeat)
+    assert result.heartbeat == 7
+    assert result.heartbeat.identity == 7
+    assert result.heartbeat.timestamp == 1234.5
+
+
+def test_heartbeat_ordering():
+    hbs = [Heartbeat(3, 0.5), Heartbeat(1, 2.0), Heartbeat(2, 1.0)]
+    assert sorted(hbs) == [1, 2, 3]
+    assert Heartbeat(1, 0.0) == Heartbeat(1, 5.0)
+    assert hash(Heartbeat(4, 1.0)) == hash(4)
+    assert Heartbeat(5) - Heartbeat(2) == 3
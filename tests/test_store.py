@@ -1,9 +1,10 @@
+import time
 import pytest
 import zmq
 import numpy as np
 
-from ami.data import MsgTypes, Datagram, CollectorMessage, Deserializer
-from ami.comm import Store, ResultStore
+from ami.data import MsgTypes, Transitions, Transition, Datagram, CollectorMessage, Deserializer
+from ami.comm import Store, ResultStore, Collector, unbatch_frames, ZMQ_BATCH_MARKER
 
 
 @pytest.fixture(scope='function')
@@ -328,3 +329,179 @@ def test_store_addremove(obj, expected, store):
     # check that the remove worked
     assert name not in store
     assert not store
+
+
+def test_store_collect_batched(ipc_dir):
+    addr = "ipc://%s/resultstore_batched" % ipc_dir
+    store = ResultStore(addr, batching=True)
+    names = ['test_namespace1', 'test_namespace2']
+    heartbeat = 3
+
+    # create the fake collector
+    collector = store.ctx.socket(zmq.PULL)
+    collector.bind(addr)
+    deserializer = Deserializer()
+
+    for version, name in enumerate(names):
+        store.configure(name, version)
+        store.update(name, {'value': version})
+
+    store.collect(0, heartbeat)
+
+    # both namespaces should arrive in a single envelope
+    frames = collector.recv_multipart(copy=False)
+    msgs = [deserializer(msg_frames) for msg_frames in unbatch_frames(frames)]
+    assert len(msgs) == len(names)
+    for version, (name, msg) in enumerate(zip(names, msgs)):
+        assert isinstance(msg, CollectorMessage)
+        assert msg.name == name
+        assert msg.version == version
+        assert msg.heartbeat == heartbeat
+        assert msg.payload == {'value': version}
+    # check that nothing else was sent
+    with pytest.raises(zmq.Again):
+        collector.recv_multipart(zmq.NOBLOCK)
+
+    collector.close()
+    store.ctx.destroy()
+
+
+def test_store_spill():
+    addr = "inproc://resultstore_spill"
+    store = ResultStore(addr, spill_depth=2)
+    name = 'test_namespace'
+    store.configure(name, 0)
+
+    # swap in an unconnected socket so that every send is deferred to the spill queue
+    store.collector.close()
+    store.collector = store.ctx.socket(zmq.PUSH)
+    for heartbeat in range(3):
+        store.update(name, {'value': heartbeat})
+        store.collect(0, heartbeat)
+    assert len(store.spill) == 2
+    # the oldest heartbeat is the one which gets dropped
+    assert store.reset_counts() == (3, 1)
+    assert store.reset_counts() == (0, 0)
+
+    collector = store.ctx.socket(zmq.PULL)
+    collector.bind(addr)
+    store.collector.connect(addr)
+    deserializer = Deserializer()
+
+    store.update(name, {'value': 3})
+    store.collect(0, 3)
+    # the spilled heartbeats should arrive before the new one
+    for heartbeat in range(1, 4):
+        msg = collector.recv_serialized(deserializer)
+        assert msg.heartbeat == heartbeat
+        assert msg.payload == {'value': heartbeat}
+    assert not store.spill
+
+    collector.close()
+    store.ctx.destroy()
+
+
+def test_store_spill_transition():
+    addr = "inproc://resultstore_spill_transition"
+    store = ResultStore(addr, spill_depth=2)
+    name = 'test_namespace'
+    store.configure(name, 0)
+
+    # swap in an unconnected socket so that every send is deferred to the spill queue
+    store.collector.close()
+    store.collector = store.ctx.socket(zmq.PUSH)
+    store.update(name, {'value': 0})
+    store.collect(0, 0)
+    store.message(MsgTypes.Transition, 0, Transition(Transitions.Unconfigure, None, 1, 0))
+    for heartbeat in range(1, 4):
+        store.update(name, {'value': heartbeat})
+        store.collect(0, heartbeat)
+    # the heartbeats around the transition are dropped but the transition is not
+    assert len(store.spill) == 2
+    assert store.reset_counts() == (5, 3)
+
+    collector = store.ctx.socket(zmq.PULL)
+    collector.bind(addr)
+    store.collector.connect(addr)
+    deserializer = Deserializer()
+
+    # draining the spill queue sends what is left in order without anything new being sent
+    assert store.drain_spill()
+    msg = collector.recv_serialized(deserializer)
+    assert msg.mtype == MsgTypes.Transition
+    assert msg.payload.ttype == Transitions.Unconfigure
+    msg = collector.recv_serialized(deserializer)
+    assert msg.heartbeat == 3
+    assert not store.spill
+
+    collector.close()
+    store.ctx.destroy()
+
+
+class OrderedCollector(Collector):
+    def __init__(self, addr, recv_threads):
+        super().__init__(addr, recv_threads=recv_threads)
+        self.received = []
+
+    @property
+    def name(self):
+        return 'ordered'
+
+    def process_msg(self, msg):
+        self.received.append(msg)
+
+
+def test_collector_recv_order(ipc_dir, metrics):
+    addr = "ipc://%s/collector_order" % ipc_dir
+    collector = OrderedCollector(addr, recv_threads=3)
+    metrics.append(collector)
+    for receiver in collector.receivers:
+        receiver.start()
+    senders = [ResultStore(addr, ctx=collector.ctx) for _ in range(2)]
+    nheartbeats = 50
+
+    for hb in range(nheartbeats):
+        for identity, sender in enumerate(senders):
+            sender.collector_message(identity, hb, 'test', 0, {'value': hb})
+
+    start = time.time()
+    while len(collector.received) < nheartbeats * len(senders) and time.time() - start < 5.0:
+        if collector.recv_sock.poll(100):
+            collector.drain()
+
+    # the messages of each sender are deserialized in parallel but processed in the order they were sent
+    for identity in range(len(senders)):
+        heartbeats = [msg.heartbeat for msg in collector.received if msg.identity == identity]
+        assert heartbeats == list(range(nheartbeats))
+
+    for sender in senders:
+        sender.collector.close(linger=0)
+    collector.ctx.destroy(linger=0)
+
+
+@pytest.mark.parametrize('recv_threads', [1, 3])
+def test_collector_recv_invalid(ipc_dir, metrics, recv_threads):
+    addr = "ipc://%s/collector_invalid%d" % (ipc_dir, recv_threads)
+    collector = OrderedCollector(addr, recv_threads=recv_threads)
+    metrics.append(collector)
+    for receiver in collector.receivers:
+        receiver.start()
+    sender = ResultStore(addr, ctx=collector.ctx)
+    garbage = collector.ctx.socket(zmq.PUSH)
+    garbage.connect(addr)
+
+    # messages which can't be deserialized are skipped without stopping the receivers
+    sender.collector_message(0, 0, 'test', 0, {'value': 0})
+    garbage.send_multipart([b'garbage'])
+    garbage.send_multipart([ZMQ_BATCH_MARKER, b'garbage'])
+    sender.collector_message(0, 1, 'test', 0, {'value': 1})
+
+    start = time.time()
+    while len(collector.received) < 2 and time.time() - start < 5.0:
+        if collector.recv_sock.poll(100):
+            collector.drain()
+    assert [msg.heartbeat for msg in collector.received] == [0, 1]
+
+    garbage.close(linger=0)
+    sender.collector.close(linger=0)
+    collector.ctx.destroy(linger=0)